@@ -0,0 +1,151 @@
+"""
+Time turning an upstream response body into the cached JSON payload, the old
+way (the body parsed three times, the whole body logged at INFO, stdlib json)
+and the way fetch_events/fetch_markets do it now (one parse, only the size
+logged, src.utils.encoding).
+
+Run from the repository root:
+
+    python -m bench.upstream_payloads [--events 500] [--fancy 400] [--repeat 50]
+
+The current path is timed twice: with orjson when it is installed, and with
+the json module it falls back to.
+"""
+import argparse
+import io
+import json
+import logging
+import random
+import statistics
+import time
+
+from src.utils import encoding
+from src.utils.processer import process_event_data, process_market_data
+
+def make_events(count: int) -> bytes:
+    """
+    A /v3/front body with count events of three runners, each with three-level
+    back and lay ladders.
+    """
+    rng = random.Random(1)
+
+    def ladder():
+        return [{"price": round(rng.uniform(1.01, 20), 2), "size": round(rng.uniform(1, 5000), 2)} for _ in range(3)]
+
+    data = []
+    for i in range(count):
+        data.append({
+            "event": {
+                "id": str(30000000 + i),
+                "name": f"Team {i} v Team {i + 1}",
+                "countryCode": "IN",
+                "timezone": "GMT",
+                "openDate": "2025-05-01T14:00:00.000Z",
+            },
+            "catalogue": {
+                "marketId": f"1.{200000000 + i}",
+                "marketName": "Match Odds",
+                "totalMatched": round(rng.uniform(0, 1e6), 2),
+                "runners": [
+                    {
+                        "selectionId": 1000 + r,
+                        "name": f"Runner {r}",
+                        "status": "ACTIVE",
+                        "backOdds": ladder(),
+                        "layOdds": ladder(),
+                    }
+                    for r in range(3)
+                ],
+            },
+        })
+    return json.dumps({"data": data}).encode()
+
+def make_markets(fancy_count: int) -> bytes:
+    """
+    A /GetSession/ body with fancy_count fancy lines and a two-runner bookmaker.
+    """
+    rng = random.Random(2)
+    fancy = [
+        {
+            "marketId": f"9.{i}",
+            "marketName": f"{i % 20} over runs",
+            "statusName": "ACTIVE",
+            "runsNo": rng.randint(30, 200),
+            "runsYes": rng.randint(30, 200),
+            "oddsNo": 100,
+            "oddsYes": 100,
+            "minSetting": 100,
+            "maxSetting": 50000,
+            "sortingOrder": i,
+            "catagory": "SESSIONS",
+            "remarks": "",
+        }
+        for i in range(fancy_count)
+    ]
+    book_maker = [
+        {
+            "marketId": "8.1",
+            "marketName": "Bookmaker",
+            "statusName": "ACTIVE",
+            "minSetting": 100,
+            "maxSetting": 100000,
+            "sortPeriority": 1,
+            "selectionName": f"Team {i}",
+            "selectionStatus": "ACTIVE",
+            "backOdds": rng.randint(1, 99),
+            "layOdds": rng.randint(1, 99),
+        }
+        for i in range(2)
+    ]
+    return json.dumps({"fancy": fancy, "bookMaker": book_maker}).encode()
+
+def old_path(body: bytes, process):
+    # httpx's response.json() decodes the text and parses it on every call
+    logging.info(json.loads(body.decode()))
+    logging.info(json.loads(body.decode()))
+    return json.dumps(process(json.loads(body.decode())))
+
+def new_path(body: bytes, process):
+    logging.info(f"{len(body)} bytes")
+    return encoding.dumps(process(encoding.loads(body)))
+
+def measure(path, body: bytes, process, repeat: int) -> float:
+    """
+    Median milliseconds per call over repeat calls, after one warm-up call.
+    """
+    path(body, process)
+    timings = []
+    for _ in range(repeat):
+        start = time.perf_counter()
+        path(body, process)
+        timings.append((time.perf_counter() - start) * 1000)
+    return statistics.median(timings)
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__.splitlines()[1])
+    parser.add_argument("--events", type=int, default=500)
+    parser.add_argument("--fancy", type=int, default=400)
+    parser.add_argument("--repeat", type=int, default=50)
+    args = parser.parse_args()
+
+    # INFO records are formatted and written, as in the service, but to memory
+    logging.basicConfig(level=logging.INFO, stream=io.StringIO(), force=True)
+
+    orjson = encoding.orjson
+    payloads = [
+        ("events", make_events(args.events), process_event_data),
+        ("markets", make_markets(args.fancy), process_market_data),
+    ]
+    print(f"orjson: {orjson.__version__ if orjson else 'not installed'}")
+    for name, body, process in payloads:
+        old = measure(old_path, body, process, args.repeat)
+        encoding.orjson = None
+        stdlib = measure(new_path, body, process, args.repeat)
+        encoding.orjson = orjson
+        line = f"{name:8} {len(body) / 1024:6.0f} KB  before {old:7.2f} ms  after (json) {stdlib:7.2f} ms"
+        if orjson is not None:
+            line += f"  after (orjson) {measure(new_path, body, process, args.repeat):7.2f} ms"
+        print(line)
+
+if __name__ == "__main__":
+    main()
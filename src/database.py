@@ -1,32 +1,129 @@
+import os
 from typing import Annotated
 from fastapi import Depends
-from sqlmodel import Session, SQLModel, create_engine
+from datetime import datetime
+from sqlalchemy import event, inspect, text
+from sqlalchemy.ext.asyncio import create_async_engine
+from sqlmodel import SQLModel
+from sqlmodel.ext.asyncio.session import AsyncSession
+from dotenv import load_dotenv
 
-from .models.user import User
+from .models.user import Transaction, TransactionType, User
 from .utils.hashing import get_password_hash
 
+load_dotenv()
 
 sqlite_file_name = "database.db"
-sqlite_url = f"sqlite:///{sqlite_file_name}"
+sqlite_url = f"sqlite+aiosqlite:///{sqlite_file_name}"
 
-connect_args = {"check_same_thread": False}
-engine = create_engine(sqlite_url, connect_args=connect_args)
+DATABASE_URL = os.getenv("DATABASE_URL", sqlite_url)
+DB_POOL_SIZE = int(os.getenv("DB_POOL_SIZE", 5))
+DB_MAX_OVERFLOW = int(os.getenv("DB_MAX_OVERFLOW", 10))
+DB_POOL_TIMEOUT = float(os.getenv("DB_POOL_TIMEOUT", 30))
+DB_POOL_RECYCLE = int(os.getenv("DB_POOL_RECYCLE", 1800))
+DB_POOL_PRE_PING = os.getenv("DB_POOL_PRE_PING", "true").lower() == "true"
+DB_ECHO = os.getenv("DB_ECHO", "false").lower() == "true"
 
-def create_db_and_tables():
-    SQLModel.metadata.create_all(engine)
-    with Session(engine) as session:
-        test_admin = session.get(User, "test")
+SQLITE_BUSY_TIMEOUT_MS = int(os.getenv("SQLITE_BUSY_TIMEOUT_MS", 5000))
+SQLITE_SYNCHRONOUS = os.getenv("SQLITE_SYNCHRONOUS", "NORMAL")
+
+def _async_url(url: str) -> str:
+    # Hosted Postgres usually hands out postgres:// URLs without an async driver
+    for prefix in ("postgres://", "postgresql://"):
+        if url.startswith(prefix):
+            return "postgresql+asyncpg://" + url[len(prefix):]
+    return url
+
+def build_engine(url: str = DATABASE_URL):
+    url = _async_url(url)
+    engine = create_async_engine(
+        url,
+        pool_size=DB_POOL_SIZE,
+        max_overflow=DB_MAX_OVERFLOW,
+        pool_timeout=DB_POOL_TIMEOUT,
+        pool_recycle=DB_POOL_RECYCLE,
+        pool_pre_ping=DB_POOL_PRE_PING,
+        echo=DB_ECHO,
+    )
+    if engine.dialect.name == "sqlite":
+        event.listen(engine.sync_engine, "connect", _configure_sqlite)
+    return engine
+
+def _configure_sqlite(dbapi_connection, connection_record):
+    # WAL lets readers proceed while a bet is being written; the busy timeout makes
+    # concurrent writers wait for the lock instead of failing with "database is locked"
+    cursor = dbapi_connection.cursor()
+    cursor.execute("PRAGMA journal_mode=WAL")
+    cursor.execute(f"PRAGMA busy_timeout={SQLITE_BUSY_TIMEOUT_MS}")
+    cursor.execute(f"PRAGMA synchronous={SQLITE_SYNCHRONOUS}")
+    cursor.close()
+
+engine = build_engine()
+
+def new_session() -> AsyncSession:
+    # Loaded attributes stay usable after commit without another round trip
+    return AsyncSession(engine, expire_on_commit=False)
+
+def _upgrade_legacy_schema(connection) -> bool:
+    """
+    Adapt tables created before the balance ledger, which create_all leaves as
+    they are: the old, never-written transaction table is kept aside as
+    transaction_legacy and bet gains its reference column. Returns whether
+    user still holds balances to move into the ledger.
+    """
+    tables = set(inspect(connection).get_table_names())
+    if "transaction" in tables:
+        columns = {column["name"] for column in inspect(connection).get_columns("transaction")}
+        if "final_balance" in columns:
+            connection.execute(text('ALTER TABLE "transaction" RENAME TO transaction_legacy'))
+    if "bet" in tables:
+        columns = {column["name"] for column in inspect(connection).get_columns("bet")}
+        if "reference" not in columns:
+            connection.execute(text("ALTER TABLE bet ADD COLUMN reference VARCHAR"))
+    if "user" in tables:
+        return "balance" in {column["name"] for column in inspect(connection).get_columns("user")}
+    return False
+
+def _move_legacy_balances(connection):
+    """
+    Open each user's ledger with a DEPOSIT of their old user.balance, then drop the column.
+    """
+    connection.execute(
+        text(
+            'INSERT INTO "transaction" (username, amount, type, reference, created_at) '
+            'SELECT username, balance, :type, :reference, :created_at FROM "user" '
+            "WHERE balance IS NOT NULL AND balance <> 0"
+        ),
+        {"type": TransactionType.DEPOSIT.value, "reference": "legacy-balance", "created_at": datetime.now()},
+    )
+    connection.execute(text('ALTER TABLE "user" DROP COLUMN balance'))
+
+def _create_missing_indexes(connection):
+    for table in SQLModel.metadata.sorted_tables:
+        for index in table.indexes:
+            index.create(connection, checkfirst=True)
+
+async def create_db_and_tables():
+    async with engine.begin() as conn:
+        legacy_balances = await conn.run_sync(_upgrade_legacy_schema)
+        await conn.run_sync(SQLModel.metadata.create_all)
+        if legacy_balances:
+            await conn.run_sync(_move_legacy_balances)
+        # create_all skips tables that already exist, so add indexes declared since
+        await conn.run_sync(_create_missing_indexes)
+    async with new_session() as session:
+        test_admin = await session.get(User, "test")
         if test_admin:
             return
-        test_admin = User(username="test", is_admin=True, balance=10000)
-        test_admin.password = get_password_hash("test")
+        test_admin = User(username="test", is_admin=True)
+        test_admin.password = await get_password_hash("test")
         session.add(test_admin)
-        session.commit()
-        session.refresh(test_admin)
+        session.add(Transaction(username="test", amount=10000, type=TransactionType.DEPOSIT.value))
+        await session.commit()
 
 
-def get_session():
-    with Session(engine) as session:
+async def get_session():
+    async with new_session() as session:
         yield session
 
-SessionDep = Annotated[Session, Depends(get_session)]
\ No newline at end of file
+SessionDep = Annotated[AsyncSession, Depends(get_session)]
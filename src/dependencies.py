@@ -1,5 +1,5 @@
 from datetime import datetime, timedelta
-from fastapi import Depends, HTTPException, status
+from fastapi import Depends, HTTPException, Request, status
 from fastapi.security import OAuth2PasswordBearer
 from jose import JWTError, jwt
 from jose.exceptions import ExpiredSignatureError
@@ -8,7 +8,7 @@ import os
 
 from .database import SessionDep
 from .models.user import User
-from .utils.hashing import verify_password
+from .utils.hashing import verify_and_update
 
 from dotenv import load_dotenv
 
@@ -20,21 +20,26 @@ JWT_ALGORITHM = os.getenv("JWT_ALGORITHM")
 oauth2_scheme = OAuth2PasswordBearer(tokenUrl="/auth/token")
 
 async def authenticate_user(db: SessionDep, username: str, password: str) -> User:
-    user = db.get(User, username)
+    user = await db.get(User, username)
     if not user:
         raise HTTPException(
             status_code=status.HTTP_401_UNAUTHORIZED,
             detail="User not found"
         )
-    if not verify_password(password, user.password):
+    valid, new_hash = await verify_and_update(password, user.password)
+    if not valid:
         raise HTTPException(
             status_code=status.HTTP_401_UNAUTHORIZED,
             detail="Incorrect password"
         )
+    if new_hash:
+        # Stored with outdated bcrypt parameters; saved by the caller's commit
+        user.password = new_hash
     return user
 
 async def get_current_user(
     token: Annotated[str, Depends(oauth2_scheme)],
+    request: Request,
     db: SessionDep
 ) -> User:
     credentials_exception = HTTPException(
@@ -60,14 +65,15 @@ async def get_current_user(
     except (JWTError, ValueError):
         raise credentials_exception
     
-    user = db.get(User, username)
-    if user is None or user.refresh_token is None:
+    user = await request.app.state.principals.get(db, username)
+    if user is None:
         raise credentials_exception
         
     return user
 
 async def get_current_admin(
     token: Annotated[str, Depends(oauth2_scheme)],
+    request: Request,
     db: SessionDep
 ) -> User:
     credentials_exception = HTTPException(
@@ -98,8 +104,8 @@ async def get_current_admin(
     except (JWTError, ValueError):
         raise credentials_exception
     
-    user = db.get(User, username)
-    if user is None or user.refresh_token is None:
+    user = await request.app.state.principals.get(db, username)
+    if user is None:
         raise credentials_exception
     
     if not user.is_admin:
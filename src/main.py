@@ -1,13 +1,18 @@
 from contextlib import asynccontextmanager
-from fastapi import FastAPI, WebSocket, WebSocketDisconnect
+from fastapi import FastAPI, WebSocket
 from fastapi.middleware.cors import CORSMiddleware
 import logging
 
 from .services.api_client import APIClient
 from .services.redis_client import RedisClient
 from .services.scheduler import SchedulerService
+from .services.ledger import LedgerWriter
+from .services.polling_coordinator import PollingCoordinator
+from .services.principal_cache import PrincipalCache
+from .services.stake_reservation import BET_RESERVATION_MODE, StakeReservation
 from .services.websocket_handler import WebSocketManager
-from .database import create_db_and_tables
+from .database import create_db_and_tables, engine
+from .utils.hashing import hashing_stats
 from .routers import users, auth, bet
 
 logging.basicConfig(level=logging.INFO)
@@ -17,19 +22,34 @@ logger = logging.getLogger("main")
 async def lifespan(app: FastAPI):
     logger.info("Starting application...")
     app.state.redis_client = RedisClient()
-    app.state.scheduler = SchedulerService(app)
-    app.state.scheduler.add_event_job()
+    app.state.redis_client.start_invalidation_listener()
+    app.state.principals = PrincipalCache(app.state.redis_client)
+    app.state.api_client = APIClient()
+    app.state.scheduler = SchedulerService(app, app.state.api_client)
+    app.state.polling = PollingCoordinator(app.state.redis_client, app.state.scheduler)
+    app.state.ledger = LedgerWriter()
+    app.state.ledger.start()
+    app.state.reservation = StakeReservation(app.state.redis_client) if BET_RESERVATION_MODE else None
     app.state.ws_manager = WebSocketManager(
         redis_client=app.state.redis_client,
-        scheduler_service=app.state.scheduler,
-        api_client_cls=APIClient
+        polling=app.state.polling,
+        api_client=app.state.api_client
     )
-    create_db_and_tables()
+    await create_db_and_tables()
+    if app.state.reservation:
+        await app.state.reservation.start()
+    await app.state.polling.start()
 
     yield
     logger.info("Shutting down application...")
-    await app.state.redis_client.close()
+    await app.state.polling.stop()
     app.state.scheduler.stop()
+    if app.state.reservation:
+        await app.state.reservation.stop()
+    await app.state.ledger.stop()
+    await app.state.redis_client.close()
+    await app.state.api_client.close()
+    await engine.dispose()
     logger.info("Shutdown complete")
 
 app = FastAPI(lifespan=lifespan)
@@ -51,12 +71,26 @@ app.include_router(bet.router)
 async def root():
     return {"message": "Betfair Real-time Data Service"}
 
+@app.get("/stats")
+async def stats():
+    return {
+        "polling": app.state.scheduler.stats(),
+        "polling_budget": app.state.scheduler.policy.stats(),
+        "market_polling": app.state.scheduler.market_stats(),
+        "leader": app.state.polling.stats(),
+        "upstream": app.state.api_client.stats(),
+        "websocket": app.state.ws_manager.stats(),
+        "single_flight": app.state.ws_manager.single_flight.stats(),
+        "l1_cache": app.state.redis_client.cache_stats(),
+        "principals": app.state.principals.stats(),
+        "hashing": hashing_stats(),
+        "ledger": app.state.ledger.stats(),
+        "reservation": app.state.reservation.stats() if app.state.reservation else None,
+    }
+
 @app.websocket("/ws")
 async def websocket_endpoint(websocket: WebSocket):
     ws_manager: WebSocketManager = app.state.ws_manager
     await ws_manager.connect(websocket)
-    try:
-        await ws_manager.listen(websocket)
-    except WebSocketDisconnect:
-        await ws_manager.disconnect_all(websocket)
-        logger.info("WebSocket client disconnected")
\ No newline at end of file
+    # Releases the socket's subscriptions, queue and polling interest however it ends
+    await ws_manager.listen(websocket)
\ No newline at end of file
@@ -1,4 +1,5 @@
 from typing import TYPE_CHECKING, List, Optional
+from sqlalchemy import Index
 from sqlmodel import Relationship, SQLModel, Field
 from datetime import datetime
 
@@ -7,16 +8,20 @@ if TYPE_CHECKING:
 
 class Event(SQLModel, table=True):
     id: Optional[int] = Field(default=None, primary_key=True)
-    event_id: str
+    event_id: str = Field(unique=True, index=True)
     event_name: str
-    start_time: datetime
+    start_time: datetime = Field(index=True)
 
     markets: Optional[List["Market"]] = Relationship(back_populates="event")
 
 class Market(SQLModel, table=True):
+    __table_args__ = (
+        Index("ix_market_event_id_market_id", "event_id", "market_id"),
+    )
+
     id: Optional[int] = Field(default=None, primary_key=True)
     event_id: str = Field(foreign_key="event.event_id")
-    market_id: str = Field(index=True)
+    market_id: str = Field(unique=True, index=True)
     market_name: str
     status: str
 
@@ -32,6 +37,14 @@ class Runner(SQLModel, table=True):
     market: Optional["Market"] = Relationship(back_populates="runners")
 
 class Bet(SQLModel, table=True):
+    __table_args__ = (
+        # History pages and settlement filter on these, newest first
+        Index("ix_bet_username_placed_at", "username", "placed_at"),
+        Index("ix_bet_market_id_status", "market_id", "status"),
+        # Pages of a market's bets, in the (placed_at, id) keyset order
+        Index("ix_bet_market_id_placed_at", "market_id", "placed_at", "id"),
+    )
+
     id: Optional[int] = Field(default=None, primary_key=True)
     username: str = Field(foreign_key="user.username")
     market_id: str = Field(foreign_key="market.market_id")
@@ -43,6 +56,8 @@ class Bet(SQLModel, table=True):
     status: str = "OPEN"
     placed_at: datetime = Field(default_factory=datetime.now)
     settled_at: datetime = Field(default=None, nullable=True)
+    # Shared by the bets of one placement and the ledger entry for their stake
+    reference: Optional[str] = Field(default=None, nullable=True, index=True)
     
     user: Optional["User"] = Relationship(back_populates="bets")
     market: Optional["Market"] = Relationship(back_populates="bets")
\ No newline at end of file
@@ -1,4 +1,7 @@
 from typing import TYPE_CHECKING, Optional, List
+from datetime import datetime
+from enum import Enum
+from sqlalchemy import Index, text
 from sqlmodel import Field, SQLModel, Relationship
 
 if TYPE_CHECKING:
@@ -8,7 +11,6 @@ if TYPE_CHECKING:
 class User(SQLModel, table=True):
     username: str = Field(primary_key=True, index=True)
     password: str = Field(nullable=False)
-    balance: float
     is_active: bool = Field(default=True)
     is_admin: bool = Field(default=False)
     refresh_token: Optional[str] = Field(default=None, nullable=True)
@@ -22,11 +24,39 @@ class User(SQLModel, table=True):
         return f"User: {self.username}, Admin: {self.is_admin}, Active: {self.is_active}"
     
 
+class TransactionType(str, Enum):
+    DEPOSIT = "DEPOSIT"
+    WITHDRAWAL = "WITHDRAWAL"
+    BET_STAKE = "BET_STAKE"
+    BET_REFUND = "BET_REFUND"
+    BET_PAYOUT = "BET_PAYOUT"
+
+
 class Transaction(SQLModel, table=True):
+    """
+    Append-only ledger entry; a user's balance is their latest
+    BalanceSnapshot plus the amounts of all later entries.
+    """
+    __table_args__ = (
+        Index("ix_transaction_username_id", "username", "id"),
+        # One stake debit per placement, so replaying a reserved bet cannot charge twice
+        Index(
+            "ux_transaction_stake_reference", "reference", unique=True,
+            sqlite_where=text("type = 'BET_STAKE'"),
+            postgresql_where=text("type = 'BET_STAKE'"),
+        ),
+    )
+
     id: Optional[int] = Field(default=None, primary_key=True)
     username: str = Field(foreign_key="user.username")
-    amount: int
+    amount: float
     type: str
-    final_balance: str
+    reference: Optional[str] = Field(default=None, nullable=True)
+    created_at: datetime = Field(default_factory=datetime.now)
+
 
-    created_at: str
\ No newline at end of file
+class BalanceSnapshot(SQLModel, table=True):
+    username: str = Field(foreign_key="user.username", primary_key=True)
+    balance: float = 0
+    last_transaction_id: int = 0
+    created_at: datetime = Field(default_factory=datetime.now)
\ No newline at end of file
@@ -10,6 +10,7 @@ from ..database import SessionDep
 from ..dependencies import create_access_token, create_refresh_token, authenticate_user, get_current_admin, get_current_user
 from ..utils.hashing import get_password_hash
 from ..models.user import User
+from ..services.ledger import get_balance
 from ..schemas.user import LoginRequest, RefreshRequest, Token, UserOut, PasswordChangeRequest
 
 from dotenv import load_dotenv
@@ -35,7 +36,7 @@ async def login(
     refresh_token = create_refresh_token(user.username)
     
     user.refresh_token = refresh_token
-    db.commit()
+    await db.commit()
     
     return {
         "access_token": access_token,
@@ -46,6 +47,7 @@ async def login(
 @router.post("/refresh", response_model=Token)
 async def refresh_tokens(
     request: RefreshRequest,
+    http_request: Request,
     db: SessionDep
 ):
     try:
@@ -62,7 +64,7 @@ async def refresh_tokens(
         )
 
     # Get user from database
-    user = db.get(User, username)
+    user = await db.get(User, username)
     if not user or user.refresh_token != request.refresh_token:
         raise HTTPException(
             status_code=status.HTTP_401_UNAUTHORIZED,
@@ -82,8 +84,9 @@ async def refresh_tokens(
 
     # Update refresh token in database
     user.refresh_token = new_refresh_token
-    db.commit()
-    db.refresh(user)
+    await db.commit()
+    await db.refresh(user)
+    await http_request.app.state.principals.invalidate(user.username)
     return {
         "access_token": new_access_token,
         "refresh_token": new_refresh_token,
@@ -91,12 +94,12 @@ async def refresh_tokens(
     }
 
 @router.post("/password_reset", response_model=UserOut)
-async def change_password(db: SessionDep, user: Annotated[User, Depends(get_current_user)], request: PasswordChangeRequest):
-    db_user = db.get(User, user.username)
-    db_user.password = get_password_hash(request.password)
-    db.add(user)
-    db.commit()
-    return user
+async def change_password(db: SessionDep, user: Annotated[User, Depends(get_current_user)], request: PasswordChangeRequest, http_request: Request):
+    db_user = await db.get(User, user.username)
+    db_user.password = await get_password_hash(request.password)
+    await db.commit()
+    await http_request.app.state.principals.invalidate(user.username)
+    return UserOut(username=user.username, balance=await get_balance(db, user.username))
 
 @router.get("/test_user")
 async def test_user(user: Annotated[User, Depends(get_current_user)]):
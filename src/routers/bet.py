@@ -1,15 +1,17 @@
 # endpoints/betting.py
-from typing import List
-from fastapi import APIRouter, Depends, HTTPException, Request
+from typing import Annotated, List, Optional
+from fastapi import APIRouter, Depends, HTTPException, Query, Request, Response
 from sqlmodel import select
 from sqlalchemy.orm import selectinload
 from ..models.bet import Bet, Event, Market
 from ..models.user import User
-from ..schemas.bet import BetCreate, BetHistory, BetResponse, BetSettle, EventResponse, MarketResponse
-from ..schemas.user import UserOut
+from ..schemas.bet import BetCreate, BetHistory, BetResponse, BetSettle, BetSlip, EventResponse, MarketResponse
+from ..schemas.user import Statement, UserOut
 from ..dependencies import get_current_admin, get_current_user
 from ..database import SessionDep
-from ..services.betting_engine import place_bet_logic, settle_bets_logic, process_cashout_logic, ensure_event, ensure_market
+from ..services.betting_engine import place_bet_logic, place_bets_logic, settle_bets_logic, process_cashout_logic
+from ..services.ledger import get_balance, get_statement
+from ..utils.pagination import page, paginate
 
 import logging
 
@@ -27,20 +29,43 @@ async def place_bet(
 ):
     try:
         redis_client = request.app.state.redis_client
-        await ensure_event(db, redis_client, event_id)
-        await ensure_market(db, redis_client, event_id, payload.market_id)
-        return place_bet_logic(db, user.username, payload)
+        ledger = request.app.state.ledger
+        reservation = request.app.state.reservation
+        return await place_bet_logic(db, redis_client, ledger, user.username, event_id, payload, reservation)
+    except HTTPException:
+        raise
     except Exception as e:
         import traceback
         traceback.print_exc()
         raise HTTPException(status_code=500, detail=str(e))
 
+@router.post("/place_bets", response_model=List[BetResponse])
+async def place_bets(
+    payload: BetSlip,
+    request: Request,
+    db: SessionDep,
+    user: User = Depends(get_current_user)
+):
+    try:
+        redis_client = request.app.state.redis_client
+        ledger = request.app.state.ledger
+        reservation = request.app.state.reservation
+        return await place_bets_logic(db, redis_client, ledger, user.username, payload.bets, reservation)
+    except HTTPException:
+        raise
+    except Exception as e:
+        logging.exception("Error placing bet slip")
+        raise HTTPException(status_code=500, detail=str(e))
+
 @router.post("/settle_bet")
 async def settle_bet(
     payload: BetSettle,
-    db: SessionDep
+    request: Request,
+    db: SessionDep,
+    admin: User = Depends(get_current_admin)
 ):
-    return settle_bets_logic(payload, db)
+    reservation = request.app.state.reservation
+    return await settle_bets_logic(db, payload.market_id, payload.selection, reservation)
 
 
 # @router.post("/cashout")
@@ -52,50 +77,79 @@ async def settle_bet(
 #     return await process_cashout(user, payload, db)
 
 
+PageLimit = Annotated[int, Query(ge=1, le=200)]
+
+BET_ORDER = (Bet.placed_at, Bet.id)
+EVENT_ORDER = (Event.start_time, Event.id)
+MARKET_ORDER = (Market.market_id,)
+
 @router.get("/history", response_model=list[BetHistory])
 async def get_bet_history(
     db: SessionDep,
-    user: User = Depends(get_current_user)
+    response: Response,
+    user: User = Depends(get_current_user),
+    limit: PageLimit = 50,
+    cursor: Optional[str] = None
 ):
-    result = db.exec(select(Bet).where(Bet.username == user.username).order_by(Bet.placed_at.desc())).all()
-    return [BetHistory.model_validate(b.model_dump()) for b in result]
+    stmt = paginate(select(Bet).where(Bet.username == user.username), BET_ORDER, cursor, limit)
+    return page((await db.exec(stmt)).all(), BET_ORDER, limit, response)
 
 
 @router.get("/balance", response_model=UserOut)
 async def get_user_balance(
+    db: SessionDep,
     user: User = Depends(get_current_user)
 ):
     return UserOut(
         username=user.username,
-        balance=user.balance,
+        balance=await get_balance(db, user.username),
         )
 
+@router.get("/statement", response_model=Statement)
+async def get_user_statement(
+    db: SessionDep,
+    user: User = Depends(get_current_user),
+    limit: Annotated[int, Query(ge=1, le=100)] = 50,
+    before: Optional[int] = None
+):
+    return Statement(
+        username=user.username,
+        balance=await get_balance(db, user.username),
+        transactions=await get_statement(db, user.username, limit, before),
+    )
+
 @router.get("/events", response_model=List[EventResponse])
 async def get_events(
     db: SessionDep,
+    response: Response,
+    limit: PageLimit = 50,
+    cursor: Optional[str] = None
     # admin: User = Depends(get_current_admin)
 ):
-    stmt = select(Event).order_by(Event.start_time.desc())
-    result = db.exec(stmt).all()
-    return [EventResponse.model_validate(b.model_dump()) for b in result]
-    
+    stmt = paginate(select(Event), EVENT_ORDER, cursor, limit)
+    return page((await db.exec(stmt)).all(), EVENT_ORDER, limit, response)
+
 
 @router.get("/markets/{event_id}", response_model=List[MarketResponse])
 async def get_markets(
     event_id: str,
     db: SessionDep,
+    response: Response,
+    limit: PageLimit = 50,
+    cursor: Optional[str] = None
     # admin: User = Depends(get_current_admin)
 ):
-    stmt = select(Market).where(Market.event_id == event_id).order_by(Market.market_id.desc())
-    result = db.exec(stmt).all()
-    return [MarketResponse.model_validate(b.model_dump()) for b in result]
+    stmt = paginate(select(Market).where(Market.event_id == event_id), MARKET_ORDER, cursor, limit)
+    return page((await db.exec(stmt)).all(), MARKET_ORDER, limit, response)
 
 @router.get("/bets/{market_id}", response_model=List[BetResponse])
 async def get_bets(
     market_id: str,
     db: SessionDep,
+    response: Response,
+    limit: PageLimit = 50,
+    cursor: Optional[str] = None
     # admin: User = Depends(get_current_admin)
 ):
-    stmt = select(Bet).where(Bet.market_id == market_id).order_by(Bet.placed_at.desc())
-    result = db.exec(stmt).all()
-    return [BetResponse.model_validate(b.model_dump()) for b in result]
\ No newline at end of file
+    stmt = paginate(select(Bet).where(Bet.market_id == market_id), BET_ORDER, cursor, limit)
+    return page((await db.exec(stmt)).all(), BET_ORDER, limit, response)
\ No newline at end of file
@@ -1,10 +1,13 @@
 from typing import Annotated
-from fastapi import APIRouter, Depends, HTTPException, Query, status
+from fastapi import APIRouter, Depends, HTTPException, Query, Request, status
+from sqlalchemy import delete
 from sqlmodel import select
-from ..models.user import User
+from ..models.bet import Bet
+from ..models.user import BalanceSnapshot, Transaction, TransactionType, User
 from ..schemas.user import UserCreate, UserOut
 from ..database import SessionDep
 from ..dependencies import get_current_admin
+from ..services.ledger import InsufficientFundsError, get_balance, get_balances
 from ..utils.hashing import get_password_hash
 import logging
 
@@ -18,51 +21,77 @@ router = APIRouter(
 
 @router.get("/", response_model=list[UserOut])
 async def get_users(session: SessionDep, offset: int = 0, limit: Annotated[int, Query(le=100)] = 100) -> list[UserOut]:
-    users = session.exec(select(User).offset(offset).limit(limit)).all()
-    return users
+    users = (await session.exec(select(User).offset(offset).limit(limit))).all()
+    balances = await get_balances(session, [user.username for user in users])
+    return [UserOut(username=user.username, balance=balances.get(user.username, 0.0)) for user in users]
 
 @router.get("/{username}", response_model=UserOut)
 async def get_user(username: str, session: SessionDep) -> UserOut:
-    user = session.get(User, username)
+    user = await session.get(User, username)
     if not user:
         raise HTTPException(status_code=404, detail="User not found")
-    return user
+    return UserOut(username=user.username, balance=await get_balance(session, username))
 
 @router.post("/", response_model=UserOut)
 async def create_user(user: UserCreate, session: SessionDep) -> UserOut:
-    db_user = session.get(User, user.username)
+    db_user = await session.get(User, user.username)
     if db_user:
         raise HTTPException(status_code=400, detail="Username already registered")
-    user = User.model_validate(user)
-    user.password = get_password_hash(user.password)
-    session.add(user)
-    session.commit()
-    session.refresh(user)
-    return user
+    db_user = User.model_validate(user)
+    db_user.password = await get_password_hash(user.password)
+    session.add(db_user)
+    if user.balance:
+        # Opening balance is the first ledger entry, committed with the user
+        session.add(Transaction(username=user.username, amount=user.balance, type=TransactionType.DEPOSIT.value))
+    await session.commit()
+    return UserOut(username=db_user.username, balance=user.balance)
 
 @router.patch("/{username}", response_model=UserOut)
-async def update_balance(username: str, amount: float, session: SessionDep) -> UserOut:
-    db_user = session.get(User, username)
-    curr_balance = db_user.balance
+async def update_balance(username: str, amount: float, request: Request, session: SessionDep) -> UserOut:
+    db_user = await session.get(User, username)
     if not db_user:
         raise HTTPException(status_code=404, detail="User not found")
-    
-    if amount < 0 and curr_balance < (amount * -1):
+
+    ledger = request.app.state.ledger
+    reservation = request.app.state.reservation
+    try:
+        if amount < 0 and reservation is not None:
+            # Mirrored balances already hold reserved stakes, so check funds there
+            await reservation.adjust(session, username, amount, require_funds=True)
+            try:
+                await ledger.append(username, amount, TransactionType.WITHDRAWAL)
+            except Exception:
+                await reservation.adjust(session, username, -amount)
+                raise
+        elif amount < 0:
+            await ledger.append(username, amount, TransactionType.WITHDRAWAL, require_funds=True)
+        else:
+            await ledger.append(username, amount, TransactionType.DEPOSIT)
+            if reservation is not None:
+                await reservation.adjust(session, username, amount)
+    except InsufficientFundsError:
         raise HTTPException(
             status_code=status.HTTP_401_UNAUTHORIZED,
             detail="can't withdraw more than current balance"
         )
-        
-    db_user.balance += amount
-    session.commit()
-    session.refresh(db_user)
-    return db_user
+
+    return UserOut(username=username, balance=await get_balance(session, username))
 
 @router.delete("/{username}", response_model=UserOut)
-def delete_user(username: str, session: SessionDep) -> UserOut:
-    user = session.get(User, username)
+async def delete_user(username: str, request: Request, session: SessionDep) -> UserOut:
+    user = await session.get(User, username)
     if not user:
         raise HTTPException(status_code=404, detail="User not found")
-    session.delete(user)
-    session.commit()
-    return user
\ No newline at end of file
+    # Bets keep their bettor for settlement and history
+    if (await session.exec(select(Bet.id).where(Bet.username == username).limit(1))).first() is not None:
+        raise HTTPException(status_code=409, detail="User has bets and cannot be deleted")
+    balance = await get_balance(session, username)
+    # The ledger goes with the user, so a new user of the same name starts from zero
+    await session.execute(delete(BalanceSnapshot).where(BalanceSnapshot.username == username))
+    await session.execute(delete(Transaction).where(Transaction.username == username))
+    await session.delete(user)
+    await session.commit()
+    await request.app.state.principals.invalidate(username)
+    if request.app.state.reservation is not None:
+        await request.app.state.reservation.forget(username)
+    return UserOut(username=username, balance=balance)
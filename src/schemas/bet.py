@@ -1,5 +1,5 @@
 from typing import List, Optional
-from pydantic import BaseModel
+from pydantic import BaseModel, Field
 from datetime import datetime
 
 from src.models.bet import Bet
@@ -9,10 +9,18 @@ class BetCreate(BaseModel):
     market_name: str
     selection: str
     odds: float
-    stake: float
+    stake: float = Field(gt=0)
+
+class BetSlipItem(BetCreate):
+    event_id: str
+
+class BetSlip(BaseModel):
+    bets: List[BetSlipItem] = Field(min_length=1, max_length=50)
 
 class BetResponse(BaseModel):
-    id: int
+    # Bets accepted by stake reservation are PENDING and get an id once persisted
+    id: Optional[int] = None
+    reference: Optional[str] = None
     username: str
     market_id: str
     selection: str
@@ -33,6 +41,9 @@ class BetHistory(BaseModel):
     placed_at: datetime
     settled_at: Optional[datetime] = None
 
+    class Config:
+        from_attributes = True
+
 class BetSettle(BaseModel):
     market_id: str
     selection: str
@@ -1,4 +1,6 @@
+from typing import List, Optional
 from pydantic import BaseModel
+from datetime import datetime
 
 class UserBase(BaseModel):
     username: str
@@ -12,6 +14,21 @@ class UserOut(UserBase):
     class Config:
         from_attributes = True
 
+class TransactionOut(BaseModel):
+    id: int
+    amount: float
+    type: str
+    reference: Optional[str] = None
+    created_at: datetime
+
+    class Config:
+        from_attributes = True
+
+class Statement(BaseModel):
+    username: str
+    balance: float
+    transactions: List[TransactionOut]
+
 class Token(BaseModel):
     access_token: str
     token_type: str
@@ -1,8 +1,14 @@
+import asyncio
 import os
+import random
+import time
 import httpx
 import logging
+from email.utils import parsedate_to_datetime
+from importlib.util import find_spec
 from dotenv import load_dotenv
 
+from ..utils.encoding import loads
 from ..utils.processer import process_event_data, process_market_data
 
 logging.basicConfig(level=logging.INFO)
@@ -12,42 +18,293 @@ load_dotenv()
 BASE_URL = os.getenv("BASE_URL")
 X_RAPIDAPI_KEY = os.getenv("X_RAPIDAPI_KEY")
 
+API_TIMEOUT = float(os.getenv("API_TIMEOUT", 10))
+API_MAX_CONNECTIONS = int(os.getenv("API_MAX_CONNECTIONS", 100))
+API_MAX_KEEPALIVE_CONNECTIONS = int(os.getenv("API_MAX_KEEPALIVE_CONNECTIONS", 20))
+API_KEEPALIVE_EXPIRY = float(os.getenv("API_KEEPALIVE_EXPIRY", 60))
+API_HTTP2 = os.getenv("API_HTTP2", "false").lower() == "true"
+
+# Shared by every poll; size these to the RapidAPI plan. A rate of 0 disables limiting.
+API_RATE_LIMIT = float(os.getenv("API_RATE_LIMIT", 5))
+API_RATE_BURST = int(os.getenv("API_RATE_BURST", 10))
+API_MAX_RETRIES = int(os.getenv("API_MAX_RETRIES", 2))
+API_BACKOFF_BASE = float(os.getenv("API_BACKOFF_BASE", 0.5))
+API_BACKOFF_MAX = float(os.getenv("API_BACKOFF_MAX", 10))
+API_BREAKER_THRESHOLD = int(os.getenv("API_BREAKER_THRESHOLD", 5))
+API_BREAKER_COOLDOWN = float(os.getenv("API_BREAKER_COOLDOWN", 30))
+# Seconds one fetch may spend across all its attempts and backoff; keep it below MARKET_POLL_TIMEOUT
+API_FETCH_DEADLINE = float(os.getenv("API_FETCH_DEADLINE", 12))
+
+RETRY_STATUSES = {429, 500, 502, 503, 504}
+
+class CircuitOpenError(Exception):
+    pass
+
+class TokenBucket:
+    """
+    Allows rate requests per second on average, in bursts of up to burst.
+    Waiters are served in order; pause holds everyone back, e.g. for Retry-After.
+    """
+
+    def __init__(self, rate: float, burst: int):
+        self.rate = rate
+        self.capacity = max(burst, 1)
+        self.tokens = float(self.capacity)
+        self.updated = time.monotonic()
+        self.paused_until = 0.0
+        self.lock = asyncio.Lock()
+
+    async def acquire(self) -> bool:
+        """
+        Take a token, waiting for one if needed. Returns whether it had to wait.
+        """
+        if self.rate <= 0:
+            return False
+        waited = False
+        async with self.lock:
+            while True:
+                now = time.monotonic()
+                if now < self.paused_until:
+                    waited = True
+                    await asyncio.sleep(self.paused_until - now)
+                    continue
+                self.tokens = min(self.capacity, self.tokens + (now - self.updated) * self.rate)
+                self.updated = now
+                if self.tokens >= 1:
+                    self.tokens -= 1
+                    return waited
+                waited = True
+                await asyncio.sleep((1 - self.tokens) / self.rate)
+
+    def pause(self, seconds: float):
+        self.paused_until = max(self.paused_until, time.monotonic() + seconds)
+
+class CircuitBreaker:
+    """
+    Opens after threshold consecutive failures and rejects calls for cooldown
+    seconds, then lets a single trial call through: its success closes the
+    breaker, its failure opens it again.
+    """
+
+    def __init__(self, threshold: int, cooldown: float):
+        self.threshold = threshold
+        self.cooldown = cooldown
+        self.failures = 0
+        self.opened_at: float | None = None
+        # Start of the trial call let through while half open
+        self.trial_at: float | None = None
+        self.trips = 0
+
+    @property
+    def state(self) -> str:
+        if self.opened_at is None:
+            return "closed"
+        if time.monotonic() - self.opened_at < self.cooldown:
+            return "open"
+        return "half_open"
+
+    def allow(self) -> bool:
+        state = self.state
+        if state == "closed":
+            return True
+        # A trial that never reported back (e.g. cancelled) is replaced after a cooldown
+        now = time.monotonic()
+        if state == "half_open" and (self.trial_at is None or now - self.trial_at >= self.cooldown):
+            self.trial_at = now
+            return True
+        return False
+
+    def record_success(self):
+        self.failures = 0
+        self.opened_at = None
+        self.trial_at = None
+
+    def record_failure(self):
+        self.failures += 1
+        if self.opened_at is not None or self.failures >= self.threshold:
+            if self.state != "open":
+                self.trips += 1
+            self.opened_at = time.monotonic()
+        self.trial_at = None
+
 class APIClient:
     """
     A reusable HTTP client for Betfair API using httpx.AsyncClient.
+
+    One instance is created per application and shared, so connections to the
+    upstream are pooled and kept alive across polls instead of reconnecting.
+    All requests share one token bucket; each endpoint retries transient
+    failures with jittered exponential backoff and has its own circuit breaker.
     """
 
-    def __init__(self):
+    def __init__(
+        self,
+        max_connections: int = API_MAX_CONNECTIONS,
+        max_keepalive_connections: int = API_MAX_KEEPALIVE_CONNECTIONS,
+        keepalive_expiry: float = API_KEEPALIVE_EXPIRY,
+        http2: bool = API_HTTP2,
+        rate_limit: float = API_RATE_LIMIT,
+        rate_burst: int = API_RATE_BURST,
+        max_retries: int = API_MAX_RETRIES,
+        fetch_deadline: float = API_FETCH_DEADLINE,
+    ):
         self.base_url = BASE_URL
         self.headers = {
             "x-rapidapi-key": X_RAPIDAPI_KEY,
             "x-rapidapi-host": "betfair-sports-casino-live-tv-result-odds.p.rapidapi.com",
         }
-        self.timeout = 10
-        self.client = httpx.AsyncClient(base_url=self.base_url, headers=self.headers, timeout=self.timeout)
+        self.timeout = API_TIMEOUT
+        self.limits = httpx.Limits(
+            max_connections=max_connections,
+            max_keepalive_connections=max_keepalive_connections,
+            keepalive_expiry=keepalive_expiry,
+        )
+        if http2 and find_spec("h2") is None:
+            logging.warning("HTTP/2 requested but the h2 package is not installed, using HTTP/1.1")
+            http2 = False
+        self.client = httpx.AsyncClient(
+            base_url=self.base_url,
+            headers=self.headers,
+            timeout=self.timeout,
+            limits=self.limits,
+            http2=http2,
+        )
+        self.latency: dict[str, dict] = {}
+        self.bucket = TokenBucket(rate_limit, rate_burst)
+        self.max_retries = max_retries
+        self.fetch_deadline = fetch_deadline
+        self.breakers: dict[str, CircuitBreaker] = {}
+        self.retries: dict[str, int] = {}
+        self.throttled: dict[str, int] = {}
 
     async def fetch_events(self) -> httpx.Response | None:
         try:
-            response = await self.client.get("/v3/front", params={"id": "4"})
-            response.raise_for_status()
-            logging.info(f"Fetched events successfully: {response.status_code}")
-            logging.info(response.json())
-            return process_event_data(response.json())
+            response = await self._fetch("events", "/v3/front", params={"id": "4"})
+            logging.info(f"Fetched events successfully: {response.status_code}, {len(response.content)} bytes")
+            return process_event_data(loads(response.content))
         except Exception as e:
             logging.error(f"Error fetching events: {e}")
             return None
 
     async def fetch_markets(self, event_id: str) -> httpx.Response | None:
         try:
-            response = await self.client.get("/GetSession/", params={"eventid": event_id})
-            response.raise_for_status()
-            logging.info(f"Fetched markets successfully: {response.status_code}")
-            logging.info(response.json())
-            return process_market_data(response.json())
+            response = await self._fetch("markets", "/GetSession/", params={"eventid": event_id})
+            logging.info(f"Fetched markets successfully: {response.status_code}, {len(response.content)} bytes")
+            return process_market_data(loads(response.content))
         except Exception as e:
             logging.error(f"Error fetching markets: {e}")
             return None
 
+    def max_fetch_time(self) -> float:
+        """
+        Longest a fetch can take talking to the upstream, waits for the rate limiter aside.
+        """
+        backoff = sum(min(API_BACKOFF_MAX, API_BACKOFF_BASE * 2 ** attempt) for attempt in range(self.max_retries))
+        return min(self.fetch_deadline, (self.max_retries + 1) * self.timeout + backoff)
+
+    async def _fetch(self, endpoint: str, url: str, params: dict) -> httpx.Response:
+        """
+        GET url through the rate limiter, retrying timeouts, connection errors,
+        429 and 5xx responses. Raises CircuitOpenError without calling the
+        upstream while the endpoint's breaker is open.
+
+        All attempts share fetch_deadline: a failing fetch gives up, and counts
+        as a breaker failure, before a caller's own timeout can cancel it.
+        """
+        breaker = self.breakers.setdefault(endpoint, CircuitBreaker(API_BREAKER_THRESHOLD, API_BREAKER_COOLDOWN))
+        if not breaker.allow():
+            raise CircuitOpenError(f"Circuit open for {endpoint}")
+
+        loop = asyncio.get_running_loop()
+        deadline = loop.time() + self.fetch_deadline
+        error = None
+        for attempt in range(self.max_retries + 1):
+            if await self.bucket.acquire():
+                self.throttled[endpoint] = self.throttled.get(endpoint, 0) + 1
+            remaining = deadline - loop.time()
+            if remaining <= 0:
+                if error is None:
+                    # Spent waiting for the rate limiter; the upstream is not at fault
+                    breaker.trial_at = None
+                    raise TimeoutError(f"Rate limited past the deadline for {endpoint}")
+                break
+            retry_after = None
+            try:
+                response = await asyncio.wait_for(self._get(endpoint, url, params), remaining)
+                if response.status_code in RETRY_STATUSES:
+                    retry_after = self._retry_after(response)
+                    if response.status_code == 429 and retry_after:
+                        self.bucket.pause(retry_after)
+                response.raise_for_status()
+                breaker.record_success()
+                return response
+            except httpx.HTTPStatusError as e:
+                if e.response.status_code not in RETRY_STATUSES:
+                    # The upstream is up and answered; the request itself is at fault
+                    breaker.record_success()
+                    raise
+                error = e
+            except (httpx.TransportError, asyncio.TimeoutError) as e:
+                error = e
+
+            if attempt == self.max_retries:
+                break
+            delay = max(random.uniform(0, min(API_BACKOFF_MAX, API_BACKOFF_BASE * 2 ** attempt)), retry_after or 0)
+            if delay > API_BACKOFF_MAX or loop.time() + delay >= deadline:
+                break  # Asked to wait longer than a poll should, or out of time; the next poll tries again
+            self.retries[endpoint] = self.retries.get(endpoint, 0) + 1
+            await asyncio.sleep(delay)
+
+        breaker.record_failure()
+        raise error
+
+    @staticmethod
+    def _retry_after(response: httpx.Response) -> float | None:
+        value = response.headers.get("Retry-After")
+        if not value:
+            return None
+        try:
+            return max(float(value), 0.0)
+        except ValueError:
+            pass
+        try:
+            return max(parsedate_to_datetime(value).timestamp() - time.time(), 0.0)
+        except (TypeError, ValueError):
+            return None
+
+    async def _get(self, endpoint: str, url: str, params: dict) -> httpx.Response:
+        started = time.perf_counter()
+        failed = True
+        try:
+            response = await self.client.get(url, params=params)
+            failed = response.is_error
+            return response
+        finally:
+            self._record_latency(endpoint, time.perf_counter() - started, failed)
+
+    def _record_latency(self, endpoint: str, elapsed: float, failed: bool):
+        stats = self.latency.setdefault(
+            endpoint, {"calls": 0, "errors": 0, "total_ms": 0.0, "max_ms": 0.0}
+        )
+        elapsed_ms = elapsed * 1000
+        stats["calls"] += 1
+        stats["errors"] += int(failed)
+        stats["total_ms"] += elapsed_ms
+        stats["max_ms"] = max(stats["max_ms"], elapsed_ms)
+
+    def stats(self) -> dict:
+        return {
+            endpoint: {
+                **stats,
+                "avg_ms": stats["total_ms"] / stats["calls"] if stats["calls"] else 0.0,
+                "retries": self.retries.get(endpoint, 0),
+                "throttled": self.throttled.get(endpoint, 0),
+                "breaker": self.breakers[endpoint].state if endpoint in self.breakers else "closed",
+                "breaker_trips": self.breakers[endpoint].trips if endpoint in self.breakers else 0,
+            }
+            for endpoint, stats in self.latency.items()
+        }
+
     async def close(self):
         await self.client.aclose()
 
@@ -55,4 +312,4 @@ class APIClient:
         return self
 
     async def __aexit__(self, exc_type, exc, tb):
-        await self.close()
\ No newline at end of file
+        await self.close()
@@ -1,126 +1,236 @@
-from datetime import datetime
+from datetime import datetime, timezone
+from uuid import uuid4
+from sqlalchemy import case, func, insert, literal, update
 from sqlmodel import select
 from ..database import SessionDep
-from ..models.user import User
+from ..models.user import Transaction, TransactionType, User
 from ..models.bet import Bet, Event, Market, Runner
-from ..schemas.bet import BetCreate
+from ..schemas.bet import BetCreate, BetSlipItem
 from ..services.redis_client import RedisClient
+from ..services.ledger import InsufficientFundsError, LedgerWriter
+from ..services.market_index import lookup_events, lookup_markets
 from fastapi import HTTPException
 
-import logging, json
+import logging
 
 logging.basicConfig(level=logging.INFO)
 
 async def ensure_event(db: SessionDep, redis_client: RedisClient, event_id: str):
-    stmt = select(Event).where(Event.event_id == event_id)
-    result = db.exec(stmt).first()
+    await ensure_events(db, redis_client, {event_id})
 
-    if result:
-        return
-    
-    data = await redis_client.get("events")
-    events = json.loads(data)
-
-    for event in events:
-        if event["event_id"] == event_id:
-            start_time = datetime.fromisoformat(event["openDate"].replace("Z", "+00:00"))
-            new_event = Event(
-                event_id=event_id,
-                event_name=event["event_name"],
-                start_time=start_time
-                )
-            db.add(new_event)
-            db.commit()
-            db.refresh(new_event)
-        
 
 async def ensure_market(db: SessionDep, redis_client: RedisClient, event_id: str, market_id: str):
-    stmt = select(Market).where(Market.market_id == market_id)
-    result = db.exec(stmt).first()
+    await ensure_markets(db, redis_client, {event_id: {market_id}})
+
+
+async def ensure_events(db: SessionDep, redis_client: RedisClient, event_ids: set[str]):
+    """
+    Add any of event_ids not yet stored, looked up in the events index.
+    Rows are only added to the session; the caller's commit persists them.
+    """
+    stmt = select(Event.event_id).where(Event.event_id.in_(event_ids))
+    missing = set(event_ids) - set((await db.exec(stmt)).all())
 
-    if result:
+    if not missing:
         return
 
-    data = await redis_client.get(f"markets:{event_id}")
-    if not data:
-        return  # Optionally raise an error
-
-    markets = json.loads(data)
-
-    for category in ['bookMaker', 'fancy', 'SESSIONS']:
-        for m in markets.get(category, []):
-            if m.get("marketId") == market_id:
-                # Step 1: Insert Market (without runners)
-                new_market = Market(
-                    event_id=event_id,
-                    market_id=m["marketId"],
-                    market_name=m.get("marketName", ""),
-                    status=m.get("statusName", ""),
-                )
-                db.add(new_market)
-                db.commit()
-
-                # Step 2: Determine runners
-                runners = m.get("runners")
-
-                if runners and isinstance(runners, list) and len(runners) > 0:
-                    for runner in runners:
-                        selection_name = runner.get("selectionName")
-                        if selection_name:
-                            new_runner = Runner(
-                                market_id=market_id,
-                                selection_name=selection_name
-                            )
-                            db.add(new_runner)
-                else:
-                    # Add default Yes/No runners
-                    for name in ["Yes", "No"]:
+    events = await lookup_events(redis_client, missing)
+
+    for event in events.values():
+        # Stored as naive UTC; server databases reject aware values in timestamp columns
+        start_time = datetime.fromisoformat(event["openDate"].replace("Z", "+00:00"))
+        start_time = start_time.astimezone(timezone.utc).replace(tzinfo=None)
+        new_event = Event(
+            event_id=event["event_id"],
+            event_name=event["event_name"],
+            start_time=start_time
+            )
+        db.add(new_event)
+
+
+async def ensure_markets(db: SessionDep, redis_client: RedisClient, market_ids_by_event: dict[str, set[str]]):
+    """
+    Add any markets (with their runners) not yet stored, looked up in each
+    event's markets index. Rows are only added to the session; the caller's
+    commit persists them.
+    """
+    market_ids = set().union(*market_ids_by_event.values())
+    stmt = select(Market.market_id).where(Market.market_id.in_(market_ids))
+    existing = set((await db.exec(stmt)).all())
+
+    for event_id, event_market_ids in market_ids_by_event.items():
+        missing = set(event_market_ids) - existing
+        if not missing:
+            continue
+
+        markets = await lookup_markets(redis_client, event_id, missing)
+
+        for market_id, m in markets.items():
+            # Step 1: Insert Market
+            new_market = Market(
+                event_id=event_id,
+                market_id=market_id,
+                market_name=m.get("marketName", ""),
+                status=m.get("statusName", ""),
+            )
+            db.add(new_market)
+
+            # Step 2: Determine runners
+            runners = m.get("runners")
+
+            if runners and isinstance(runners, list) and len(runners) > 0:
+                for runner in runners:
+                    selection_name = runner.get("selectionName")
+                    if selection_name:
                         new_runner = Runner(
                             market_id=market_id,
-                            selection_name=name
+                            selection_name=selection_name
                         )
                         db.add(new_runner)
-
-                db.commit()
-                return new_market
-
-def place_bet_logic(db: SessionDep, username: str, bet_data: BetCreate) -> Bet:
-    user = db.get(User, username)
-    if not user or user.balance < bet_data.stake:
+            else:
+                # Add default Yes/No runners
+                for name in ["Yes", "No"]:
+                    new_runner = Runner(
+                        market_id=market_id,
+                        selection_name=name
+                    )
+                    db.add(new_runner)
+
+async def place_bet_logic(
+    db: SessionDep, redis_client: RedisClient, ledger: LedgerWriter,
+    username: str, event_id: str, bet_data: BetCreate, reservation=None
+) -> Bet:
+    bets = await place_bets_logic(
+        db, redis_client, ledger, username,
+        [BetSlipItem(event_id=event_id, **bet_data.model_dump())],
+        reservation
+    )
+    return bets[0]
+
+
+async def place_bets_logic(
+    db: SessionDep, redis_client: RedisClient, ledger: LedgerWriter,
+    username: str, bets_data: list[BetSlipItem], reservation=None
+) -> list[Bet]:
+    """
+    Place every bet of a slip in one transaction: the combined stake is debited
+    from the ledger once, in the same commit that stores the bets, so there is
+    never a debit without its bets or bets without their debit. With a
+    StakeReservation the stake is reserved in Redis instead and the bets are
+    stored asynchronously.
+    """
+    if reservation is not None:
+        try:
+            return await reservation.place_bets(db, username, bets_data)
+        except InsufficientFundsError:
+            raise HTTPException(status_code=400, detail="Insufficient balance or invalid user.")
+
+    total_stake = sum(bet_data.stake for bet_data in bets_data)
+    reference = uuid4().hex
+
+    # Events and markets are committed first, so the ledger writer never waits on this session's lock
+    market_ids_by_event: dict[str, set[str]] = {}
+    for bet_data in bets_data:
+        market_ids_by_event.setdefault(bet_data.event_id, set()).add(bet_data.market_id)
+    await ensure_events(db, redis_client, set(market_ids_by_event))
+    await ensure_markets(db, redis_client, market_ids_by_event)
+    await db.commit()
+
+    bets = [
+        Bet(username=username, reference=reference, **bet_data.model_dump(exclude={"event_id"}))
+        for bet_data in bets_data
+    ]
+    try:
+        await ledger.append(
+            username, -total_stake, TransactionType.BET_STAKE, reference, require_funds=True, rows=bets
+        )
+    except InsufficientFundsError:
         raise HTTPException(status_code=400, detail="Insufficient balance or invalid user.")
-
-    user.balance -= bet_data.stake
-    bet = Bet(username=username, **bet_data.model_dump())
-    db.add(bet)
-    db.commit()
-    db.refresh(bet)
-    return bet
-
-
-def settle_bets_logic(db: SessionDep, market_id: str, winning_selection: str):
-    stmt = select(Bet).where(Bet.market_id == market_id).where(Bet.status == 'OPEN')
-    bets = db.exec(stmt)
-    for bet in bets:
-        if bet.selection_name == winning_selection:
-            win_amount = bet.stake * bet.odds
-            user = db.query(User).filter(User.id == bet.user_id).first()
-            user.balance += win_amount
-            bet.is_won = True
-        else:
-            bet.is_won = False
-
-        bet.is_settled = True
-
-    db.commit()
-
-
-def process_cashout_logic(db: SessionDep, bet_id: int, cashout_odds: float):
-    bet = db.query(Bet).filter(Bet.id == bet_id).first()
+    return bets
+
+
+async def settle_bets_logic(db: SessionDep, market_id: str, winning_selection: str, reservation=None) -> dict:
+    """
+    Settle every open bet on a market in one transaction using set-based
+    statements: bets are marked WON/LOST with payout and settled_at in one
+    UPDATE, then each winner gets one BET_PAYOUT ledger entry from a grouped
+    INSERT ... SELECT. Mirrored balances of a StakeReservation are credited
+    after commit.
+    """
+    settled_at = datetime.now()
+    is_winner = Bet.selection == winning_selection
+
+    # Marked settled first: the row lock makes a reservation that is storing bets on this
+    # market finish before the bets are settled, and any later one sees SETTLED and is refunded
+    await db.execute(
+        update(Market)
+        .where(Market.market_id == market_id)
+        .values(status="SETTLED")
+        .execution_options(synchronize_session=False)
+    )
+
+    await db.execute(
+        update(Bet)
+        .where(Bet.market_id == market_id, Bet.status == "OPEN")
+        .values(
+            status=case((is_winner, "WON"), else_="LOST"),
+            payout=case((is_winner, Bet.stake * Bet.odds), else_=0),
+            settled_at=settled_at,
+        )
+        .execution_options(synchronize_session=False)
+    )
+
+    # Only the rows marked above carry this settled_at, so bets placed meanwhile are untouched
+    settled_now = (Bet.market_id == market_id, Bet.settled_at == settled_at)
+    payouts = (
+        select(
+            Bet.username,
+            func.sum(Bet.payout),
+            literal(TransactionType.BET_PAYOUT.value),
+            literal(market_id),
+            literal(settled_at),
+        )
+        .where(*settled_now, Bet.status == "WON")
+        .group_by(Bet.username)
+    )
+    await db.execute(
+        insert(Transaction).from_select(
+            ["username", "amount", "type", "reference", "created_at"], payouts
+        )
+    )
+
+    summary = (await db.exec(
+        select(Bet.status, func.count(), func.coalesce(func.sum(Bet.payout), 0))
+        .where(*settled_now)
+        .group_by(Bet.status)
+    )).all()
+    await db.commit()
+
+    if reservation is not None:
+        credits = (await db.exec(
+            select(Bet.username, func.sum(Bet.payout))
+            .where(*settled_now, Bet.status == "WON")
+            .group_by(Bet.username)
+        )).all()
+        await reservation.credit_many(dict(credits))
+
+    counts = {status: (count, payout) for status, count, payout in summary}
+    return {
+        "market_id": market_id,
+        "winning_selection": winning_selection,
+        "won": counts.get("WON", (0, 0))[0],
+        "lost": counts.get("LOST", (0, 0))[0],
+        "total_payout": counts.get("WON", (0, 0))[1],
+    }
+
+
+async def process_cashout_logic(db: SessionDep, bet_id: int, cashout_odds: float):
+    bet = await db.get(Bet, bet_id)
     if not bet or bet.is_settled or bet.is_cashed_out:
         raise HTTPException(status_code=400, detail="Invalid or already settled bet.")
 
     cashout_amount = bet.stake * cashout_odds
-    user = db.query(User).filter(User.id == bet.user_id).first()
+    user = (await db.exec(select(User).where(User.id == bet.user_id))).first()
     user.balance += cashout_amount
 
     bet.is_cashed_out = True
@@ -128,5 +238,5 @@ def process_cashout_logic(db: SessionDep, bet_id: int, cashout_odds: float):
     bet.is_settled = True
     bet.is_won = None
 
-    db.commit()
+    await db.commit()
     return cashout_amount
\ No newline at end of file
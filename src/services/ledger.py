@@ -0,0 +1,235 @@
+import asyncio
+import logging
+import os
+from datetime import datetime, timedelta
+from sqlalchemy import exists, func, literal, update
+from sqlalchemy.dialects import postgresql, sqlite
+from sqlmodel import select
+from dotenv import load_dotenv
+
+from ..database import new_session
+from ..models.user import BalanceSnapshot, Transaction, TransactionType, User
+
+logging.basicConfig(level=logging.INFO)
+
+load_dotenv()
+
+LEDGER_MAX_BATCH = int(os.getenv("LEDGER_MAX_BATCH", 500))
+# Only entries older than this are folded into snapshots, so a transaction that
+# is still committing with a lower id is never skipped
+LEDGER_SNAPSHOT_LAG = float(os.getenv("LEDGER_SNAPSHOT_LAG", 60))
+
+class InsufficientFundsError(Exception):
+    pass
+
+def _tail_sum():
+    return (
+        select(func.coalesce(func.sum(Transaction.amount), 0))
+        .where(
+            Transaction.username == User.username,
+            Transaction.id > func.coalesce(BalanceSnapshot.last_transaction_id, 0),
+        )
+        .scalar_subquery()
+    )
+
+async def get_balances(db, usernames) -> dict[str, float]:
+    """
+    Derive balances from each user's latest snapshot plus their ledger tail.
+    """
+    stmt = (
+        select(User.username, func.coalesce(BalanceSnapshot.balance, 0) + _tail_sum())
+        .outerjoin(BalanceSnapshot, BalanceSnapshot.username == User.username)
+        .where(User.username.in_(usernames))
+    )
+    return {username: balance for username, balance in (await db.exec(stmt)).all()}
+
+async def get_balance(db, username: str) -> float:
+    return (await get_balances(db, [username])).get(username, 0.0)
+
+async def get_statement(db, username: str, limit: int, before: int | None = None) -> list[Transaction]:
+    stmt = select(Transaction).where(Transaction.username == username)
+    if before is not None:
+        stmt = stmt.where(Transaction.id < before)
+    stmt = stmt.order_by(Transaction.id.desc()).limit(limit)
+    return list((await db.exec(stmt)).all())
+
+async def _lock_users(db, usernames):
+    """
+    Hold the users until the transaction ends, so fund checks for the same
+    user in other workers wait for this commit instead of reading the same balance.
+    """
+    if (await db.connection()).dialect.name == "sqlite":
+        # No row locks in SQLite; any write takes the database lock, held until commit
+        await db.execute(update(User).where(User.username.in_(usernames)).values(username=User.username))
+    else:
+        await db.exec(select(User.username).where(User.username.in_(usernames)).with_for_update())
+
+class _PendingEntry:
+    __slots__ = ("transaction", "require_funds", "rows", "future")
+
+    def __init__(self, transaction: Transaction, require_funds: bool, rows: list, future: asyncio.Future):
+        self.transaction = transaction
+        self.require_funds = require_funds
+        self.rows = rows
+        self.future = future
+
+class LedgerWriter:
+    """
+    Group-commit writer for ledger entries.
+
+    Callers await append(); a single task drains everything queued while the
+    previous commit was in flight and writes it in one transaction, checking
+    funds for debits against balances read once per batch. If that transaction
+    fails, its entries are retried one by one so a bad entry fails alone.
+    """
+
+    def __init__(self, session_factory=new_session, max_batch: int = LEDGER_MAX_BATCH):
+        self.session_factory = session_factory
+        self.max_batch = max_batch
+        self.queue: asyncio.Queue[_PendingEntry] = asyncio.Queue()
+        self.task: asyncio.Task | None = None
+        self.batches = 0
+        self.entries = 0
+        self.rejected = 0
+
+    def start(self):
+        if self.task is None:
+            self.task = asyncio.create_task(self._run())
+
+    async def stop(self):
+        if self.task is None:
+            return
+        while not self.queue.empty():
+            await asyncio.sleep(0.01)
+        self.task.cancel()
+        self.task = None
+
+    async def append(
+        self,
+        username: str,
+        amount: float,
+        type: TransactionType,
+        reference: str | None = None,
+        require_funds: bool = False,
+        rows: list | None = None,
+    ) -> Transaction:
+        """
+        Append an entry and wait for it to be committed. With require_funds the
+        entry is rejected with InsufficientFundsError if it would take the
+        balance below zero. rows (e.g. the bets a stake pays for) are stored in
+        the same transaction as the entry, or not at all.
+        """
+        transaction = Transaction(username=username, amount=amount, type=type.value, reference=reference)
+        future = asyncio.get_running_loop().create_future()
+        await self.queue.put(_PendingEntry(transaction, require_funds, rows or [], future))
+        return await future
+
+    async def _run(self):
+        while True:
+            batch = [await self.queue.get()]
+            while len(batch) < self.max_batch and not self.queue.empty():
+                batch.append(self.queue.get_nowait())
+            await self._commit(batch)
+
+    async def _commit(self, batch: list[_PendingEntry]):
+        accepted = []
+        try:
+            async with self.session_factory() as db:
+                checked = {entry.transaction.username for entry in batch if entry.require_funds}
+                balances = {username: 0.0 for username in checked}
+                if checked:
+                    await _lock_users(db, checked)
+                    balances.update(await get_balances(db, checked))
+
+                for entry in batch:
+                    username = entry.transaction.username
+                    if username in balances:
+                        if entry.require_funds and balances[username] + entry.transaction.amount < 0:
+                            self.rejected += 1
+                            entry.future.set_exception(InsufficientFundsError(username))
+                            continue
+                        balances[username] += entry.transaction.amount
+                    accepted.append(entry)
+
+                for entry in accepted:
+                    db.add(entry.transaction)
+                    db.add_all(entry.rows)
+                await db.commit()
+
+            self.batches += 1
+            self.entries += len(accepted)
+            for entry in accepted:
+                entry.future.set_result(entry.transaction)
+        except Exception as e:
+            pending = [entry for entry in batch if not entry.future.done()]
+            if len(pending) > 1:
+                logging.error(f"Error committing ledger batch, retrying {len(pending)} entries one by one: {e}")
+                for entry in pending:
+                    # Rolled-back rows keep the ids their flush assigned
+                    for row in (entry.transaction, *entry.rows):
+                        row.id = None
+                    await self._commit([entry])
+                return
+            logging.error(f"Error committing ledger entry: {e}")
+            for entry in pending:
+                entry.future.set_exception(e)
+
+    async def snapshot_balances(self):
+        """
+        Fold every user's settled ledger tail into their BalanceSnapshot so
+        balance reads only sum recent entries.
+
+        Each snapshot is rolled forward by a single UPDATE that reads its own
+        last_transaction_id, so a run that overlaps another one (e.g. during a
+        leader change) cannot fold the same entries twice.
+        """
+        async with self.session_factory() as db:
+            cutoff = (await db.exec(
+                select(func.max(Transaction.id))
+                .where(Transaction.created_at < datetime.now() - timedelta(seconds=LEDGER_SNAPSHOT_LAG))
+            )).first()
+            if cutoff is None:
+                return
+
+            # Users with settled entries but no snapshot yet start from an empty one
+            dialect = (await db.connection()).dialect.name
+            insert = sqlite.insert if dialect == "sqlite" else postgresql.insert
+            missing = (
+                select(Transaction.username, literal(0.0), literal(0), literal(datetime.now()))
+                .where(
+                    Transaction.id <= cutoff,
+                    ~exists().where(BalanceSnapshot.username == Transaction.username),
+                )
+                .distinct()
+            )
+            await db.execute(
+                insert(BalanceSnapshot)
+                .from_select(["username", "balance", "last_transaction_id", "created_at"], missing)
+                .on_conflict_do_nothing(index_elements=["username"])
+            )
+
+            in_tail = (
+                Transaction.username == BalanceSnapshot.username,
+                Transaction.id > BalanceSnapshot.last_transaction_id,
+                Transaction.id <= cutoff,
+            )
+            result = await db.execute(
+                update(BalanceSnapshot)
+                .where(BalanceSnapshot.last_transaction_id < cutoff, exists().where(*in_tail))
+                .values(
+                    balance=BalanceSnapshot.balance
+                    + select(func.sum(Transaction.amount)).where(*in_tail).scalar_subquery(),
+                    last_transaction_id=cutoff,
+                    created_at=datetime.now(),
+                )
+            )
+            await db.commit()
+            logging.info(f"Balance snapshots updated for {result.rowcount} users up to entry {cutoff}")
+
+    def stats(self) -> dict:
+        return {
+            "queued": self.queue.qsize(),
+            "batches": self.batches,
+            "entries": self.entries,
+            "rejected": self.rejected,
+        }
@@ -0,0 +1,63 @@
+import json
+
+EVENT_INDEX_KEY = "index:events"
+MARKET_INDEX_KEY = "index:markets:{}"
+MARKET_CATEGORIES = ("bookMaker", "fancy", "SESSIONS")
+
+def index_key(cache_key: str) -> str:
+    """
+    Name of the per-id index kept alongside a cached feed ("events" or "markets:{event_id}").
+    """
+    return f"index:{cache_key}"
+
+async def index_events(redis_client, events: list, ex: int = 18000):
+    """
+    Store each event of a processed events feed under its id, replacing the previous index.
+    """
+    entries = {event["event_id"]: json.dumps(event) for event in events if event.get("event_id")}
+    await redis_client.replace_hash(EVENT_INDEX_KEY, entries, ex=ex)
+
+async def index_markets(redis_client, event_id: str, markets: dict, ex: int = 18000):
+    """
+    Store each market of a processed markets feed, with its status and runners,
+    under its marketId, replacing the event's previous index.
+    """
+    entries = {}
+    for category in MARKET_CATEGORIES:
+        for market in markets.get(category) or []:
+            if market.get("marketId"):
+                entries[market["marketId"]] = json.dumps({**market, "category": category})
+    await redis_client.replace_hash(MARKET_INDEX_KEY.format(event_id), entries, ex=ex)
+
+async def lookup_events(redis_client, event_ids) -> dict[str, dict]:
+    """
+    Fetch events by id from the index. Ids it does not hold, e.g. before the
+    first poll after a deploy, are looked up in the cached feed instead.
+    """
+    event_ids = list(event_ids)
+    found = _decode(event_ids, await redis_client.hmget(EVENT_INDEX_KEY, event_ids))
+    missing = set(event_ids) - set(found)
+    if missing:
+        for event in await redis_client.get_json("events") or []:
+            if event.get("event_id") in missing:
+                found[event["event_id"]] = event
+    return found
+
+async def lookup_markets(redis_client, event_id: str, market_ids) -> dict[str, dict]:
+    """
+    Fetch an event's markets by marketId from the index, falling back to the
+    cached feed like lookup_events.
+    """
+    market_ids = list(market_ids)
+    found = _decode(market_ids, await redis_client.hmget(MARKET_INDEX_KEY.format(event_id), market_ids))
+    missing = set(market_ids) - set(found)
+    if missing:
+        markets = await redis_client.get_json(f"markets:{event_id}") or {}
+        for category in MARKET_CATEGORIES:
+            for market in markets.get(category) or []:
+                if market.get("marketId") in missing:
+                    found[market["marketId"]] = {**market, "category": category}
+    return found
+
+def _decode(ids: list[str], values: list) -> dict[str, dict]:
+    return {id_: json.loads(value) for id_, value in zip(ids, values) if value is not None}
@@ -0,0 +1,220 @@
+import asyncio
+import logging
+import os
+import socket
+from uuid import uuid4
+from dotenv import load_dotenv
+
+logging.basicConfig(level=logging.INFO)
+
+load_dotenv()
+
+# Seconds a leader keeps polling without renewing; it renews every third of this
+LEADER_LEASE = float(os.getenv("LEADER_LEASE", 15))
+
+LEADER_KEY = "scheduler:leader"
+INTEREST_KEY = "market_interest:{}"
+# Ids of the workers that may hold an interest hash, so the leader never scans the keyspace
+WORKERS_KEY = "market_interest:workers"
+INTEREST_CHANNEL = "market_interest"
+
+RENEW_SCRIPT = """
+if redis.call('GET', KEYS[1]) == ARGV[1] then
+    return redis.call('PEXPIRE', KEYS[1], ARGV[2])
+end
+return 0
+"""
+
+# KEYS: workers set. ARGV: interest key prefix, worker ids...
+# Drops the workers whose interest hash is gone, e.g. expired after the worker died.
+PRUNE_SCRIPT = """
+local removed = 0
+for i = 2, #ARGV do
+    if redis.call('EXISTS', ARGV[1] .. ARGV[i]) == 0 then
+        removed = removed + redis.call('SREM', KEYS[1], ARGV[i])
+    end
+end
+return removed
+"""
+
+RELEASE_SCRIPT = """
+if redis.call('GET', KEYS[1]) == ARGV[1] then
+    return redis.call('DEL', KEYS[1])
+end
+return 0
+"""
+
+class PollingCoordinator:
+    """
+    Elects one process among all workers to run the polling jobs.
+
+    Leadership is a Redis key held with a lease that the leader keeps renewing;
+    when it stops, another worker takes over once the lease expires. Every
+    worker records its socket counts per feed ("events" or an event id) in its
+    own interest hash and announces changes, and the leader polls exactly the
+    events some worker is interested in, with the summed counts as subscribers.
+    """
+
+    def __init__(self, redis_client, scheduler, lease: float = LEADER_LEASE):
+        self.redis_client = redis_client
+        self.redis = redis_client.redis_client
+        self.scheduler = scheduler
+        self.lease = lease
+        self.worker_id = f"{socket.gethostname()}:{os.getpid()}:{uuid4().hex[:8]}"
+        self.renew_script = redis_client.register_script(RENEW_SCRIPT)
+        self.release_script = redis_client.register_script(RELEASE_SCRIPT)
+        self.prune_script = redis_client.register_script(PRUNE_SCRIPT)
+        self.is_leader = False
+        self.elections = 0
+        # This worker's socket counts, and (on the leader) the sum over all workers
+        self.local_interest: dict[str, int] = {}
+        self.subscriber_counts: dict[str, int] = {}
+        self.interest_changed = asyncio.Event()
+        self.task: asyncio.Task | None = None
+        self.leader_tasks: list[asyncio.Task] = []
+
+    async def start(self):
+        await self._campaign()
+        self.task = asyncio.create_task(self._lease_loop())
+
+    async def stop(self):
+        if self.task:
+            self.task.cancel()
+        try:
+            if self.is_leader:
+                await self._demote()
+                await self.release_script(keys=[LEADER_KEY], args=[self.worker_id])
+            await self.redis.delete(INTEREST_KEY.format(self.worker_id))
+            await self.redis.srem(WORKERS_KEY, self.worker_id)
+        except Exception as e:
+            logging.error(f"Error releasing polling leadership: {e}")
+
+    async def update_interest(self, key: str, count: int):
+        """
+        Record how many of this worker's sockets follow key and tell the leader.
+        """
+        if count > 0:
+            self.local_interest[key] = count
+        else:
+            self.local_interest.pop(key, None)
+        interest_key = INTEREST_KEY.format(self.worker_id)
+        try:
+            async with self.redis.pipeline(transaction=True) as pipe:
+                if count > 0:
+                    pipe.hset(interest_key, key, count)
+                    pipe.expire(interest_key, int(self.lease * 3))
+                else:
+                    pipe.hdel(interest_key, key)
+                pipe.sadd(WORKERS_KEY, self.worker_id)
+                pipe.publish(INTEREST_CHANNEL, self.worker_id)
+                await pipe.execute()
+        except Exception as e:
+            logging.error(f"Error recording polling interest in {key}: {e}")
+
+    def subscribers(self, key: str) -> int:
+        return self.subscriber_counts.get(key, 0)
+
+    async def _lease_loop(self):
+        while True:
+            await asyncio.sleep(self.lease / 3)
+            try:
+                await self._heartbeat()
+                await self._campaign()
+            except asyncio.CancelledError:
+                raise
+            except Exception as e:
+                logging.error(f"Polling leader election error: {e}")
+
+    async def _heartbeat(self):
+        # Rewritten whole so it survives a Redis restart; expires if this worker dies
+        await self.redis_client.replace_hash(
+            INTEREST_KEY.format(self.worker_id),
+            {key: str(count) for key, count in self.local_interest.items()},
+            ex=int(self.lease * 3),
+        )
+        await self.redis.sadd(WORKERS_KEY, self.worker_id)
+        if self.is_leader:
+            self.interest_changed.set()
+
+    async def _campaign(self):
+        lease_ms = int(self.lease * 1000)
+        if self.is_leader:
+            if not await self.renew_script(keys=[LEADER_KEY], args=[self.worker_id, lease_ms]):
+                logging.warning(f"Worker {self.worker_id} lost polling leadership")
+                await self._demote()
+        elif await self.redis.set(LEADER_KEY, self.worker_id, nx=True, px=lease_ms):
+            await self._promote()
+
+    async def _promote(self):
+        logging.info(f"Worker {self.worker_id} elected polling leader")
+        self.is_leader = True
+        self.elections += 1
+        # Subscribe before the first sync so no announcement falls in between
+        pubsub = await self.redis_client.new_pubsub(INTEREST_CHANNEL)
+        await self._sync_interest()
+        self.leader_tasks = [
+            asyncio.create_task(self._interest_listener(pubsub)),
+            asyncio.create_task(self._interest_sync_loop()),
+        ]
+        self.scheduler.start_polling()
+
+    async def _demote(self):
+        self.is_leader = False
+        for task in self.leader_tasks:
+            task.cancel()
+        self.leader_tasks = []
+        self.scheduler.stop_polling()
+        self.subscriber_counts = {}
+
+    async def _interest_listener(self, pubsub):
+        try:
+            async for message in pubsub.listen():
+                if message["type"] == "message":
+                    self.interest_changed.set()
+        except asyncio.CancelledError:
+            pass
+        except Exception as e:
+            logging.error(f"Polling interest listener error: {e}")
+        finally:
+            await self.redis_client.close_pubsub(INTEREST_CHANNEL, pubsub)
+
+    async def _interest_sync_loop(self):
+        # Bursts of announcements are folded into one sync
+        while True:
+            await self.interest_changed.wait()
+            self.interest_changed.clear()
+            try:
+                await self._sync_interest()
+            except Exception as e:
+                logging.error(f"Error syncing polling interest: {e}")
+
+    async def _sync_interest(self):
+        workers = sorted(await self.redis.smembers(WORKERS_KEY))
+        async with self.redis.pipeline(transaction=False) as pipe:
+            for worker in workers:
+                pipe.hgetall(INTEREST_KEY.format(worker))
+            interests = await pipe.execute()
+        counts: dict[str, int] = {}
+        for interest in interests:
+            for key, count in interest.items():
+                counts[key] = counts.get(key, 0) + int(count)
+        self.subscriber_counts = counts
+
+        gone = [worker for worker, interest in zip(workers, interests) if not interest]
+        if gone:
+            await self.prune_script(keys=[WORKERS_KEY], args=[INTEREST_KEY.format(""), *gone])
+
+        wanted = set(counts) - {"events"}
+        polled = set(self.scheduler.market_due)
+        for event_id in wanted - polled:
+            self.scheduler.add_market_job(event_id)
+        for event_id in polled - wanted:
+            self.scheduler.remove_market_fetch_job(event_id)
+
+    def stats(self) -> dict:
+        return {
+            "worker_id": self.worker_id,
+            "is_leader": self.is_leader,
+            "elections": self.elections,
+            "local_interest": len(self.local_interest),
+        }
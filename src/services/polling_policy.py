@@ -0,0 +1,98 @@
+import math
+import os
+import random
+from datetime import datetime
+from dotenv import load_dotenv
+
+load_dotenv()
+
+POLLING_INTERVAL = int(os.getenv("POLLING_INTERVAL", 10))
+POLL_MIN_INTERVAL = float(os.getenv("POLL_MIN_INTERVAL", 2))
+POLL_MAX_INTERVAL = float(os.getenv("POLL_MAX_INTERVAL", POLLING_INTERVAL * 60))
+# Fraction of each interval added or removed at random so jobs drift apart
+POLL_JITTER = float(os.getenv("POLL_JITTER", 0.1))
+# Upstream requests per minute shared by every polling job
+POLL_BUDGET = float(os.getenv("POLL_BUDGET", 300))
+# Weight of the latest poll in each key's change rate
+POLL_CHANGE_ALPHA = 0.3
+
+class PollingPolicy:
+    """
+    Chooses how long each polling job waits before its next poll.
+
+    Events about to start or in play are polled near the minimum interval and
+    ones days away near the maximum. Keys whose payload changes often, or that
+    more sockets are watching, are polled sooner; unwatched ones wait the
+    maximum. When the jobs together would exceed the request budget, every
+    interval is stretched by the same factor.
+    """
+
+    def __init__(
+        self,
+        min_interval: float = POLL_MIN_INTERVAL,
+        max_interval: float = POLL_MAX_INTERVAL,
+        jitter: float = POLL_JITTER,
+        budget: float = POLL_BUDGET,
+    ):
+        self.min_interval = min_interval
+        self.max_interval = max(max_interval, min_interval)
+        self.jitter = jitter
+        self.budget = budget
+        self.change_rates: dict[str, float] = {}
+        self.intervals: dict[str, float] = {}
+
+    def observe(self, key: str, changed: bool):
+        """
+        Record whether a poll of key returned a changed payload.
+        """
+        rate = self.change_rates.get(key, 1.0 if changed else 0.0)
+        self.change_rates[key] = rate + POLL_CHANGE_ALPHA * (float(changed) - rate)
+
+    def interval(self, key: str, subscribers: int, start_time: datetime | None = None, now: datetime | None = None) -> float:
+        """
+        Seconds until key's next poll. start_time is a naive UTC datetime, or
+        None for feeds that are not tied to one event.
+        """
+        if subscribers <= 0:
+            wanted = self.max_interval
+        else:
+            wanted = self._base_interval(start_time, now or datetime.utcnow())
+            # Between 1.5x slower for payloads that never change and 2x faster for ones that always do
+            wanted *= 1.5 - self.change_rates.get(key, 0.5)
+            wanted /= 1 + math.log2(subscribers)
+        wanted = min(max(wanted, self.min_interval), self.max_interval)
+        self.intervals[key] = wanted
+
+        interval = wanted * self.budget_scale()
+        return interval * random.uniform(1 - self.jitter, 1 + self.jitter)
+
+    def _base_interval(self, start_time: datetime | None, now: datetime) -> float:
+        if start_time is None:
+            return self.max_interval
+        until_start = (start_time - now).total_seconds()
+        if until_start <= 0:
+            return self.min_interval
+        # One second of delay per minute until the start: an hour out polls every minute
+        return until_start / 60
+
+    def requests_per_minute(self) -> float:
+        return sum(60 / interval for interval in self.intervals.values())
+
+    def budget_scale(self) -> float:
+        """
+        Factor applied to every interval to keep the total request rate within budget.
+        """
+        if self.budget <= 0:
+            return 1.0
+        return max(1.0, self.requests_per_minute() / self.budget)
+
+    def forget(self, key: str):
+        self.change_rates.pop(key, None)
+        self.intervals.pop(key, None)
+
+    def stats(self) -> dict:
+        return {
+            "requests_per_minute": self.requests_per_minute(),
+            "budget": self.budget,
+            "scale": self.budget_scale(),
+        }
@@ -0,0 +1,57 @@
+import json
+import os
+from dotenv import load_dotenv
+
+from ..models.user import User
+
+load_dotenv()
+
+PRINCIPAL_CACHE_TTL = int(os.getenv("PRINCIPAL_CACHE_TTL", 60))
+
+PRINCIPAL_KEY = "principal:{}"
+
+class PrincipalCache:
+    """
+    Short-lived cache of authenticated users, keyed by token subject.
+
+    Entries hold only the username and admin flag of a user with an active
+    session, in Redis and in each process's L1. Anything that ends or changes
+    a session must call invalidate, which drops the entry everywhere.
+    """
+
+    def __init__(self, redis_client, ttl: int = PRINCIPAL_CACHE_TTL):
+        self.redis_client = redis_client
+        self.ttl = ttl
+        self.hits = 0
+        self.misses = 0
+
+    async def get(self, db, username: str) -> User | None:
+        """
+        Return the user if they have an active session, or None.
+        Users returned from the cache are not attached to db.
+        """
+        key = PRINCIPAL_KEY.format(username)
+        cached = await self.redis_client.get_json(key)
+        if cached is not None:
+            self.hits += 1
+            return User(username=cached["username"], is_admin=cached["is_admin"])
+
+        self.misses += 1
+        user = await db.get(User, username)
+        if user is None or user.refresh_token is None:
+            return None
+        await self.redis_client.set(
+            key, json.dumps({"username": user.username, "is_admin": user.is_admin}), ex=self.ttl
+        )
+        return user
+
+    async def invalidate(self, username: str):
+        await self.redis_client.invalidate(PRINCIPAL_KEY.format(username))
+
+    def stats(self) -> dict:
+        lookups = self.hits + self.misses
+        return {
+            "hits": self.hits,
+            "misses": self.misses,
+            "hit_ratio": self.hits / lookups if lookups else 0.0,
+        }
@@ -1,4 +1,8 @@
+import asyncio
+import json
 import os
+import time
+from collections import OrderedDict
 import redis.asyncio as redis
 import logging
 from dotenv import load_dotenv
@@ -9,24 +13,83 @@ logging.basicConfig(level=logging.INFO)
 load_dotenv()
 
 REDIS_URL = os.getenv("REDIS_URL")
+# Size 0 disables the in-process L1 cache
+REDIS_L1_SIZE = int(os.getenv("REDIS_L1_SIZE", 1024))
+REDIS_L1_TTL = float(os.getenv("REDIS_L1_TTL", 30))
+
+INVALIDATION_CHANNEL = "cache_invalidate"
+
+class _CacheEntry:
+    __slots__ = ("raw", "value", "decoded", "expires_at")
+
+    def __init__(self, raw: str, expires_at: float):
+        self.raw = raw
+        self.value = None
+        self.decoded = False
+        self.expires_at = expires_at
 
 class RedisClient:
-    def __init__(self):
+    # Keys served from L1; each has an invalidating publish (see _invalidated_key),
+    # or is only ever removed with invalidate
+    L1_PREFIXES = ("events", "markets:", "principal:")
+
+    def __init__(self, l1_size: int = REDIS_L1_SIZE, l1_ttl: float = REDIS_L1_TTL):
         self.redis_url = REDIS_URL
         self.redis_client = redis.from_url(
             url=self.redis_url,
             decode_responses=True
         )
         self.pubsubs = {}
+        self.l1_size = l1_size
+        self.l1_ttl = l1_ttl
+        self.l1: OrderedDict[str, _CacheEntry] = OrderedDict()
+        self.l1_hits = 0
+        self.l1_misses = 0
+        self.invalidation_task: asyncio.Task | None = None
 
     async def get(self, key: str):
         """
         Get data from Redis cache.
         """
+        entry = self._l1_get(key)
+        if entry is not None:
+            return entry.raw
+        return await self._load(key)
+
+    async def get_json(self, key: str):
+        """
+        Get and decode JSON data from Redis cache. The decoded object is kept in
+        L1, so callers must treat it as read-only.
+        """
+        entry = self._l1_get(key)
+        if entry is None:
+            data = await self._load(key)
+            if data is None:
+                return None
+            entry = self.l1.get(key)
+            if entry is None:
+                return json.loads(data)
+        if not entry.decoded:
+            entry.value = json.loads(entry.raw)
+            entry.decoded = True
+        return entry.value
+
+    async def mget(self, keys: list[str]) -> list:
+        """
+        Get several keys from Redis at one point in time, bypassing L1.
+        """
+        try:
+            return await self.redis_client.mget(keys)
+        except Exception as e:
+            logging.error(f"Error fetching Redis keys {keys}: {e}")
+            return [None] * len(keys)
+
+    async def _load(self, key: str):
         try:
             data = await self.redis_client.get(key)
             if data:
                 logging.info(f"Data fetched from Redis for key: {key}")
+                self._l1_put(key, data)
             return data
         except Exception as e:
             logging.error(f"Error fetching data from Redis for key {key}: {e}")
@@ -38,14 +101,65 @@ class RedisClient:
         """
         try:
             await self.redis_client.set(key, value, ex=ex)
+            self._l1_put(key, value)
             logging.info(f"Data set in Redis for key: {key}")
         except Exception as e:
             logging.error(f"Error setting data in Redis for key {key}: {e}")
 
+    async def expire(self, key: str, ex: int = 18000):
+        """
+        Refresh the expiration time (in seconds) of an existing key.
+        """
+        try:
+            await self.redis_client.expire(key, ex)
+        except Exception as e:
+            logging.error(f"Error refreshing expiration in Redis for key {key}: {e}")
+
+    async def incr(self, key: str, ex: int = 18000):
+        """
+        Atomically increment a counter and refresh its expiration time (in seconds).
+        """
+        try:
+            async with self.redis_client.pipeline(transaction=True) as pipe:
+                pipe.incr(key)
+                pipe.expire(key, ex)
+                value, _ = await pipe.execute()
+            return value
+        except Exception as e:
+            logging.error(f"Error incrementing Redis key {key}: {e}")
+            return None
+
+    async def replace_hash(self, key: str, mapping: dict[str, str], ex: int = 18000):
+        """
+        Atomically replace all fields of a hash and set its expiration time (in seconds).
+        """
+        try:
+            async with self.redis_client.pipeline(transaction=True) as pipe:
+                pipe.delete(key)
+                if mapping:
+                    pipe.hset(key, mapping=mapping)
+                    pipe.expire(key, ex)
+                await pipe.execute()
+        except Exception as e:
+            logging.error(f"Error replacing Redis hash {key}: {e}")
+
+    async def hmget(self, key: str, fields: list[str]) -> list:
+        """
+        Get several fields of a hash; missing fields are None.
+        """
+        if not fields:
+            return []
+        try:
+            return await self.redis_client.hmget(key, fields)
+        except Exception as e:
+            logging.error(f"Error fetching fields of Redis hash {key}: {e}")
+            return [None] * len(fields)
+
     async def delete(self, key: str):
         """
         Delete data from Redis cache.
         """
+        self.l1.pop(key, None)
         try:
             await self.redis_client.delete(key)
             logging.info(f"Data deleted from Redis for key: {key}")
@@ -62,13 +176,149 @@ class RedisClient:
         except Exception as e:
             logging.error(f"Error publishing message to Redis channel {channel}: {e}")
 
+    async def publish_sequenced(self, channel: str, stream: str, seq: int, message: str, maxlen: int, ex: int = 18000):
+        """
+        Publish a message and append it to a capped stream under entry id seq,
+        in one transaction, so subscribers that missed it can replay it. seq 1
+        starts a new sequence and clears what the stream held before.
+        """
+        try:
+            async with self.redis_client.pipeline(transaction=True) as pipe:
+                if seq == 1:
+                    pipe.delete(stream)
+                pipe.xadd(stream, {"message": message}, id=f"{seq}-0", maxlen=maxlen, approximate=True)
+                pipe.expire(stream, ex)
+                pipe.publish(channel, message)
+                await pipe.execute()
+            logging.info(f"Message {seq} published to Redis channel: {channel}")
+        except Exception as e:
+            logging.error(f"Error publishing message {seq} to Redis channel {channel}: {e}")
+
+    async def read_stream(self, stream: str, after_seq: int) -> list[tuple[int, str]]:
+        """
+        Messages of a stream written by publish_sequenced after after_seq, as (seq, message) pairs.
+        """
+        try:
+            entries = await self.redis_client.xrange(stream, min=f"{after_seq + 1}-0")
+        except Exception as e:
+            logging.error(f"Error reading Redis stream {stream}: {e}")
+            return []
+        return [(int(entry_id.split("-")[0]), fields["message"]) for entry_id, fields in entries]
+
+    def register_script(self, script: str):
+        """
+        Register a Lua script to be run atomically on the Redis server.
+        """
+        return self.redis_client.register_script(script)
+
+    def lock(self, name: str, timeout: float):
+        """
+        Create a Redis lock that expires after timeout seconds if not released.
+        """
+        return self.redis_client.lock(name, timeout=timeout)
+
     async def new_pubsub(self, channel: str):
         pubsub = self.redis_client.pubsub()
         await pubsub.subscribe(channel)
         self.pubsubs[channel] = pubsub
         return pubsub
 
+    async def close_pubsub(self, channel: str, pubsub):
+        """
+        Unsubscribe and release a pubsub connection created by new_pubsub.
+        """
+        if self.pubsubs.get(channel) is pubsub:
+            del self.pubsubs[channel]
+        try:
+            await pubsub.unsubscribe(channel)
+            await pubsub.close()
+            logging.info(f"PubSub closed for Redis channel: {channel}")
+        except Exception as e:
+            logging.error(f"Error closing pubsub for Redis channel {channel}: {e}")
+
+    async def invalidate(self, key: str):
+        """
+        Delete a key and drop it from the L1 cache of every process.
+        """
+        await self.delete(key)
+        await self.publish(INVALIDATION_CHANNEL, key)
+
+    def start_invalidation_listener(self):
+        """
+        Drop L1 entries when their data is republished by any process.
+        """
+        if self.l1_size > 0 and self.invalidation_task is None:
+            self.invalidation_task = asyncio.create_task(self._invalidation_listener())
+
+    async def _invalidation_listener(self):
+        # Resubscribes with backoff; L1 is cleared each time, since invalidations
+        # published while unsubscribed are lost
+        delay = 1
+        while True:
+            pubsub = self.redis_client.pubsub()
+            try:
+                await pubsub.subscribe("events_channel", INVALIDATION_CHANNEL)
+                await pubsub.psubscribe("markets_channel:*")
+                self.l1.clear()
+                delay = 1
+                async for message in pubsub.listen():
+                    if message["type"] in ("message", "pmessage"):
+                        key = self._invalidated_key(message["channel"], message["data"])
+                        self.l1.pop(key, None)
+            except asyncio.CancelledError:
+                return
+            except Exception as e:
+                logging.error(f"L1 invalidation listener error, resubscribing in {delay}s: {e}")
+            finally:
+                try:
+                    await pubsub.aclose()
+                except Exception:
+                    pass
+            await asyncio.sleep(delay)
+            delay = min(delay * 2, 30)
+
+    @staticmethod
+    def _invalidated_key(channel: str, data: str) -> str:
+        if channel == INVALIDATION_CHANNEL:
+            return data
+        if channel == "events_channel":
+            return "events"
+        return f"markets:{channel.removeprefix('markets_channel:')}"
+
+    def _l1_get(self, key: str) -> _CacheEntry | None:
+        if self.l1_size <= 0 or not key.startswith(self.L1_PREFIXES):
+            return None
+        entry = self.l1.get(key)
+        if entry is None or entry.expires_at < time.monotonic():
+            if entry is not None:
+                del self.l1[key]
+            self.l1_misses += 1
+            return None
+        self.l1.move_to_end(key)
+        self.l1_hits += 1
+        return entry
+
+    def _l1_put(self, key: str, raw: str):
+        if self.l1_size <= 0 or not key.startswith(self.L1_PREFIXES):
+            return
+        self.l1[key] = _CacheEntry(raw, time.monotonic() + self.l1_ttl)
+        self.l1.move_to_end(key)
+        while len(self.l1) > self.l1_size:
+            self.l1.popitem(last=False)
+
+    def cache_stats(self) -> dict:
+        lookups = self.l1_hits + self.l1_misses
+        return {
+            "size": len(self.l1),
+            "max_size": self.l1_size,
+            "hits": self.l1_hits,
+            "misses": self.l1_misses,
+            "hit_ratio": self.l1_hits / lookups if lookups else 0.0,
+        }
+
     async def close(self):
+        if self.invalidation_task:
+            self.invalidation_task.cancel()
         try:
             for pubsub in self.pubsubs.values():
                 await pubsub.unsubscribe()
@@ -1,83 +1,419 @@
-import json
+import asyncio
+import hashlib
 import logging
 import os
+import time
+from uuid import uuid4
+from datetime import datetime, timedelta, timezone
 from apscheduler.schedulers.asyncio import AsyncIOScheduler
+from apscheduler.jobstores.base import JobLookupError
 from apscheduler.triggers.interval import IntervalTrigger
 from fastapi import FastAPI
 from dotenv import load_dotenv
 
 from .api_client import APIClient
+from .market_index import index_events, index_key, index_markets, lookup_events
+from .polling_policy import PollingPolicy
+from ..utils.delta import diff_market_data
+from ..utils.encoding import dumps, snapshot_message
 
 load_dotenv()
 
-POLLING_INTERVAL = int(os.getenv("POLLING_INTERVAL", 10))
+LEDGER_SNAPSHOT_INTERVAL = int(os.getenv("LEDGER_SNAPSHOT_INTERVAL", 300))
+MARKET_POLL_CONCURRENCY = int(os.getenv("MARKET_POLL_CONCURRENCY", 10))
+MARKET_POLL_TIMEOUT = float(os.getenv("MARKET_POLL_TIMEOUT", 15))
+MARKET_POLL_MAX_PER_TICK = int(os.getenv("MARKET_POLL_MAX_PER_TICK", 100))
+# Longest the market loop sleeps, so newly added events are picked up promptly
+MARKET_POLL_TICK = float(os.getenv("MARKET_POLL_TICK", 1))
+# Sequenced market messages kept per event for clients resuming after a reconnect
+MARKET_STREAM_MAXLEN = int(os.getenv("MARKET_STREAM_MAXLEN", 1000))
+CACHE_TTL = 18000
 logging.basicConfig(level=logging.INFO)
 
 class SchedulerService:
-    def __init__(self, app: FastAPI):
+    def __init__(self, app: FastAPI, api_client: APIClient):
         self.app = app
+        self.api_client = api_client
+        # Last published markets snapshot per event, used to build patches
+        self.market_snapshots: dict[str, dict] = {}
+        # Id of each event's current seq sequence, mirrored as markets_epoch:{event_id}
+        self.market_epochs: dict[str, str] = {}
+        # Content hash of the last payload cached per key, mirrored in Redis as digest:{key}
+        self.content_hashes: dict[str, str] = {}
+        self.poll_counts: dict[str, int] = {}
+        self.unchanged_polls: dict[str, int] = {}
+        # Whether each key's cached snapshot is flagged stale (stale:{key}); absent until first polled
+        self.stale_keys: dict[str, bool] = {}
+        self.policy = PollingPolicy()
+        # Naive UTC start time per event from the events feed, None if unknown
+        self.start_times: dict[str, datetime | None] = {}
+        # Loop time at which each subscribed event's markets are next due
+        self.market_due: dict[str, float] = {}
+        # Poll task per event being polled; it is not due again until its poll ends
+        self.market_polls: dict[str, asyncio.Task] = {}
+        self.market_semaphore = asyncio.Semaphore(MARKET_POLL_CONCURRENCY)
+        self.tick_stats = {
+            "ticks": 0, "last_poll_ms": 0.0, "max_poll_ms": 0.0,
+            "last_polled": 0, "last_skipped": 0, "skipped": 0, "timeouts": 0,
+        }
         self.scheduler = AsyncIOScheduler()
         self.scheduler.start()
+        self.market_task: asyncio.Task | None = None
+        self._check_poll_timeout()
         logging.info("✅ Scheduler started")
 
+    def start_polling(self):
+        """
+        Start the event job, the market loop and the balance snapshot job;
+        only the polling leader runs them.
+        """
+        self.add_event_job()
+        self.add_ledger_snapshot_job(self.app.state.ledger)
+        if self.market_task is None:
+            self.market_task = asyncio.create_task(self._market_loop())
+
+    def stop_polling(self):
+        for job_id in ("fetch_events", "snapshot_balances"):
+            if self.scheduler.get_job(job_id):
+                self.scheduler.remove_job(job_id)
+        if self.market_task is not None:
+            self.market_task.cancel()
+            self.market_task = None
+        for event_id in list(self.market_due):
+            self.remove_market_fetch_job(event_id)
+        # Another leader may publish events meanwhile; the next term re-reads the
+        # digest and stale flag from Redis instead of trusting this one's
+        self.content_hashes.pop("events", None)
+        self.stale_keys.pop("events", None)
+        self.policy.forget("events")
+
     def add_event_job(self):
         if not self.scheduler.get_job("fetch_events"):
             self.scheduler.add_job(
                 self._poll_fetch_events,
-                trigger=IntervalTrigger(minutes=POLLING_INTERVAL),
+                # Each poll reschedules the next one; the trigger is only a fallback
+                trigger=IntervalTrigger(seconds=self.policy.max_interval),
+                next_run_time=datetime.now(self.scheduler.timezone),
                 id="fetch_events",
                 name="Periodic Event Fetch"
             )
             logging.info("Event polling job added")
 
-    def add_market_job(self, event_id: str):
-        job_id = f"fetch_market_{event_id}"
-        if not self.scheduler.get_job(job_id):
+    def add_ledger_snapshot_job(self, ledger):
+        if not self.scheduler.get_job("snapshot_balances"):
             self.scheduler.add_job(
-                self._poll_fetch_markets,
-                args=[event_id],
-                trigger=IntervalTrigger(minutes=POLLING_INTERVAL),
-                id=job_id,
-                name=f"Market Fetch for {event_id}"
+                ledger.snapshot_balances,
+                trigger=IntervalTrigger(seconds=LEDGER_SNAPSHOT_INTERVAL),
+                id="snapshot_balances",
+                name="Periodic Balance Snapshot"
             )
-            logging.info(f"Market polling job added for event {event_id}")
+            logging.info("Balance snapshot job added")
+
+    def add_market_job(self, event_id: str):
+        if event_id not in self.market_due:
+            self.market_due[event_id] = asyncio.get_running_loop().time()
+            logging.info(f"Market polling added for event {event_id}")
 
     def remove_market_fetch_job(self, event_id: str):
-        job_id = f"fetch_market_{event_id}"
-        if self.scheduler.get_job(job_id):
-            self.scheduler.remove_job(job_id)
-            logging.info(f"Market polling job removed for event {event_id}")
+        if self.market_due.pop(event_id, None) is not None:
+            logging.info(f"Market polling removed for event {event_id}")
+        self._forget_markets(event_id)
+
+    def _forget_markets(self, event_id: str):
+        self.market_snapshots.pop(event_id, None)
+        self.market_epochs.pop(event_id, None)
+        self.policy.forget(f"markets:{event_id}")
+        for counters in (self.content_hashes, self.poll_counts, self.unchanged_polls, self.stale_keys):
+            counters.pop(f"markets:{event_id}", None)
 
     def stop(self):
         logging.info("📛 Scheduler stopping...")
+        if self.market_task is not None:
+            self.market_task.cancel()
         self.scheduler.shutdown(wait=False)
 
+    def market_stats(self) -> dict:
+        return {**self.tick_stats, "events": len(self.market_due), "in_flight": len(self.market_polls)}
+
+    def stats(self) -> dict:
+        return {
+            key: {
+                "polls": count,
+                "unchanged": self.unchanged_polls.get(key, 0),
+                "interval": self.policy.intervals.get(key),
+            }
+            for key, count in self.poll_counts.items()
+        }
+
     async def _poll_fetch_events(self):
         logging.info("Polling events...")
         try:
-            async with APIClient() as client:
-                response = await client.fetch_events()
-                if response:
-                    redis = self.app.state.redis_client
-                    await redis.publish("events_channel", json.dumps(response))
-                    await redis.set("events", json.dumps(response))
+            response = await self.api_client.fetch_events()
+            redis = self.app.state.redis_client
+            await self._set_stale(redis, "events", response is None)
+            if response:
+                payload = dumps(response)
+                digest = await self._changed_digest(redis, "events", payload)
+                self.policy.observe("events", digest is not None)
+                if digest:
+                    self._update_start_times(response)
+                    await redis.set("events", payload, ex=CACHE_TTL)
+                    await index_events(redis, response, ex=CACHE_TTL)
+                    await redis.publish("events_channel", payload)
+                    await self._store_digest(redis, "events", digest)
                     logging.info("Events published successfully")
-                else:
-                    logging.warning("No events fetched")
+            else:
+                logging.warning("No events fetched")
         except Exception as e:
             logging.error(f"Error fetching events: {e}")
+        self._schedule_next("fetch_events", "events", self._subscribers("events"))
 
     async def _poll_fetch_markets(self, event_id: str):
         logging.info(f"Polling markets for event {event_id}...")
         try:
-            async with APIClient() as client:
-                response = await client.fetch_markets(event_id=event_id)
-                if response:
-                    redis = self.app.state.redis_client
-                    await redis.publish(f"markets_channel:{event_id}", json.dumps(response))
-                    await redis.set(f"markets:{event_id}", json.dumps(response))
-                    logging.info(f"Markets for {event_id} published successfully")
+            response = await self.api_client.fetch_markets(event_id=event_id)
+            redis = self.app.state.redis_client
+            key = f"markets:{event_id}"
+            await self._set_stale(redis, key, response is None, event_id)
+            if response:
+                payload = dumps(response)
+                digest = await self._changed_digest(redis, key, payload)
+                self.policy.observe(key, digest is not None)
+                if digest:
+                    await redis.set(key, payload, ex=CACHE_TTL)
+                    await index_markets(redis, event_id, response, ex=CACHE_TTL)
+                    await self._publish_markets(redis, event_id, response, payload)
+                    await self._store_digest(redis, key, digest)
                 else:
-                    logging.warning(f"No markets fetched for {event_id}")
+                    await redis.expire(f"markets_seq:{event_id}", CACHE_TTL)
+                    await redis.expire(f"stream:markets:{event_id}", CACHE_TTL)
+                    await redis.expire(f"markets_epoch:{event_id}", CACHE_TTL)
+                    self.market_snapshots.setdefault(event_id, response)
+            else:
+                logging.warning(f"No markets fetched for {event_id}")
         except Exception as e:
-            logging.error(f"Error fetching markets for {event_id}: {e}")
\ No newline at end of file
+            logging.error(f"Error fetching markets for {event_id}: {e}")
+
+    async def _market_loop(self):
+        """
+        Start a poll for every event whose markets are due, most overdue first,
+        sharing the API client's connection pool. Each poll is its own task, run
+        at most MARKET_POLL_CONCURRENCY at a time and cut off after
+        MARKET_POLL_TIMEOUT, so a slow poll never holds back the events due
+        after it. Due events beyond MARKET_POLL_MAX_PER_TICK wait for the next
+        wake-up.
+        """
+        loop = asyncio.get_running_loop()
+        try:
+            while True:
+                try:
+                    now = loop.time()
+                    due = sorted((at, event_id) for event_id, at in self._waiting_markets() if at <= now)
+                    if due:
+                        self._market_tick([event_id for _, event_id in due])
+                    next_due = min((at for _, at in self._waiting_markets()), default=loop.time() + MARKET_POLL_TICK)
+                    await asyncio.sleep(min(max(next_due - loop.time(), 0), MARKET_POLL_TICK))
+                except asyncio.CancelledError:
+                    raise
+                except Exception as e:
+                    logging.error(f"Market polling loop error: {e}")
+                    await asyncio.sleep(MARKET_POLL_TICK)
+        finally:
+            for task in self.market_polls.values():
+                task.cancel()
+            self.market_polls.clear()
+
+    def _waiting_markets(self):
+        return ((event_id, at) for event_id, at in self.market_due.items() if event_id not in self.market_polls)
+
+    def _market_tick(self, due: list[str]):
+        polled, skipped = due[:MARKET_POLL_MAX_PER_TICK], due[MARKET_POLL_MAX_PER_TICK:]
+        for event_id in polled:
+            task = asyncio.create_task(self._poll_due_markets(event_id))
+            self.market_polls[event_id] = task
+            task.add_done_callback(lambda task, event_id=event_id: self._market_poll_done(event_id, task))
+
+        stats = self.tick_stats
+        stats["ticks"] += 1
+        stats["last_polled"] = len(polled)
+        stats["last_skipped"] = len(skipped)
+        stats["skipped"] += len(skipped)
+        if skipped:
+            logging.warning(f"Market polling tick skipped {len(skipped)} due events")
+
+    def _market_poll_done(self, event_id: str, task: asyncio.Task):
+        if self.market_polls.get(event_id) is task:
+            del self.market_polls[event_id]
+        if not task.cancelled() and task.exception() is not None:
+            # Still due, so it is retried on the next wake-up
+            logging.error(f"Market polling error for {event_id}: {task.exception()}")
+
+    async def _poll_due_markets(self, event_id: str):
+        async with self.market_semaphore:
+            started = time.perf_counter()
+            try:
+                await asyncio.wait_for(self._poll_fetch_markets(event_id), MARKET_POLL_TIMEOUT)
+            except asyncio.TimeoutError:
+                self.tick_stats["timeouts"] += 1
+                logging.error(f"Timed out polling markets for {event_id}")
+                # The cancelled poll never got to flag its snapshot
+                await self._set_stale(self.app.state.redis_client, f"markets:{event_id}", True, event_id)
+            elapsed_ms = (time.perf_counter() - started) * 1000
+            self.tick_stats["last_poll_ms"] = elapsed_ms
+            self.tick_stats["max_poll_ms"] = max(self.tick_stats["max_poll_ms"], elapsed_ms)
+        if event_id not in self.market_due:
+            # Removed while polling; drop the state the poll left behind
+            self._forget_markets(event_id)
+            return
+        interval = self.policy.interval(
+            f"markets:{event_id}", self._subscribers(event_id), await self._start_time(event_id)
+        )
+        self.market_due[event_id] = asyncio.get_running_loop().time() + interval
+
+    def _check_poll_timeout(self):
+        # A poll cut off by MARKET_POLL_TIMEOUT cancels its fetch before the circuit breaker hears of the failure
+        max_fetch_time = self.api_client.max_fetch_time()
+        if max_fetch_time >= MARKET_POLL_TIMEOUT:
+            logging.error(
+                f"Upstream fetches may take {max_fetch_time:.1f}s, not below MARKET_POLL_TIMEOUT={MARKET_POLL_TIMEOUT}s; "
+                "lower API_FETCH_DEADLINE, API_TIMEOUT or API_MAX_RETRIES"
+            )
+
+    def _schedule_next(self, job_id: str, key: str, subscribers: int, start_time: datetime | None = None):
+        interval = self.policy.interval(key, subscribers, start_time)
+        try:
+            self.scheduler.modify_job(
+                job_id, next_run_time=datetime.now(self.scheduler.timezone) + timedelta(seconds=interval)
+            )
+        except JobLookupError:
+            pass  # Removed while polling
+
+    def _subscribers(self, key: str) -> int:
+        # Summed over all workers by the polling coordinator
+        polling = getattr(self.app.state, "polling", None)
+        if polling is None:
+            return 0
+        return polling.subscribers(key)
+
+    def _update_start_times(self, events: list):
+        self.start_times = {
+            event["event_id"]: self._parse_open_date(event.get("openDate"))
+            for event in events
+            if event.get("event_id")
+        }
+
+    async def _start_time(self, event_id: str) -> datetime | None:
+        if event_id not in self.start_times:
+            event = (await lookup_events(self.app.state.redis_client, [event_id])).get(event_id)
+            self.start_times[event_id] = self._parse_open_date(event.get("openDate")) if event else None
+        return self.start_times[event_id]
+
+    @staticmethod
+    def _parse_open_date(open_date: str | None) -> datetime | None:
+        if not open_date:
+            return None
+        try:
+            start_time = datetime.fromisoformat(open_date.replace("Z", "+00:00"))
+        except ValueError:
+            return None
+        if start_time.tzinfo is not None:
+            start_time = start_time.astimezone(timezone.utc).replace(tzinfo=None)
+        return start_time
+
+    async def _changed_digest(self, redis, key: str, payload: str) -> str | None:
+        """
+        Hash the payload and compare it with the last one cached under key.
+        Returns the new digest when it changed; an unchanged payload only has
+        its cache TTL refreshed and is counted, and None is returned.
+        """
+        digest = hashlib.blake2b(payload.encode(), digest_size=16).hexdigest()
+        previous = self.content_hashes.get(key)
+        if previous is None:
+            previous = await redis.get(f"digest:{key}")
+
+        self.poll_counts[key] = self.poll_counts.get(key, 0) + 1
+
+        if previous != digest:
+            return digest
+
+        self.content_hashes[key] = digest
+        self.unchanged_polls[key] = self.unchanged_polls.get(key, 0) + 1
+        await redis.expire(key, CACHE_TTL)
+        await redis.expire(index_key(key), CACHE_TTL)
+        await redis.expire(f"digest:{key}", CACHE_TTL)
+        logging.info(f"No changes for {key}, skipped publish")
+        return None
+
+    async def _set_stale(self, redis, key: str, stale: bool, event_id: str | None = None):
+        """
+        While the upstream fails, keep serving the last good snapshot of key,
+        flagged as stale:{key}. Changes of a markets flag are announced on the
+        event's channel.
+        """
+        if stale:
+            await redis.expire(key, CACHE_TTL)
+            await redis.expire(index_key(key), CACHE_TTL)
+        previous = self.stale_keys.get(key)
+        if previous == stale:
+            return
+        self.stale_keys[key] = stale
+        if stale:
+            await redis.set(f"stale:{key}", "1", ex=CACHE_TTL)
+            logging.warning(f"Upstream failing, serving stale {key}")
+        else:
+            # Also clears a flag left behind by an earlier process
+            await redis.delete(f"stale:{key}")
+        if event_id and (stale or previous):
+            await redis.publish(
+                f"markets_channel:{event_id}",
+                dumps({"type": "status", "event_id": event_id, "stale": stale}),
+            )
+
+    async def _store_digest(self, redis, key: str, digest: str):
+        self.content_hashes[key] = digest
+        await redis.set(f"digest:{key}", digest, ex=CACHE_TTL)
+
+    async def _market_epoch(self, redis, event_id: str, seq: int | None) -> str:
+        """
+        The epoch of an event's seq sequence. A new one starts whenever seq
+        restarts at 1 (its key expired or Redis was flushed), so clients
+        resuming from an older sequence can be told apart.
+        """
+        key = f"markets_epoch:{event_id}"
+        epoch = None if seq == 1 else self.market_epochs.get(event_id) or await redis.get(key)
+        if epoch is None:
+            epoch = uuid4().hex[:12]
+        self.market_epochs[event_id] = epoch
+        await redis.set(key, epoch, ex=CACHE_TTL)
+        return epoch
+
+    async def _publish_markets(self, redis, event_id: str, markets: dict, payload: str):
+        """
+        Publish a full snapshot the first time an event is polled and compact
+        patches afterwards, each stamped with the event's sequence number.
+        payload is markets already serialized for the cache, reused for snapshots.
+        """
+        previous = self.market_snapshots.get(event_id)
+        self.market_snapshots[event_id] = markets
+
+        if previous is not None:
+            changes = diff_market_data(previous, markets)
+            if not changes:
+                logging.info(f"Markets for {event_id} unchanged, nothing to publish")
+                return
+
+        seq = await redis.incr(f"markets_seq:{event_id}")
+        epoch = await self._market_epoch(redis, event_id, seq)
+        if previous is None:
+            message_type, message = "snapshot", snapshot_message(event_id, seq, payload, epoch=epoch)
+        else:
+            message_type = "patch"
+            message = dumps({"type": "patch", "event_id": event_id, "changes": changes, "seq": seq, "epoch": epoch})
+        channel = f"markets_channel:{event_id}"
+        if seq is None:
+            await redis.publish(channel, message)
+        else:
+            await redis.publish_sequenced(
+                channel, f"stream:markets:{event_id}", seq, message, MARKET_STREAM_MAXLEN, ex=CACHE_TTL
+            )
+        logging.info(f"Markets {message_type} {seq} for {event_id} published successfully")
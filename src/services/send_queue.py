@@ -0,0 +1,126 @@
+import asyncio
+import logging
+import os
+import time
+from collections import deque
+from dotenv import load_dotenv
+
+logging.basicConfig(level=logging.INFO)
+
+load_dotenv()
+
+# Messages a socket may have waiting before its channels are conflated
+WS_SEND_QUEUE = int(os.getenv("WS_SEND_QUEUE", 100))
+# Seconds a socket may stay over its queue limit before it is disconnected
+WS_SLOW_CLIENT_TIMEOUT = float(os.getenv("WS_SLOW_CLIENT_TIMEOUT", 30))
+
+class SendQueue:
+    """
+    Outbound messages for one WebSocket, written by its own task so a slow
+    client never holds up the listener broadcasting to it.
+
+    When the queue is full, a channel's waiting messages are dropped and
+    replaced by one resync entry; the writer turns it into a fresh snapshot
+    of the channel when it gets there. A socket that stays over the limit for
+    slow_timeout seconds is reported through on_slow.
+    """
+
+    def __init__(self, send, resync, on_slow, maxsize: int = WS_SEND_QUEUE, slow_timeout: float = WS_SLOW_CLIENT_TIMEOUT):
+        self.send = send
+        self.resync = resync
+        self.on_slow = on_slow
+        self.maxsize = maxsize
+        self.slow_timeout = slow_timeout
+        # (channel, message) pairs; a None message is a resync of the channel
+        self.queue: deque = deque()
+        self.resyncing: set[str] = set()
+        self.ready = asyncio.Event()
+        self.behind_since: float | None = None
+        self.closed = False
+        self.max_depth = 0
+        self.conflated = 0
+        self.resyncs = 0
+        self.task = asyncio.create_task(self._writer())
+
+    def put(self, message, channel: str | None = None):
+        """
+        Queue message, published on channel or sent directly when channel is None.
+        """
+        if self.closed:
+            return
+        if channel in self.resyncing:
+            # Already covered by the snapshot the pending resync will send
+            self.conflated += 1
+            self._check_slow()
+            return
+        if channel is not None and len(self.queue) >= self.maxsize:
+            self.conflated += 1
+            self._conflate(channel)
+            self._check_slow()
+        else:
+            self.queue.append((channel, message))
+        self.max_depth = max(self.max_depth, len(self.queue))
+        self.ready.set()
+
+    def request_resync(self, channel: str):
+        """
+        Replace channel's waiting messages with a resync, for when updates
+        published on it may have been lost before reaching this queue.
+        """
+        if self.closed or channel in self.resyncing:
+            return
+        self._conflate(channel)
+        self.ready.set()
+
+    def _conflate(self, channel: str):
+        kept = deque(entry for entry in self.queue if entry[0] != channel)
+        self.conflated += len(self.queue) - len(kept)
+        kept.append((channel, None))
+        self.queue = kept
+        self.resyncing.add(channel)
+
+    def _check_slow(self):
+        now = time.monotonic()
+        if self.behind_since is None:
+            self.behind_since = now
+        elif now - self.behind_since > self.slow_timeout:
+            self.close()
+            self.on_slow()
+
+    async def _writer(self):
+        try:
+            while True:
+                if not self.queue:
+                    self.behind_since = None
+                    self.ready.clear()
+                    await self.ready.wait()
+                    continue
+                channel, message = self.queue.popleft()
+                if len(self.queue) < self.maxsize:
+                    # Caught up below the limit; a later overflow starts a new slow period
+                    self.behind_since = None
+                if message is None:
+                    # Cleared before reading the snapshot so later updates queue behind it
+                    self.resyncing.discard(channel)
+                    self.resyncs += 1
+                    message = await self.resync(channel)
+                    if message is None:
+                        continue
+                if not await self.send(message):
+                    break
+        except asyncio.CancelledError:
+            pass
+        except Exception as e:
+            logging.info(f"WebSocket writer stopped: {e}")
+        finally:
+            self.closed = True
+
+    def close(self):
+        self.closed = True
+        self.queue.clear()
+        self.resyncing.clear()
+        if self.task is not asyncio.current_task():
+            self.task.cancel()
+
+    def depth(self) -> int:
+        return len(self.queue)
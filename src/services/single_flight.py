@@ -0,0 +1,100 @@
+import asyncio
+import logging
+import os
+from dotenv import load_dotenv
+from redis.exceptions import LockError
+
+logging.basicConfig(level=logging.INFO)
+
+load_dotenv()
+
+SINGLE_FLIGHT_DISTRIBUTED = os.getenv("SINGLE_FLIGHT_DISTRIBUTED", "false").lower() == "true"
+SINGLE_FLIGHT_LOCK_TIMEOUT = float(os.getenv("SINGLE_FLIGHT_LOCK_TIMEOUT", 15))
+SINGLE_FLIGHT_WAIT_TIMEOUT = float(os.getenv("SINGLE_FLIGHT_WAIT_TIMEOUT", 10))
+
+class SingleFlight:
+    """
+    Coalesces concurrent loads of the same cache key into one in-flight call.
+
+    Within a process, callers for a key that is already being loaded await the
+    same task. With distributed enabled, a Redis lock extends this across
+    processes: the lock holder loads and caches the value while other processes
+    wait for it to appear in Redis, falling back to loading it themselves.
+    """
+
+    def __init__(
+        self,
+        redis_client,
+        distributed: bool = SINGLE_FLIGHT_DISTRIBUTED,
+        lock_timeout: float = SINGLE_FLIGHT_LOCK_TIMEOUT,
+        wait_timeout: float = SINGLE_FLIGHT_WAIT_TIMEOUT,
+        poll_interval: float = 0.1,
+    ):
+        self.redis_client = redis_client
+        self.distributed = distributed
+        self.lock_timeout = lock_timeout
+        self.wait_timeout = wait_timeout
+        self.poll_interval = poll_interval
+        self.inflight: dict[str, asyncio.Task] = {}
+        self.loads = 0
+        self.coalesced = 0
+
+    async def do(self, key: str, load):
+        """
+        Return the value for key, running load() at most once per concurrent burst.
+        load must cache its result under key in Redis and return the cached value.
+        """
+        task = self.inflight.get(key)
+        if task is None:
+            task = asyncio.create_task(self._load(key, load))
+            self.inflight[key] = task
+            task.add_done_callback(lambda done: self._forget(key, done))
+        else:
+            self.coalesced += 1
+        # Shielded so a waiter that disconnects does not cancel the load for the others
+        return await asyncio.shield(task)
+
+    def _forget(self, key: str, task: asyncio.Task):
+        if self.inflight.get(key) is task:
+            del self.inflight[key]
+
+    async def _load(self, key: str, load):
+        if not self.distributed:
+            self.loads += 1
+            return await load()
+
+        lock = self.redis_client.lock(f"lock:{key}", timeout=self.lock_timeout)
+        if await lock.acquire(blocking=False):
+            try:
+                self.loads += 1
+                return await load()
+            finally:
+                try:
+                    await lock.release()
+                except LockError:
+                    logging.warning(f"Single-flight lock for {key} expired before release")
+
+        value = await self._wait_for_cache(key)
+        if value is not None:
+            self.coalesced += 1
+            return value
+        logging.warning(f"Timed out waiting for another process to load {key}, loading locally")
+        self.loads += 1
+        return await load()
+
+    async def _wait_for_cache(self, key: str):
+        loop = asyncio.get_running_loop()
+        deadline = loop.time() + self.wait_timeout
+        while loop.time() < deadline:
+            value = await self.redis_client.get(key)
+            if value is not None:
+                return value
+            await asyncio.sleep(self.poll_interval)
+        return None
+
+    def stats(self) -> dict:
+        return {
+            "inflight": len(self.inflight),
+            "loads": self.loads,
+            "coalesced": self.coalesced,
+        }
@@ -0,0 +1,384 @@
+import asyncio
+import json
+import logging
+import os
+from datetime import datetime
+from uuid import uuid4
+from sqlalchemy import update
+from sqlalchemy.exc import IntegrityError
+from sqlmodel import select
+from dotenv import load_dotenv
+
+from ..database import new_session
+from ..models.bet import Bet, Market
+from ..models.user import Transaction, TransactionType
+from ..schemas.bet import BetSlipItem
+from .betting_engine import ensure_events, ensure_markets
+from .ledger import InsufficientFundsError, get_balance, get_balances
+
+logging.basicConfig(level=logging.INFO)
+
+load_dotenv()
+
+BET_RESERVATION_MODE = os.getenv("BET_RESERVATION_MODE", "false").lower() == "true"
+RESERVATION_BATCH = int(os.getenv("RESERVATION_BATCH", 200))
+RESERVATION_RECONCILE_INTERVAL = float(os.getenv("RESERVATION_RECONCILE_INTERVAL", 60))
+# Failed persist attempts before a slip is dead-lettered and its stake refunded
+RESERVATION_MAX_ATTEMPTS = int(os.getenv("RESERVATION_MAX_ATTEMPTS", 5))
+
+BALANCE_KEY = "balance:{}"
+VERSION_KEY = "balance_version"
+PENDING_KEY = "bets:pending"
+PROCESSING_KEY = "bets:processing"
+DEAD_KEY = "bets:dead"
+
+# KEYS: balance, pending list. ARGV: stake, bet payload.
+# Returns {-1} if the balance is not mirrored yet, {0, balance} if it is too low,
+# otherwise {1, remaining} after debiting and queueing the bet for persistence.
+RESERVE_SCRIPT = """
+local balance = redis.call('GET', KEYS[1])
+if not balance then return {-1, ''} end
+local stake = tonumber(ARGV[1])
+if tonumber(balance) < stake then return {0, balance} end
+local remaining = redis.call('INCRBYFLOAT', KEYS[1], -stake)
+redis.call('LPUSH', KEYS[2], ARGV[2])
+return {1, remaining}
+"""
+
+# KEYS: balance, version. ARGV: amount, require_funds ('1' or '0').
+# Same return shape as RESERVE_SCRIPT; bumps the version so a concurrent
+# reconcile does not overwrite the adjustment.
+ADJUST_SCRIPT = """
+redis.call('INCR', KEYS[2])
+local balance = redis.call('GET', KEYS[1])
+if not balance then return {-1, ''} end
+local amount = tonumber(ARGV[1])
+if ARGV[2] == '1' and tonumber(balance) + amount < 0 then return {0, balance} end
+return {1, redis.call('INCRBYFLOAT', KEYS[1], amount)}
+"""
+
+# KEYS: version, pending, processing, balance keys... ARGV: expected version, balances...
+# Overwrites mirrored balances only if nothing was reserved, persisted or adjusted
+# since the database balances were read.
+RECONCILE_SCRIPT = """
+if (redis.call('GET', KEYS[1]) or '0') ~= ARGV[1] then return 0 end
+if redis.call('LLEN', KEYS[2]) > 0 or redis.call('LLEN', KEYS[3]) > 0 then return 0 end
+for i = 4, #KEYS do redis.call('SET', KEYS[i], ARGV[i - 2]) end
+return 1
+"""
+
+async def _lock_markets(db, market_ids) -> dict[str, str]:
+    """
+    Status of each stored market, held until the transaction ends so that a
+    settlement cannot commit between this check and the bets being stored.
+    """
+    stmt = select(Market.market_id, Market.status).where(Market.market_id.in_(market_ids))
+    if (await db.connection()).dialect.name == "sqlite":
+        # No row locks in SQLite; any write takes the database lock, held until commit
+        await db.execute(update(Market).where(Market.market_id.in_(market_ids)).values(status=Market.status))
+    else:
+        stmt = stmt.with_for_update()
+    return dict((await db.exec(stmt)).all())
+
+class StakeReservation:
+    """
+    Accepts bets with a single Redis round trip.
+
+    Balances are mirrored into Redis and stakes are reserved atomically by a
+    server-side script that also queues the bet. A persister task writes queued
+    bets and their ledger entries to the database in batches, idempotently by
+    reference, and a reconcile task resyncs the mirror from the ledger when no
+    reservations are in flight. On start, bets left mid-persistence by a stopped
+    process are requeued.
+
+    A failed batch is retried slip by slip, so one bad slip holds up no other.
+    Slips on unknown or settled markets, slips the database rejects, and slips
+    still failing after max_attempts are moved to bets:dead with their mirrored
+    stake refunded.
+    """
+
+    def __init__(self, redis_client, batch_size: int = RESERVATION_BATCH,
+                 reconcile_interval: float = RESERVATION_RECONCILE_INTERVAL,
+                 max_attempts: int = RESERVATION_MAX_ATTEMPTS):
+        self.redis_client = redis_client
+        self.redis = redis_client.redis_client
+        self.batch_size = batch_size
+        self.reconcile_interval = reconcile_interval
+        self.max_attempts = max_attempts
+        # Failed attempts per queued slip, dropped once it is stored or dead-lettered
+        self.attempts: dict[str, int] = {}
+        self.reserve_script = redis_client.register_script(RESERVE_SCRIPT)
+        self.adjust_script = redis_client.register_script(ADJUST_SCRIPT)
+        self.reconcile_script = redis_client.register_script(RECONCILE_SCRIPT)
+        self.tasks: list[asyncio.Task] = []
+        self.reserved = 0
+        self.rejected = 0
+        self.persisted = 0
+        self.dead_lettered = 0
+
+    async def start(self):
+        await self.recover()
+        self.tasks = [
+            asyncio.create_task(self._persist_loop()),
+            asyncio.create_task(self._reconcile_loop()),
+        ]
+
+    async def stop(self):
+        for task in self.tasks:
+            task.cancel()
+        self.tasks = []
+
+    async def recover(self):
+        """
+        Requeue bets a previous process took for persistence but never finished.
+        Persistence is idempotent, so a bet that was in fact written is skipped.
+        """
+        recovered = 0
+        while await self.redis.lmove(PROCESSING_KEY, PENDING_KEY, "LEFT", "RIGHT"):
+            recovered += 1
+        if recovered:
+            logging.info(f"Requeued {recovered} unpersisted bet reservations")
+
+    async def place_bets(self, db, username: str, bets_data: list[BetSlipItem]) -> list[Bet]:
+        """
+        Reserve the combined stake and queue the slip. The returned bets have no
+        id yet; their reference identifies them once persisted.
+        """
+        total_stake = sum(bet_data.stake for bet_data in bets_data)
+        reference = uuid4().hex
+        bets = [
+            Bet(username=username, reference=reference, **bet_data.model_dump(exclude={"event_id"}))
+            for bet_data in bets_data
+        ]
+        payload = json.dumps({
+            "reference": reference,
+            "username": username,
+            "placed_at": bets[0].placed_at.isoformat(),
+            "bets": [bet_data.model_dump() for bet_data in bets_data],
+        })
+
+        keys = [BALANCE_KEY.format(username), PENDING_KEY]
+        status, _ = await self.reserve_script(keys=keys, args=[total_stake, payload])
+        if status == -1:
+            await self._mirror(db, username)
+            status, _ = await self.reserve_script(keys=keys, args=[total_stake, payload])
+        if status != 1:
+            self.rejected += 1
+            raise InsufficientFundsError(username)
+
+        self.reserved += 1
+        for bet in bets:
+            bet.status = "PENDING"
+        return bets
+
+    async def adjust(self, db, username: str, amount: float, require_funds: bool = False):
+        """
+        Apply a balance change made outside of bet placement to the mirror.
+        Unmirrored balances are loaded first only when funds must be checked.
+        """
+        keys = [BALANCE_KEY.format(username), VERSION_KEY]
+        args = [amount, "1" if require_funds else "0"]
+        status, _ = await self.adjust_script(keys=keys, args=args)
+        if status == -1 and require_funds:
+            await self._mirror(db, username)
+            status, _ = await self.adjust_script(keys=keys, args=args)
+        if status == 0:
+            raise InsufficientFundsError(username)
+
+    async def credit_many(self, credits: dict[str, float]):
+        async with self.redis.pipeline(transaction=False) as pipe:
+            for username, amount in credits.items():
+                await self.adjust_script(keys=[BALANCE_KEY.format(username), VERSION_KEY], args=[amount, "0"], client=pipe)
+            await pipe.execute()
+
+    async def forget(self, username: str):
+        """
+        Drop a deleted user's mirrored balance so a new user of that name starts from the ledger.
+        """
+        await self.redis.delete(BALANCE_KEY.format(username))
+
+    async def _mirror(self, db, username: str):
+        balance = await get_balance(db, username)
+        await self.redis.set(BALANCE_KEY.format(username), balance, nx=True)
+
+    async def _persist_loop(self):
+        delay = 1
+        while True:
+            try:
+                first = await self.redis.blmove(PENDING_KEY, PROCESSING_KEY, 5, "RIGHT", "LEFT")
+                if first is None:
+                    continue
+                batch = [first]
+                while len(batch) < self.batch_size:
+                    item = await self.redis.lmove(PENDING_KEY, PROCESSING_KEY, "RIGHT", "LEFT")
+                    if item is None:
+                        break
+                    batch.append(item)
+                if await self._persist_batch(batch):
+                    # Requeued slips are retried after a backoff, not immediately
+                    await asyncio.sleep(delay)
+                    delay = min(delay * 2, 30)
+                else:
+                    delay = 1
+            except asyncio.CancelledError:
+                raise
+            except Exception as e:
+                logging.error(f"Bet reservation persister error: {e}")
+                await asyncio.sleep(1)
+
+    async def _persist_batch(self, batch: list[str]) -> bool:
+        """
+        Store a batch in one transaction, or slip by slip if that fails.
+        Returns whether any slip was requeued.
+        """
+        try:
+            rejected = await self._persist(batch)
+        except Exception as e:
+            if len(batch) == 1:
+                return await self._failed(batch[0], e)
+            logging.error(f"Error persisting {len(batch)} reserved bet slips, retrying one by one: {e}")
+            requeued = False
+            for item in batch:
+                requeued = await self._persist_batch([item]) or requeued
+            return requeued
+        await self._dead_letter(rejected)
+        stored = [item for item in batch if item not in rejected]
+        await self._release(stored)
+        for item in stored:
+            self.attempts.pop(item, None)
+        self.persisted += len(stored)
+        return False
+
+    async def _failed(self, item: str, error: Exception) -> bool:
+        attempts = self.attempts.get(item, 0) + 1
+        if isinstance(error, IntegrityError) or attempts >= self.max_attempts:
+            await self._dead_letter({item: f"{type(error).__name__}: {error}"})
+            return False
+        logging.error(f"Error persisting reserved bet slip (attempt {attempts}), requeueing: {error}")
+        self.attempts[item] = attempts
+        await self._release([item], requeue=True)
+        return True
+
+    async def _dead_letter(self, rejected: dict[str, str]):
+        """
+        Move slips that will never be stored to bets:dead and give their stake
+        back to the mirrored balance. No ledger entry was written for them, so a
+        refund lost to a crash is restored by the next reconcile.
+        """
+        if not rejected:
+            return
+        failed_at = datetime.now().isoformat()
+        async with self.redis.pipeline(transaction=True) as pipe:
+            for item, reason in rejected.items():
+                pipe.lrem(PROCESSING_KEY, 1, item)
+                pipe.rpush(DEAD_KEY, json.dumps({"slip": json.loads(item), "reason": reason, "failed_at": failed_at}))
+            await pipe.execute()
+        for item, reason in rejected.items():
+            self.attempts.pop(item, None)
+            slip = json.loads(item)
+            stake = sum(bet_data["stake"] for bet_data in slip["bets"])
+            await self.adjust_script(keys=[BALANCE_KEY.format(slip["username"]), VERSION_KEY], args=[stake, "0"])
+            logging.warning(f"Dead-lettered bet slip {slip['reference']} of {slip['username']}, refunded {stake}: {reason}")
+        self.dead_lettered += len(rejected)
+
+    async def _release(self, batch: list[str], requeue: bool = False):
+        async with self.redis.pipeline(transaction=True) as pipe:
+            for item in batch:
+                pipe.lrem(PROCESSING_KEY, 1, item)
+            if requeue:
+                pipe.rpush(PENDING_KEY, *batch)
+            else:
+                pipe.incr(VERSION_KEY)
+            await pipe.execute()
+
+    async def _persist(self, batch: list[str]) -> dict[str, str]:
+        """
+        Store the batch's slips in one transaction, skipping those already
+        stored. Returns the slips rejected for an unknown or settled market,
+        with the reason; the rest are committed.
+        """
+        slips = {item: json.loads(item) for item in batch}
+        async with new_session() as db:
+            references = [slip["reference"] for slip in slips.values()]
+            stored = set((await db.exec(select(Bet.reference).where(Bet.reference.in_(references)))).all())
+            slips = {item: slip for item, slip in slips.items() if slip["reference"] not in stored}
+            if not slips:
+                return {}
+
+            market_ids_by_event: dict[str, set[str]] = {}
+            for slip in slips.values():
+                for bet_data in slip["bets"]:
+                    market_ids_by_event.setdefault(bet_data["event_id"], set()).add(bet_data["market_id"])
+            await ensure_events(db, self.redis_client, set(market_ids_by_event))
+            await ensure_markets(db, self.redis_client, market_ids_by_event)
+            statuses = await _lock_markets(db, set().union(*market_ids_by_event.values()))
+
+            rejected = {}
+            for item, slip in list(slips.items()):
+                for bet_data in slip["bets"]:
+                    status = statuses.get(bet_data["market_id"])
+                    if status is None or status == "SETTLED":
+                        rejected[item] = f"Market {bet_data['market_id']} is {'unknown' if status is None else 'settled'}"
+                        del slips[item]
+                        break
+
+            for slip in slips.values():
+                placed_at = datetime.fromisoformat(slip["placed_at"])
+                db.add(Transaction(
+                    username=slip["username"],
+                    amount=-sum(bet_data["stake"] for bet_data in slip["bets"]),
+                    type=TransactionType.BET_STAKE.value,
+                    reference=slip["reference"],
+                    created_at=placed_at,
+                ))
+                db.add_all([
+                    Bet(
+                        username=slip["username"],
+                        reference=slip["reference"],
+                        placed_at=placed_at,
+                        **{key: value for key, value in bet_data.items() if key != "event_id"},
+                    )
+                    for bet_data in slip["bets"]
+                ])
+            await db.commit()
+            return rejected
+
+    async def _reconcile_loop(self):
+        while True:
+            await asyncio.sleep(self.reconcile_interval)
+            try:
+                await self.reconcile()
+            except Exception as e:
+                logging.error(f"Error reconciling mirrored balances: {e}")
+
+    async def reconcile(self) -> bool:
+        """
+        Reset mirrored balances to the ledger's. Skipped, and retried next
+        interval, while any reservation is queued or being persisted.
+        """
+        version = await self.redis.get(VERSION_KEY) or "0"
+        if await self.redis.llen(PENDING_KEY) or await self.redis.llen(PROCESSING_KEY):
+            return False
+
+        keys = [key async for key in self.redis.scan_iter(match=BALANCE_KEY.format("*"))]
+        if not keys:
+            return True
+        usernames = [key.split(":", 1)[1] for key in keys]
+        async with new_session() as db:
+            balances = await get_balances(db, usernames)
+
+        applied = await self.reconcile_script(
+            keys=[VERSION_KEY, PENDING_KEY, PROCESSING_KEY, *keys],
+            args=[version, *(balances.get(username, 0.0) for username in usernames)],
+        )
+        if applied:
+            logging.info(f"Reconciled {len(keys)} mirrored balances")
+        return bool(applied)
+
+    def stats(self) -> dict:
+        return {
+            "reserved": self.reserved,
+            "rejected": self.rejected,
+            "persisted": self.persisted,
+            "dead_lettered": self.dead_lettered,
+        }
@@ -4,136 +4,475 @@ import logging
 from fastapi import WebSocket, WebSocketDisconnect
 from fastapi.websockets import WebSocketState
 
+from .market_index import MARKET_CATEGORIES, index_events, index_markets
+from .send_queue import SendQueue
+from .single_flight import SingleFlight
+from ..utils.encoding import DEFAULT_FORMAT, EncodedMessage, available_formats, dumps, snapshot_message
+from ..utils.market_filter import MarketFilter
+
 logging.basicConfig(level=logging.INFO)
 
 class WebSocketManager:
-    def __init__(self, redis_client, scheduler_service, api_client_cls):
+    # Seconds between keepalive pings; one encoded ping is shared by every socket
+    PING_INTERVAL = 30
+    PING = EncodedMessage(dumps({"ping": "pong"}))
+
+    def __init__(self, redis_client, polling, api_client):
         self.redis_client = redis_client
-        self.scheduler = scheduler_service
-        self.api_client_cls = api_client_cls
+        # Forwards subscription counts to whichever worker is polling
+        self.polling = polling
+        self.api_client = api_client
+        self.single_flight = SingleFlight(redis_client)
         self.connections: dict[str, set[WebSocket]] = {}
-        self.listener_tasks: dict[tuple[str, WebSocket], asyncio.Task] = {}
+        # One Redis subscription per channel, fanned out to every socket in channel_subscribers
+        self.channel_subscribers: dict[str, set[WebSocket]] = {}
+        self.listener_tasks: dict[str, asyncio.Task] = {}
         self.ping_tasks: dict[WebSocket, asyncio.Task] = {}
+        # Outbound queue and writer task per socket
+        self.queues: dict[WebSocket, SendQueue] = {}
+        self.closing_tasks: set[asyncio.Task] = set()
+        # Counters of queues already closed, added to the live ones in stats()
+        self.queue_totals = {"conflated": 0, "resyncs": 0}
+        self.slow_disconnects = 0
+        self.replays = 0
+        self.replay_fallbacks = 0
+        self.listener_restarts = 0
+        # Markets each socket selected per channel; absent means the whole event
+        self.market_filters: dict[str, dict[WebSocket, MarketFilter]] = {}
+        # Wire format chosen by each socket; absent means JSON
+        self.formats: dict[WebSocket, str] = {}
+        self.bytes_sent: dict[str, int] = {}
 
     async def connect(self, websocket: WebSocket):
         await websocket.accept()
         logging.info("WebSocket connected.")
+        self.queues[websocket] = SendQueue(
+            send=lambda message: self._write(websocket, message),
+            resync=lambda channel: self._resync(websocket, channel),
+            on_slow=lambda: self._drop_slow(websocket),
+        )
         self.ping_tasks[websocket] = asyncio.create_task(self._ping(websocket))
 
     async def listen(self, websocket: WebSocket):
+        code = 1000
         try:
             while True:
                 message = await websocket.receive_text()
-                data = json.loads(message)
+                try:
+                    data = json.loads(message)
+                except ValueError:
+                    data = None
+                if not isinstance(data, dict):
+                    self._reply(websocket, {"error": "Invalid message format"})
+                    continue
                 msg_type = data.get("type")
 
-                if msg_type == "market" and "event_id" in data:
-                    await self.subscribe_to_markets(data["event_id"], websocket)
+                if "format" in data and not self._set_format(websocket, data["format"]):
+                    self._reply(websocket, {
+                        "error": "Unsupported format",
+                        "formats": sorted(available_formats()),
+                    })
+                    continue
+
+                if msg_type in ("market", "unsubscribe") and isinstance(data.get("event_id"), str):
+                    selection = self._selection(data)
+                    if selection is None:
+                        self._reply(websocket, {
+                            "error": "Invalid market selection",
+                            "categories": list(MARKET_CATEGORIES),
+                        })
+                    elif msg_type == "market":
+                        await self.subscribe_to_markets(
+                            data["event_id"], websocket, *selection, since=data.get("since"), epoch=data.get("epoch")
+                        )
+                    elif not await self.unsubscribe_from_markets(data["event_id"], websocket, *selection):
+                        self._reply(websocket, {"error": "Not subscribed to these markets"})
                 elif msg_type == "events":
                     await self.subscribe_to_events(websocket)
                 else:
-                    await websocket.send_text(json.dumps({"error": "Invalid message format"}))
+                    self._reply(websocket, {"error": "Invalid message format"})
 
         except WebSocketDisconnect:
-            await self.disconnect_all(websocket)
+            pass
+        except Exception as e:
+            logging.error(f"WebSocket listener error, disconnecting: {e}")
+            code = 1011
+        finally:
+            # Whatever ended the loop, nothing registered for the socket may outlive it
+            await self.disconnect_all(websocket, code)
+
+    def _selection(self, data: dict) -> tuple[list, list] | None:
+        """
+        The categories and market_ids lists of a market message, or None if they are malformed.
+        """
+        categories = data.get("categories") or []
+        market_ids = data.get("market_ids") or []
+        if not isinstance(categories, list) or not isinstance(market_ids, list):
+            return None
+        if any(category not in MARKET_CATEGORIES for category in categories):
+            return None
+        if not all(isinstance(market_id, str) for market_id in market_ids):
+            return None
+        return categories, market_ids
+
+    def _set_format(self, websocket: WebSocket, format) -> bool:
+        if not isinstance(format, str) or format not in available_formats():
+            return False
+        if format == DEFAULT_FORMAT:
+            self.formats.pop(websocket, None)
+        else:
+            self.formats[websocket] = format
+        return True
 
     async def subscribe_to_events(self, websocket: WebSocket):
         self.connections.setdefault("events", set()).add(websocket)
+        await self.polling.update_interest("events", len(self.connections["events"]))
         await self._send_events_data(websocket)
         self._start_listener("events_channel", websocket)
 
-    async def subscribe_to_markets(self, event_id: str, websocket: WebSocket):
-        first_subscriber = event_id not in self.connections
-        self.connections.setdefault(event_id, set()).add(websocket)
+    async def subscribe_to_markets(
+        self, event_id: str, websocket: WebSocket, categories=(), market_ids=(), since=None, epoch=None
+    ):
+        """
+        Subscribe to an event's markets. With categories or market_ids, they are
+        added to the socket's selection and only those markets are sent; without,
+        the socket gets the whole event. A socket resuming with since and epoch,
+        the last seq it saw and its sequence, is sent only the messages after it
+        when they are still kept.
+        """
+        channel = f"markets_channel:{event_id}"
+        # Only a new subscription resumes; changing the selection needs a fresh snapshot
+        resuming = since is not None and websocket not in self.connections.get(event_id, ())
+        if categories or market_ids:
+            filters = self.market_filters.setdefault(channel, {})
+            filters[websocket] = filters.get(websocket, MarketFilter()).add(categories, market_ids)
+        elif websocket in self.market_filters.get(channel, {}):
+            del self.market_filters[channel][websocket]
+            if not self.market_filters[channel]:
+                del self.market_filters[channel]
 
-        if first_subscriber:
-            self.scheduler.add_market_job(event_id)
+        self.connections.setdefault(event_id, set()).add(websocket)
+        await self.polling.update_interest(event_id, len(self.connections[event_id]))
 
         logging.info(f"Added connection to {event_id} (total: {len(self.connections[event_id])})")
-        await self._send_markets_data(event_id, websocket)
-        self._start_listener(f"markets_channel:{event_id}", websocket)
+        if not (resuming and await self._replay_markets(event_id, websocket, since, epoch)):
+            await self._send_markets_data(event_id, websocket)
+        self._start_listener(channel, websocket)
+
+    async def unsubscribe_from_markets(self, event_id: str, websocket: WebSocket, categories=(), market_ids=()) -> bool:
+        """
+        Drop categories and market_ids from the socket's selection, or leave the
+        event when none are given or nothing is left. Returns False if the socket
+        is not subscribed to them.
+        """
+        channel = f"markets_channel:{event_id}"
+        if websocket not in self.connections.get(event_id, ()):
+            return False
+        filters = self.market_filters.get(channel, {})
+        if categories or market_ids:
+            if websocket not in filters:
+                # A whole-event subscription has no selection to narrow
+                return False
+            remaining = filters[websocket].remove(categories, market_ids)
+            if remaining:
+                filters[websocket] = remaining
+                return True
+
+        filters.pop(websocket, None)
+        if not filters:
+            self.market_filters.pop(channel, None)
+        websockets = self.connections[event_id]
+        websockets.discard(websocket)
+        await self.polling.update_interest(event_id, len(websockets))
+        if not websockets:
+            del self.connections[event_id]
+        self._stop_listener(channel, websocket)
+        logging.info(f"Removed connection from {event_id} (remaining: {len(websockets)})")
+        return True
 
     async def _send_events_data(self, websocket: WebSocket):
-        events_data = await self.redis_client.get("events")
-        if events_data:
-            await websocket.send_text(events_data)
+        message = await self._cached_events()
+        if message:
+            self._send(websocket, message, "events_channel")
             logging.info("Sent cached events data to WebSocket")
-        else:
-            async with self.api_client_cls() as client:
-                response = await client.fetch_events()
-                if response:
-                    await websocket.send_text(json.dumps({"events": response}))
-                    await self.redis_client.set("events", json.dumps(response))
-                    logging.info("Sent freshly fetched events data to WebSocket")
-                else:
-                    logging.warning("No events data found")
+            return
 
+        events_data = await self.single_flight.do("events", self._load_events)
+        if events_data:
+            self._send(websocket, EncodedMessage(events_data), "events_channel")
+            logging.info("Sent freshly fetched events data to WebSocket")
+        else:
+            logging.warning("No events data found")
 
     async def _send_markets_data(self, event_id: str, websocket: WebSocket):
-        markets_data = await self.redis_client.get(f"markets:{event_id}")
-        if markets_data:
-            await websocket.send_text(markets_data)
+        channel = f"markets_channel:{event_id}"
+        message, seq, epoch = await self._cached_markets(event_id)
+        if message:
+            self._send(websocket, self._filtered(websocket, channel, message), channel)
             logging.info(f"Sent cached markets data for {event_id} to WebSocket")
+            return
+
+        markets_data = await self.single_flight.do(
+            f"markets:{event_id}", lambda: self._load_markets(event_id)
+        )
+        if markets_data:
+            message = EncodedMessage(snapshot_message(event_id, seq, markets_data, epoch=epoch))
+            self._send(websocket, self._filtered(websocket, channel, message), channel)
+            logging.info(f"Sent freshly fetched markets data for {event_id} to WebSocket")
         else:
-            async with self.api_client_cls() as client:
-                response = await client.fetch_markets(event_id=event_id)
-                if response:
-                    await websocket.send_text(json.dumps({"markets": response}))
-                    await self.redis_client.set(f"markets:{event_id}", json.dumps(response))
-                    logging.info(f"Sent freshly fetched markets data for {event_id} to WebSocket")
-                else:
-                    logging.warning(f"No markets data found for event {event_id}")
+            logging.warning(f"No markets data found for event {event_id}")
+
+    async def _replay_markets(self, event_id: str, websocket: WebSocket, since, epoch) -> bool:
+        """
+        Send the messages published after seq since, followed by the current
+        stale status. Returns False, for a snapshot instead, when since is not
+        from the current sequence (epoch) or the stream no longer reaches back to it.
+        """
+        seq, current_epoch = await self.redis_client.mget([f"markets_seq:{event_id}", f"markets_epoch:{event_id}"])
+        seq = int(seq or 0)
+        if (
+            epoch is None or epoch != current_epoch
+            or not isinstance(since, int) or isinstance(since, bool) or not 0 < since <= seq
+        ):
+            self.replay_fallbacks += 1
+            return False
+        entries = []
+        if since < seq:
+            entries = await self.redis_client.read_stream(f"stream:markets:{event_id}", since)
+            if not entries or entries[0][0] != since + 1:
+                self.replay_fallbacks += 1
+                return False
+
+        channel = f"markets_channel:{event_id}"
+        for _, message in entries:
+            self._send(websocket, self._filtered(websocket, channel, EncodedMessage(message)), channel)
+        stale = await self.redis_client.get(f"stale:markets:{event_id}") is not None
+        self._send(websocket, EncodedMessage(dumps({"type": "status", "event_id": event_id, "stale": stale})), channel)
+        self.replays += 1
+        logging.info(f"Replayed {len(entries)} markets messages for {event_id} after seq {since}")
+        return True
+
+    async def _cached_events(self) -> EncodedMessage | None:
+        events_data = await self.redis_client.get("events")
+        return EncodedMessage(events_data) if events_data else None
+
+    async def _cached_markets(self, event_id: str) -> tuple[EncodedMessage | None, int, str | None]:
+        # Sequence and data are read together straight from Redis, never from L1:
+        # patches only set values, so a snapshot that is newer than its seq is
+        # safe to replay them on, an older one is not.
+        seq, epoch, markets_data, stale = await self.redis_client.mget([
+            f"markets_seq:{event_id}", f"markets_epoch:{event_id}",
+            f"markets:{event_id}", f"stale:markets:{event_id}",
+        ])
+        seq = int(seq or 0)
+        if not markets_data:
+            return None, seq, epoch
+        return EncodedMessage(snapshot_message(event_id, seq, markets_data, stale is not None, epoch)), seq, epoch
+
+    async def _resync(self, websocket: WebSocket, channel: str) -> EncodedMessage | None:
+        """
+        Latest snapshot of a channel, sent in place of the updates a slow socket missed.
+        """
+        if channel == "events_channel":
+            return await self._cached_events()
+        message, _, _ = await self._cached_markets(channel.removeprefix("markets_channel:"))
+        return self._filtered(websocket, channel, message) if message else None
+
+    def _filtered(self, websocket: WebSocket, channel: str, message: EncodedMessage) -> EncodedMessage:
+        market_filter = self.market_filters.get(channel, {}).get(websocket)
+        return self._slice(message, market_filter) if market_filter else message
+
+    @staticmethod
+    def _slice(message: EncodedMessage, market_filter: MarketFilter) -> EncodedMessage:
+        value = message.decode()
+        sliced = market_filter.apply(value)
+        if sliced is value:
+            return message
+        return EncodedMessage(dumps(sliced))
+
+    async def _load_events(self) -> str | None:
+        response = await self.api_client.fetch_events()
+        if not response:
+            return None
+        events_data = dumps(response)
+        await self.redis_client.set("events", events_data)
+        await index_events(self.redis_client, response)
+        return events_data
+
+    async def _load_markets(self, event_id: str) -> str | None:
+        response = await self.api_client.fetch_markets(event_id=event_id)
+        if not response:
+            return None
+        markets_data = dumps(response)
+        await self.redis_client.set(f"markets:{event_id}", markets_data)
+        await index_markets(self.redis_client, event_id, response)
+        return markets_data
 
     def _start_listener(self, channel: str, websocket: WebSocket):
-        key = (channel, websocket)
-        if key not in self.listener_tasks:
-            task = asyncio.create_task(self._pubsub_listener(channel, websocket))
-            self.listener_tasks[key] = task
+        self.channel_subscribers.setdefault(channel, set()).add(websocket)
+        task = self.listener_tasks.get(channel)
+        if task is None or task.done():
+            task = asyncio.create_task(self._pubsub_listener(channel))
+            self.listener_tasks[channel] = task
+            logging.info(f"Started shared listener for {channel}")
 
-    async def _pubsub_listener(self, channel: str, websocket: WebSocket):
-        pubsub = await self.redis_client.new_pubsub(channel)
-        await pubsub.subscribe(channel)
+    def _stop_listener(self, channel: str, websocket: WebSocket):
+        subscribers = self.channel_subscribers.get(channel)
+        if subscribers is None:
+            return
+        subscribers.discard(websocket)
+        if not subscribers:
+            del self.channel_subscribers[channel]
+            task = self.listener_tasks.pop(channel, None)
+            if task:
+                task.cancel()
+            logging.info(f"Stopped shared listener for {channel}")
 
+    async def _pubsub_listener(self, channel: str):
+        # Resubscribes with backoff while the channel has subscribers. Messages
+        # published while unsubscribed are lost, so each subscriber is resynced
+        # once the subscription is back.
+        delay = 1
+        lost = False
         try:
-            async for message in pubsub.listen():
-                if message["type"] == "message":
-                    payload = message["data"]
-                    if websocket.client_state == WebSocketState.CONNECTED:
-                        await websocket.send_text(payload)
-                    else:
-                        break
-        except Exception as e:
-            logging.error(f"PubSub listener error for {channel}: {e}")
+            while self.channel_subscribers.get(channel):
+                pubsub = None
+                try:
+                    pubsub = await self.redis_client.new_pubsub(channel)
+                    if lost:
+                        self.listener_restarts += 1
+                        self._resync_subscribers(channel)
+                        lost = False
+                    delay = 1
+                    async for message in pubsub.listen():
+                        if message["type"] == "message":
+                            await self._broadcast(channel, message["data"])
+                    logging.error(f"PubSub for {channel} ended, resubscribing in {delay}s")
+                except Exception as e:
+                    logging.error(f"PubSub listener error for {channel}, resubscribing in {delay}s: {e}")
+                finally:
+                    if pubsub is not None:
+                        await self.redis_client.close_pubsub(channel, pubsub)
+                lost = True
+                await asyncio.sleep(delay)
+                delay = min(delay * 2, 30)
+        except asyncio.CancelledError:
+            pass
         finally:
-            await pubsub.unsubscribe(channel)
-            await pubsub.close()
-            self.listener_tasks.pop((channel, websocket), None)
+            if self.listener_tasks.get(channel) is asyncio.current_task():
+                del self.listener_tasks[channel]
+
+    def _resync_subscribers(self, channel: str):
+        for websocket in self.channel_subscribers.get(channel, ()):
+            queue = self.queues.get(websocket)
+            if queue is not None:
+                queue.request_resync(channel)
+
+    async def _broadcast(self, channel: str, payload: str):
+        subscribers = list(self.channel_subscribers.get(channel, ()))
+        if not subscribers:
+            return
+        # Encoded once per format and shared by every recipient
+        message = EncodedMessage(payload)
+        filters = self.market_filters.get(channel)
+        # Sliced once per distinct selection; sockets without one get the message as-is
+        sliced: dict[MarketFilter, EncodedMessage] = {}
+        for websocket in subscribers:
+            market_filter = filters.get(websocket) if filters else None
+            if market_filter is None:
+                self._send(websocket, message, channel)
+                continue
+            if market_filter not in sliced:
+                sliced[market_filter] = self._slice(message, market_filter)
+            self._send(websocket, sliced[market_filter], channel)
+
+    def _send(self, websocket: WebSocket, message: EncodedMessage, channel: str | None = None):
+        queue = self.queues.get(websocket)
+        if queue is not None:
+            queue.put(message, channel)
+
+    async def _write(self, websocket: WebSocket, message: EncodedMessage) -> bool:
+        if websocket.client_state != WebSocketState.CONNECTED:
+            return False
+        format = self.formats.get(websocket, DEFAULT_FORMAT)
+        payload = message.encode(format)
+        if isinstance(payload, bytes):
+            await websocket.send_bytes(payload)
+        else:
+            await websocket.send_text(payload)
+        self.bytes_sent[format] = self.bytes_sent.get(format, 0) + message.size(format)
+        return True
+
+    def _reply(self, websocket: WebSocket, message: dict):
+        # Queued like every other frame, so it is never written mid-frame and uses the socket's format
+        self._send(websocket, EncodedMessage(dumps(message)))
 
     async def _ping(self, websocket: WebSocket):
         try:
             while websocket.client_state == WebSocketState.CONNECTED:
-                await asyncio.sleep(30)
-                await websocket.send_json({"ping": "pong"})
+                await asyncio.sleep(self.PING_INTERVAL)
+                self._send(websocket, self.PING)
         except Exception:
             pass
         finally:
             self.ping_tasks.pop(websocket, None)
 
-    async def disconnect_all(self, websocket: WebSocket):
+    def _drop_slow(self, websocket: WebSocket):
+        self.slow_disconnects += 1
+        logging.warning("Disconnecting WebSocket that stayed behind its send queue")
+        # 1013: try again later
+        task = asyncio.create_task(self.disconnect_all(websocket, code=1013))
+        self.closing_tasks.add(task)
+        task.add_done_callback(self.closing_tasks.discard)
+
+    def stats(self) -> dict:
+        formats: dict[str, int] = {}
+        for format in self.formats.values():
+            formats[format] = formats.get(format, 0) + 1
+        queues = list(self.queues.values())
+        return {
+            "connections": len(self.ping_tasks),
+            "non_json_connections": formats,
+            "filtered_subscriptions": sum(len(filters) for filters in self.market_filters.values()),
+            "bytes_sent": self.bytes_sent,
+            "send_queues": {
+                "depth": sum(queue.depth() for queue in queues),
+                "max_depth": max((queue.max_depth for queue in queues), default=0),
+                "conflated": self.queue_totals["conflated"] + sum(queue.conflated for queue in queues),
+                "resyncs": self.queue_totals["resyncs"] + sum(queue.resyncs for queue in queues),
+                "slow_disconnects": self.slow_disconnects,
+            },
+            "replays": self.replays,
+            "replay_fallbacks": self.replay_fallbacks,
+            "listener_restarts": self.listener_restarts,
+        }
+
+    async def disconnect_all(self, websocket: WebSocket, code: int = 1000):
         for channel, websockets in list(self.connections.items()):
+            if websocket not in websockets:
+                continue
             websockets.discard(websocket)
+            await self.polling.update_interest(channel, len(websockets))
             if not websockets:
-                if channel != "events":
-                    self.scheduler.remove_market_fetch_job(channel)
                 del self.connections[channel]
                 logging.info(f"Removed subscription for channel: {channel}")
 
-        # Cancel listener tasks
-        to_cancel = [key for key in self.listener_tasks if key[1] == websocket]
-        for key in to_cancel:
-            task = self.listener_tasks.pop(key, None)
-            if task:
-                task.cancel()
+        # Drop from shared listeners; the last subscriber releases the Redis subscription
+        for channel in list(self.channel_subscribers):
+            self._stop_listener(channel, websocket)
+
+        for channel, filters in list(self.market_filters.items()):
+            filters.pop(websocket, None)
+            if not filters:
+                del self.market_filters[channel]
+
+        self.formats.pop(websocket, None)
+
+        queue = self.queues.pop(websocket, None)
+        if queue:
+            queue.close()
+            self.queue_totals["conflated"] += queue.conflated
+            self.queue_totals["resyncs"] += queue.resyncs
 
         # Cancel ping
         ping_task = self.ping_tasks.pop(websocket, None)
@@ -142,7 +481,7 @@ class WebSocketManager:
 
         if websocket.client_state == WebSocketState.CONNECTED:
             try:
-                await websocket.close()
+                await websocket.close(code=code)
                 logging.info("WebSocket disconnected.")
             except Exception as e:
                 logging.warning(f"Failed to close WebSocket: {e}")
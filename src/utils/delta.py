@@ -0,0 +1,73 @@
+def _index(items, key):
+    return {item.get(key): item for item in items or [] if item.get(key) is not None}
+
+def _diff_fields(previous, current, skip=()):
+    return {
+        field: value
+        for field, value in current.items()
+        if field not in skip and previous.get(field) != value
+    }
+
+def _diff_runners(previous, current):
+    prev_runners = _index(previous, 'selectionName')
+    curr_runners = _index(current, 'selectionName')
+
+    changed = []
+    for name, runner in curr_runners.items():
+        old = prev_runners.get(name)
+        if old is None:
+            changed.append(runner)
+            continue
+        fields = _diff_fields(old, runner)
+        if fields:
+            changed.append({'selectionName': name, **fields})
+
+    removed = [name for name in prev_runners if name not in curr_runners]
+
+    patch = {}
+    if changed:
+        patch['changed'] = changed
+    if removed:
+        patch['removed'] = removed
+    return patch
+
+def _diff_market(previous, current):
+    patch = _diff_fields(previous, current, skip=('runners',))
+    if 'runners' in current or 'runners' in previous:
+        runners = _diff_runners(previous.get('runners'), current.get('runners'))
+        if runners:
+            patch['runners'] = runners
+    return patch
+
+def diff_market_data(previous, current):
+    """
+    Compute a compact patch between two process_market_data snapshots.
+
+    Markets are matched by marketId and runners by selectionName. New markets and
+    runners are included whole; existing ones carry only the fields that changed.
+    Returns an empty dict when nothing changed.
+    """
+    patch = {}
+    for category in dict.fromkeys([*previous, *current]):
+        prev_markets = _index(previous.get(category), 'marketId')
+        curr_markets = _index(current.get(category), 'marketId')
+
+        changed = []
+        for market_id, market in curr_markets.items():
+            old = prev_markets.get(market_id)
+            if old is None:
+                changed.append(market)
+                continue
+            fields = _diff_market(old, market)
+            if fields:
+                changed.append({'marketId': market_id, **fields})
+
+        removed = [market_id for market_id in prev_markets if market_id not in curr_markets]
+
+        if changed or removed:
+            patch[category] = {}
+            if changed:
+                patch[category]['changed'] = changed
+            if removed:
+                patch[category]['removed'] = removed
+    return patch
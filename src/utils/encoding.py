@@ -0,0 +1,82 @@
+import json
+
+try:
+    import orjson
+except ImportError:
+    orjson = None
+
+try:
+    import msgpack
+except ImportError:
+    msgpack = None
+
+DEFAULT_FORMAT = "json"
+
+def dumps(value) -> str:
+    """
+    Serialize to a JSON string, with orjson when it is installed.
+    """
+    if orjson is not None:
+        return orjson.dumps(value).decode()
+    return json.dumps(value)
+
+def loads(data: str | bytes):
+    if orjson is not None:
+        return orjson.loads(data)
+    return json.loads(data)
+
+def snapshot_message(event_id: str, seq: int, markets_data: str, stale: bool = False, epoch: str | None = None) -> str:
+    """
+    Build a markets snapshot message around already-serialized markets JSON,
+    splicing it in as-is instead of decoding and re-encoding it. epoch names
+    the sequence seq belongs to; there is none before the first publish.
+    """
+    epoch_field = f', "epoch": {dumps(epoch)}' if epoch else ""
+    stale_field = ', "stale": true' if stale else ""
+    return f'{{"type": "snapshot", "event_id": {dumps(event_id)}, "seq": {seq}{epoch_field}{stale_field}, "markets": {markets_data}}}'
+
+def available_formats() -> set[str]:
+    """
+    Wire formats a WebSocket client may ask for; MessagePack needs the msgpack package.
+    """
+    formats = {DEFAULT_FORMAT}
+    if msgpack is not None:
+        formats.add("msgpack")
+    return formats
+
+class EncodedMessage:
+    """
+    A message to send to many sockets, encoded at most once per wire format.
+
+    JSON recipients get the original text as-is; the first MessagePack
+    recipient decodes and packs it, and the others reuse the same bytes.
+    """
+    __slots__ = ("text", "value", "binary", "text_size")
+
+    def __init__(self, text: str):
+        self.text = text
+        self.value = None
+        self.binary: bytes | None = None
+        self.text_size: int | None = None
+
+    def decode(self):
+        if self.value is None:
+            self.value = loads(self.text)
+        return self.value
+
+    def encode(self, format: str) -> str | bytes:
+        if format == "msgpack":
+            if self.binary is None:
+                self.binary = msgpack.packb(self.decode())
+            return self.binary
+        return self.text
+
+    def size(self, format: str) -> int:
+        """
+        Bytes on the wire for format; only valid after encode(format).
+        """
+        if format == "msgpack":
+            return len(self.binary)
+        if self.text_size is None:
+            self.text_size = len(self.text.encode())
+        return self.text_size
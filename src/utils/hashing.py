@@ -1,9 +1,98 @@
+import asyncio
+import os
+import threading
+import time
+from concurrent.futures import ThreadPoolExecutor
 from passlib.context import CryptContext
+from dotenv import load_dotenv
 
-pwd_context = CryptContext(schemes=["bcrypt"], deprecated="auto")
+load_dotenv()
 
-def verify_password(plain_password, hashed_password):
-    return pwd_context.verify(plain_password, hashed_password)
+# bcrypt releases the GIL, so a few threads hash in parallel without blocking the event loop
+HASH_WORKERS = int(os.getenv("HASH_WORKERS", min(4, os.cpu_count() or 1)))
+BCRYPT_ROUNDS = int(os.getenv("BCRYPT_ROUNDS", 12))
 
-def get_password_hash(password):
-    return pwd_context.hash(password)
\ No newline at end of file
+# Hashes made with other rounds still verify and are flagged for rehashing
+pwd_context = CryptContext(schemes=["bcrypt"], deprecated="auto", bcrypt__rounds=BCRYPT_ROUNDS)
+
+class _HashPool:
+    """
+    Runs bcrypt calls on a fixed number of threads, counting how many wait.
+    """
+
+    def __init__(self, workers: int):
+        self.workers = workers
+        self.executor = ThreadPoolExecutor(max_workers=workers, thread_name_prefix="bcrypt")
+        self.lock = threading.Lock()
+        self.queued = 0
+        self.running = 0
+        self.max_queued = 0
+        self.completed = 0
+        self.total_wait = 0.0
+        self.max_wait = 0.0
+
+    async def run(self, func, *args):
+        call = {"submitted": time.perf_counter(), "queued": True}
+        with self.lock:
+            self.queued += 1
+            self.max_queued = max(self.max_queued, self.queued)
+        try:
+            future = self.executor.submit(self._call, call, func, *args)
+            return await asyncio.wrap_future(future)
+        finally:
+            # A call no thread picked up (submit failed, or cancelled while waiting) leaves the queue here
+            self._dequeue(call)
+
+    def _dequeue(self, call: dict) -> bool:
+        # Whichever of the caller and the worker thread gets here first takes the call off the queue
+        with self.lock:
+            if not call["queued"]:
+                return False
+            call["queued"] = False
+            self.queued -= 1
+            return True
+
+    def _call(self, call: dict, func, *args):
+        waited = time.perf_counter() - call["submitted"]
+        self._dequeue(call)
+        with self.lock:
+            self.running += 1
+            self.total_wait += waited
+            self.max_wait = max(self.max_wait, waited)
+        try:
+            return func(*args)
+        finally:
+            with self.lock:
+                self.running -= 1
+                self.completed += 1
+
+    def stats(self) -> dict:
+        with self.lock:
+            started = self.completed + self.running
+            return {
+                "workers": self.workers,
+                "queued": self.queued,
+                "running": self.running,
+                "max_queued": self.max_queued,
+                "completed": self.completed,
+                "avg_wait_ms": self.total_wait / started * 1000 if started else 0.0,
+                "max_wait_ms": self.max_wait * 1000,
+            }
+
+_pool = _HashPool(HASH_WORKERS)
+
+async def verify_password(plain_password, hashed_password):
+    return await _pool.run(pwd_context.verify, plain_password, hashed_password)
+
+async def verify_and_update(plain_password, hashed_password):
+    """
+    Verify a password, also returning a new hash if the stored one was made
+    with outdated parameters, or None.
+    """
+    return await _pool.run(pwd_context.verify_and_update, plain_password, hashed_password)
+
+async def get_password_hash(password):
+    return await _pool.run(pwd_context.hash, password)
+
+def hashing_stats() -> dict:
+    return _pool.stats()
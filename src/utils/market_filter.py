@@ -0,0 +1,73 @@
+class MarketFilter:
+    """
+    The part of an event's markets one subscription asked for: whole categories
+    and individual marketIds. A market matches if either selects it.
+
+    Filters are immutable and hashable, so subscribers with the same filter can
+    share one sliced message.
+    """
+    __slots__ = ("categories", "market_ids")
+
+    def __init__(self, categories=(), market_ids=()):
+        self.categories = frozenset(categories)
+        self.market_ids = frozenset(market_ids)
+
+    def add(self, categories=(), market_ids=()) -> "MarketFilter":
+        return MarketFilter(self.categories | set(categories), self.market_ids | set(market_ids))
+
+    def remove(self, categories=(), market_ids=()) -> "MarketFilter":
+        return MarketFilter(self.categories - set(categories), self.market_ids - set(market_ids))
+
+    def __bool__(self):
+        return bool(self.categories or self.market_ids)
+
+    def __eq__(self, other):
+        return (
+            isinstance(other, MarketFilter)
+            and self.categories == other.categories
+            and self.market_ids == other.market_ids
+        )
+
+    def __hash__(self):
+        return hash((self.categories, self.market_ids))
+
+    def apply(self, message: dict) -> dict:
+        """
+        Slice a markets channel message. A patch touching nothing selected keeps
+        its seq with empty changes, so the sequence stays gapless. Messages other
+        than snapshots and patches pass through unchanged.
+        """
+        message_type = message.get("type")
+        if message_type == "snapshot":
+            return {**message, "markets": self.slice_markets(message.get("markets") or {})}
+        if message_type == "patch":
+            return {**message, "changes": self.slice_changes(message.get("changes") or {})}
+        return message
+
+    def slice_markets(self, markets: dict) -> dict:
+        sliced = {}
+        for category, entries in markets.items():
+            if category in self.categories:
+                sliced[category] = entries
+            elif self.market_ids:
+                kept = [market for market in entries or [] if market.get("marketId") in self.market_ids]
+                if kept:
+                    sliced[category] = kept
+        return sliced
+
+    def slice_changes(self, changes: dict) -> dict:
+        sliced = {}
+        for category, change in changes.items():
+            if category in self.categories:
+                sliced[category] = change
+            elif self.market_ids:
+                kept = {}
+                changed = [market for market in change.get("changed", []) if market.get("marketId") in self.market_ids]
+                if changed:
+                    kept["changed"] = changed
+                removed = [market_id for market_id in change.get("removed", []) if market_id in self.market_ids]
+                if removed:
+                    kept["removed"] = removed
+                if kept:
+                    sliced[category] = kept
+        return sliced
@@ -0,0 +1,53 @@
+import base64
+import json
+from datetime import datetime
+
+from fastapi import HTTPException, Response
+from sqlalchemy import TypeDecorator, tuple_
+
+NEXT_CURSOR_HEADER = "X-Next-Cursor"
+
+def encode_cursor(*values) -> str:
+    payload = [value.isoformat() if isinstance(value, datetime) else value for value in values]
+    return base64.urlsafe_b64encode(json.dumps(payload).encode()).decode()
+
+def decode_cursor(cursor: str, *types) -> tuple:
+    try:
+        payload = json.loads(base64.urlsafe_b64decode(cursor.encode()))
+        if len(payload) != len(types):
+            raise ValueError("wrong cursor length")
+        return tuple(
+            datetime.fromisoformat(value) if kind is datetime else kind(value)
+            for kind, value in zip(types, payload)
+        )
+    except (ValueError, TypeError):
+        raise HTTPException(status_code=400, detail="Invalid cursor")
+
+def _python_type(column) -> type:
+    # SQLModel's AutoString wraps String and declares no python_type of its own
+    column_type = column.type
+    if isinstance(column_type, TypeDecorator):
+        column_type = column_type.impl_instance
+    return column_type.python_type
+
+def paginate(stmt, columns, cursor: str | None, limit: int):
+    """
+    Apply keyset pagination to a statement ordered by columns, newest first.
+    The last column must be unique so every row has a distinct position.
+    """
+    if cursor is not None:
+        values = decode_cursor(cursor, *(_python_type(column) for column in columns))
+        stmt = stmt.where(tuple_(*columns) < tuple_(*values))
+    # One extra row tells whether another page follows
+    return stmt.order_by(*(column.desc() for column in columns)).limit(limit + 1)
+
+def page(rows, columns, limit: int, response: Response) -> list:
+    """
+    Trim the look-ahead row and expose the next page's cursor in a header.
+    """
+    rows = list(rows)
+    if len(rows) > limit:
+        rows = rows[:limit]
+        last = rows[-1]
+        response.headers[NEXT_CURSOR_HEADER] = encode_cursor(*(getattr(last, column.key) for column in columns))
+    return rows
@@ -1,31 +1,29 @@
-import json
-
 def process_event_data(input_data):
     processed = []
     if not input_data or 'data' not in input_data:
         return processed
 
-    for entry in input_data.get('data', []):
-        event_info = entry.get('event', {})
-        catalogue_info = entry.get('catalogue', {})
+    for entry in input_data.get('data') or []:
+        event_info = entry.get('event') or {}
+        catalogue_info = entry.get('catalogue') or {}
 
         runners = []
-        for runner in catalogue_info.get('runners', []):
-            processed_runner = {
+        for runner in catalogue_info.get('runners') or []:
+            # Best price of each ladder; a missing or empty ladder has none
+            back_odds = runner.get('backOdds')
+            lay_odds = runner.get('layOdds')
+            runners.append({
                 "name": runner.get('name'),
-                "backOdds": (runner.get('backOdds', [{}])[0]).get('price'),
-                "layOdds": (runner.get('layOdds', [{}])[0]).get('price')
-            }
-            runners.append(processed_runner)
+                "backOdds": back_odds[0].get('price') if back_odds else None,
+                "layOdds": lay_odds[0].get('price') if lay_odds else None
+            })
 
-        processed_entry = {
+        processed.append({
             "event_id": event_info.get('id'),
             "event_name": event_info.get('name'),
             "openDate": event_info.get('openDate'),
             "runners": runners
-        }
-
-        processed.append(processed_entry)
+        })
     return processed
 
 def process_market_data(input_data):
@@ -34,37 +32,38 @@ def process_market_data(input_data):
         return processed
 
     # Process fancy markets
-    for entry in input_data.get('fancy', []):
-        processed_entry = {
-            'marketId': entry.get('marketId'),
-            'marketName': entry.get('marketName'),
-            'statusName': entry.get('statusName'),
-            'runsNo': entry.get('runsNo'),
-            'runsYes': entry.get('runsYes'),
-            'oddsNo': entry.get('oddsNo'),
-            'oddsYes': entry.get('oddsYes'),
-            'minSetting': entry.get('minSetting'),
-            'maxSetting': entry.get('maxSetting'),
-            'sortingOrder': entry.get('sortingOrder'),
-            'catagory': entry.get('catagory')
-        }
-        processed['fancy'].append(processed_entry)
+    fancy = processed['fancy']
+    for entry in input_data.get('fancy') or []:
+        get = entry.get
+        fancy.append({
+            'marketId': get('marketId'),
+            'marketName': get('marketName'),
+            'statusName': get('statusName'),
+            'runsNo': get('runsNo'),
+            'runsYes': get('runsYes'),
+            'oddsNo': get('oddsNo'),
+            'oddsYes': get('oddsYes'),
+            'minSetting': get('minSetting'),
+            'maxSetting': get('maxSetting'),
+            'sortingOrder': get('sortingOrder'),
+            'catagory': get('catagory')
+        })
 
     # Process bookmaker markets
-    bookMaker = input_data.get('bookMaker', [])
+    bookMaker = input_data.get('bookMaker') or []
     if bookMaker:
-        runners = []
-        for entry in bookMaker:
-            processed_runner = {
+        runners = [
+            {
                 'selectionName': entry.get('selectionName'),
                 'selectionStatus': entry.get('selectionStatus'),
                 'backOdds': entry.get('backOdds'),
                 'layOdds': entry.get('layOdds')
             }
-            runners.append(processed_runner)
+            for entry in bookMaker
+        ]
 
         first_entry = bookMaker[0]
-        processed_bookmaker = {
+        processed['bookMaker'].append({
             'marketId': first_entry.get('marketId'),
             'marketName': first_entry.get('marketName'),
             'statusName': first_entry.get('statusName'),
@@ -72,7 +71,6 @@ def process_market_data(input_data):
             'maxSetting': first_entry.get('maxSetting'),
             'sortPeriority': first_entry.get('sortPeriority'),
             'runners': runners
-        }
-        processed['bookMaker'].append(processed_bookmaker)
+        })
 
-    return processed
\ No newline at end of file
+    return processed
@@ -0,0 +1,105 @@
+import copy
+import os
+import tempfile
+
+# Configuration is read when src is imported, so it is set before anything imports it
+_db_dir = tempfile.mkdtemp(prefix="betting-tests-")
+os.environ["DATABASE_URL"] = f"sqlite+aiosqlite:///{_db_dir}/test.db"
+os.environ.setdefault("JWT_SECRET_KEY", "test-secret")
+os.environ.setdefault("JWT_ALGORITHM", "HS256")
+os.environ.setdefault("BASE_URL", "http://upstream.test/")
+os.environ.setdefault("X_RAPIDAPI_KEY", "test-key")
+os.environ.setdefault("REDIS_URL", "redis://localhost:6379/0")
+
+import fakeredis
+import fakeredis.aioredis
+import pytest
+import redis.asyncio
+from fastapi.testclient import TestClient
+from sqlmodel import SQLModel
+
+import src.main
+from src.database import create_db_and_tables, engine
+from src.services.api_client import APIClient
+from src.services.redis_client import RedisClient
+
+
+@pytest.fixture
+def anyio_backend():
+    return "asyncio"
+
+
+@pytest.fixture
+def redis_server(monkeypatch):
+    """
+    One in-memory Redis server per test; every client created during the test shares it.
+    """
+    server = fakeredis.FakeServer()
+    monkeypatch.setattr(
+        redis.asyncio, "from_url",
+        lambda url=None, **kwargs: fakeredis.aioredis.FakeRedis(server=server, decode_responses=True),
+    )
+    return server
+
+
+@pytest.fixture
+async def redis_client(redis_server):
+    client = RedisClient()
+    yield client
+    await client.close()
+
+
+@pytest.fixture
+async def db():
+    """
+    A fresh schema, seeded like a new deployment (the "test" admin with 10000).
+    """
+    async with engine.begin() as conn:
+        await conn.run_sync(SQLModel.metadata.drop_all)
+    await create_db_and_tables()
+    yield
+    await engine.dispose()
+
+
+class Upstream:
+    """
+    Canned upstream feeds, served in place of the HTTP API; tests edit them between polls.
+    """
+
+    def __init__(self):
+        self.events = [{"event_id": "E1", "event_name": "A v B", "openDate": "2030-01-01T10:00:00Z", "runners": []}]
+        self.markets = {
+            "E1": {
+                "bookMaker": [{"marketId": "M1", "marketName": "Match Odds", "statusName": "OPEN",
+                               "runners": [{"selectionName": "A", "backOdds": 1.5}, {"selectionName": "B", "backOdds": 2.5}]}],
+                "fancy": [{"marketId": "F1", "marketName": "Runs", "statusName": "ACTIVE", "runsYes": 10}],
+            }
+        }
+
+    async def fetch_events(self):
+        return copy.deepcopy(self.events)
+
+    async def fetch_markets(self, event_id):
+        return copy.deepcopy(self.markets.get(event_id))
+
+
+@pytest.fixture
+def upstream(monkeypatch):
+    feeds = Upstream()
+    monkeypatch.setattr(APIClient, "fetch_events", lambda self: feeds.fetch_events())
+    monkeypatch.setattr(APIClient, "fetch_markets", lambda self, event_id: feeds.fetch_markets(event_id))
+    return feeds
+
+
+@pytest.fixture
+def client(redis_server, upstream):
+    """
+    The app with its lifespan running, on fakeredis and canned upstream feeds.
+    """
+    with TestClient(src.main.app) as test_client:
+        yield test_client
+
+
+@pytest.fixture
+def sync_redis(redis_server):
+    return fakeredis.FakeRedis(server=redis_server, decode_responses=True)
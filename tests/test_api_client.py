@@ -0,0 +1,121 @@
+import asyncio
+
+import httpx
+import pytest
+
+from src.services import api_client
+from src.services.api_client import APIClient, CircuitBreaker, CircuitOpenError, TokenBucket
+
+pytestmark = pytest.mark.anyio
+
+
+@pytest.fixture(autouse=True)
+def fast_backoff(monkeypatch):
+    monkeypatch.setattr(api_client, "API_BACKOFF_BASE", 0.01)
+    monkeypatch.setattr(api_client, "API_BREAKER_THRESHOLD", 3)
+    monkeypatch.setattr(api_client, "API_BREAKER_COOLDOWN", 0.2)
+
+
+class Upstream:
+    """
+    Answers each request with the next queued behaviour: a status code, or "hang".
+    """
+
+    def __init__(self, *behaviours):
+        self.behaviours = list(behaviours)
+        self.calls = 0
+
+    async def __call__(self, request):
+        self.calls += 1
+        behaviour = self.behaviours.pop(0) if self.behaviours else 200
+        if behaviour == "hang":
+            await asyncio.sleep(10)
+        if isinstance(behaviour, tuple):
+            status, headers = behaviour
+            return httpx.Response(status, headers=headers, json={})
+        return httpx.Response(behaviour, json={"fancy": [], "bookMaker": []})
+
+
+def make_client(upstream, **kwargs):
+    client = APIClient(rate_limit=0, **kwargs)
+    client.client = httpx.AsyncClient(base_url="http://upstream.test", transport=httpx.MockTransport(upstream))
+    return client
+
+
+async def test_transient_errors_are_retried():
+    upstream = Upstream(503, 502)
+    client = make_client(upstream, max_retries=2)
+    assert await client.fetch_markets("E1") == {"bookMaker": [], "fancy": []}
+    assert upstream.calls == 3
+    assert client.stats()["markets"]["retries"] == 2
+    assert client.breakers["markets"].failures == 0
+
+
+async def test_client_errors_are_not_retried_or_counted_against_the_upstream():
+    upstream = Upstream(404)
+    client = make_client(upstream, max_retries=2)
+    assert await client.fetch_markets("E1") is None
+    assert upstream.calls == 1
+    assert client.breakers["markets"].failures == 0
+
+
+async def test_hanging_upstream_fails_within_the_deadline_and_trips_the_breaker():
+    upstream = Upstream(*["hang"] * 20)
+    client = make_client(upstream, max_retries=2, fetch_deadline=0.2)
+
+    loop = asyncio.get_running_loop()
+    for _ in range(3):
+        started = loop.time()
+        assert await client.fetch_markets("E1") is None
+        assert loop.time() - started < 0.5
+    assert client.breakers["markets"].state == "open"
+    assert client.stats()["markets"]["breaker_trips"] == 1
+
+    # Open: rejected without calling the upstream
+    calls = upstream.calls
+    with pytest.raises(CircuitOpenError):
+        await client._fetch("markets", "/GetSession/", {"eventid": "E1"})
+    assert upstream.calls == calls
+
+
+async def test_half_open_trial_closes_the_breaker_on_success():
+    upstream = Upstream("hang", "hang", "hang")
+    client = make_client(upstream, max_retries=0, fetch_deadline=0.05)
+    for _ in range(3):
+        await client.fetch_markets("E1")
+    assert client.breakers["markets"].state == "open"
+
+    await asyncio.sleep(0.25)
+    assert client.breakers["markets"].state == "half_open"
+    assert await client.fetch_markets("E1") is not None
+    assert client.breakers["markets"].state == "closed"
+
+
+async def test_max_fetch_time_is_bounded_by_the_deadline():
+    client = make_client(Upstream(), max_retries=2, fetch_deadline=12)
+    assert client.max_fetch_time() == 12
+    client = make_client(Upstream(), max_retries=0, fetch_deadline=12)
+    assert client.max_fetch_time() == client.timeout
+
+
+async def test_retry_after_pauses_every_request():
+    bucket = TokenBucket(rate=100, burst=1)
+    bucket.pause(0.1)
+    loop = asyncio.get_running_loop()
+    started = loop.time()
+    assert await bucket.acquire()
+    assert loop.time() - started >= 0.09
+
+
+async def test_breaker_reopens_when_the_trial_fails():
+    breaker = CircuitBreaker(threshold=2, cooldown=0.05)
+    breaker.record_failure()
+    assert breaker.state == "closed"
+    breaker.record_failure()
+    assert breaker.trips == 1
+    assert not breaker.allow()
+    await asyncio.sleep(0.06)
+    assert breaker.allow()
+    assert not breaker.allow()  # One trial at a time
+    breaker.record_failure()
+    assert breaker.trips == 2
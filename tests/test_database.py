@@ -0,0 +1,82 @@
+import pytest
+from sqlalchemy import inspect, text
+from sqlmodel import SQLModel, select
+
+from src.database import create_db_and_tables, engine, new_session
+from src.models.bet import Bet
+from src.models.user import Transaction, User
+from src.services.ledger import get_balance
+
+pytestmark = pytest.mark.anyio
+
+# The schema as the app created it before the balance ledger
+BASELINE_SCHEMA = [
+    'CREATE TABLE "user" (username VARCHAR NOT NULL PRIMARY KEY, password VARCHAR NOT NULL, balance FLOAT NOT NULL, '
+    "is_active BOOLEAN NOT NULL, is_admin BOOLEAN NOT NULL, refresh_token VARCHAR)",
+    'CREATE INDEX ix_user_username ON "user" (username)',
+    "CREATE TABLE event (id INTEGER NOT NULL PRIMARY KEY, event_id VARCHAR NOT NULL, event_name VARCHAR NOT NULL, "
+    "start_time DATETIME NOT NULL)",
+    "CREATE TABLE market (id INTEGER NOT NULL PRIMARY KEY, event_id VARCHAR NOT NULL REFERENCES event (event_id), "
+    "market_id VARCHAR NOT NULL, market_name VARCHAR NOT NULL, status VARCHAR NOT NULL)",
+    "CREATE INDEX ix_market_market_id ON market (market_id)",
+    "CREATE TABLE runner (id INTEGER NOT NULL PRIMARY KEY, selection_name VARCHAR NOT NULL, "
+    "market_id VARCHAR NOT NULL REFERENCES market (market_id))",
+    'CREATE TABLE bet (id INTEGER NOT NULL PRIMARY KEY, username VARCHAR NOT NULL REFERENCES "user" (username), '
+    "market_id VARCHAR NOT NULL REFERENCES market (market_id), market_name VARCHAR NOT NULL, selection VARCHAR NOT NULL, "
+    "stake FLOAT NOT NULL, odds FLOAT NOT NULL, payout FLOAT NOT NULL, status VARCHAR NOT NULL, "
+    "placed_at DATETIME NOT NULL, settled_at DATETIME)",
+    'CREATE TABLE "transaction" (id INTEGER NOT NULL PRIMARY KEY, username VARCHAR NOT NULL REFERENCES "user" (username), '
+    "amount INTEGER NOT NULL, type VARCHAR NOT NULL, final_balance VARCHAR NOT NULL, created_at VARCHAR NOT NULL)",
+]
+
+
+@pytest.fixture
+async def baseline_db():
+    async with engine.begin() as conn:
+        await conn.run_sync(SQLModel.metadata.drop_all)
+        await conn.execute(text("DROP TABLE IF EXISTS transaction_legacy"))
+        for statement in BASELINE_SCHEMA:
+            await conn.execute(text(statement))
+        await conn.execute(text(
+            "INSERT INTO \"user\" VALUES ('test', 'x', 2500, 1, 1, NULL), ('alice', 'x', 120.5, 1, 0, NULL), "
+            "('bob', 'x', 0, 1, 0, NULL)"
+        ))
+        await conn.execute(text("INSERT INTO event VALUES (1, 'E1', 'A v B', '2030-01-01 10:00:00')"))
+        await conn.execute(text("INSERT INTO market VALUES (1, 'E1', 'M1', 'Match Odds', 'OPEN')"))
+        await conn.execute(text(
+            "INSERT INTO bet VALUES (1, 'alice', 'M1', 'Match Odds', 'A', 10, 2, 0, 'OPEN', '2026-01-01 00:00:00', NULL)"
+        ))
+        await conn.execute(text("INSERT INTO \"transaction\" VALUES (1, 'alice', 5, 'x', '5', 'yesterday')"))
+    yield
+    async with engine.begin() as conn:
+        await conn.execute(text("DROP TABLE IF EXISTS transaction_legacy"))
+    await engine.dispose()
+
+
+async def test_baseline_database_is_upgraded_with_balances_kept(baseline_db):
+    await create_db_and_tables()
+
+    async with new_session() as session:
+        assert await get_balance(session, "test") == 2500
+        assert await get_balance(session, "alice") == 120.5
+        assert await get_balance(session, "bob") == 0
+        assert (await session.exec(select(Bet.reference))).all() == [None]
+        opening = (await session.exec(select(Transaction).where(Transaction.username == "alice"))).one()
+        assert (opening.type, opening.reference) == ("DEPOSIT", "legacy-balance")
+
+        # New users no longer need the dropped balance column
+        session.add(User(username="carol", password="x"))
+        await session.commit()
+
+    async with engine.connect() as conn:
+        tables = await conn.run_sync(lambda sync: inspect(sync).get_table_names())
+        legacy_rows = (await conn.execute(text("SELECT COUNT(*) FROM transaction_legacy"))).scalar()
+    assert {"transaction", "transaction_legacy", "balancesnapshot"} <= set(tables)
+    assert legacy_rows == 1
+
+
+async def test_upgrade_runs_once(baseline_db):
+    await create_db_and_tables()
+    await create_db_and_tables()
+    async with new_session() as session:
+        assert await get_balance(session, "alice") == 120.5
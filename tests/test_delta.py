@@ -0,0 +1,96 @@
+import copy
+
+import pytest
+
+from src.utils.delta import diff_market_data
+
+
+def apply_patch(markets, patch):
+    """
+    Apply a patch the way a client does: markets by marketId, runners by selectionName.
+    """
+    markets = copy.deepcopy(markets)
+    for category, changes in patch.items():
+        current = {market["marketId"]: market for market in markets.setdefault(category, [])}
+        for change in changes.get("changed", []):
+            market = current.get(change["marketId"])
+            if market is None:
+                markets[category].append(change)
+                continue
+            for field, value in change.items():
+                if field != "runners":
+                    market[field] = value
+            runners_patch = change.get("runners", {})
+            runners = {runner["selectionName"]: runner for runner in market.get("runners", [])}
+            for runner_change in runners_patch.get("changed", []):
+                if runner_change["selectionName"] in runners:
+                    runners[runner_change["selectionName"]].update(runner_change)
+                else:
+                    market.setdefault("runners", []).append(runner_change)
+            removed_runners = set(runners_patch.get("removed", []))
+            if removed_runners:
+                market["runners"] = [r for r in market["runners"] if r["selectionName"] not in removed_runners]
+        removed = set(changes.get("removed", []))
+        markets[category] = [market for market in markets[category] if market["marketId"] not in removed]
+    return markets
+
+
+def book(*runners, status="OPEN"):
+    return {"marketId": "M1", "marketName": "Match Odds", "statusName": status,
+            "runners": [{"selectionName": name, "backOdds": odds, "layOdds": odds + 0.1} for name, odds in runners]}
+
+
+PREVIOUS = {
+    "bookMaker": [book(("A", 1.5), ("B", 2.5))],
+    "fancy": [{"marketId": "F1", "marketName": "Runs", "statusName": "ACTIVE", "runsYes": 10},
+              {"marketId": "F2", "marketName": "Wickets", "statusName": "ACTIVE", "runsYes": 2}],
+}
+
+
+def test_unchanged_snapshot_gives_an_empty_patch():
+    assert diff_market_data(PREVIOUS, copy.deepcopy(PREVIOUS)) == {}
+
+
+def test_patch_carries_only_changed_fields():
+    current = copy.deepcopy(PREVIOUS)
+    current["bookMaker"][0]["runners"][0]["backOdds"] = 1.6
+    current["fancy"][1]["statusName"] = "SUSPENDED"
+
+    assert diff_market_data(PREVIOUS, current) == {
+        "bookMaker": {"changed": [{"marketId": "M1", "runners": {"changed": [{"selectionName": "A", "backOdds": 1.6}]}}]},
+        "fancy": {"changed": [{"marketId": "F2", "statusName": "SUSPENDED"}]},
+    }
+
+
+def test_new_entries_are_sent_whole_and_missing_ones_removed():
+    current = copy.deepcopy(PREVIOUS)
+    current["bookMaker"] = [book(("A", 1.5), ("C", 4.0))]
+    current["fancy"] = [PREVIOUS["fancy"][0], {"marketId": "F3", "marketName": "Fours", "statusName": "ACTIVE"}]
+
+    patch = diff_market_data(PREVIOUS, current)
+    assert patch["bookMaker"] == {"changed": [{"marketId": "M1", "runners": {
+        "changed": [{"selectionName": "C", "backOdds": 4.0, "layOdds": 4.1}], "removed": ["B"],
+    }}]}
+    assert patch["fancy"] == {"changed": [current["fancy"][1]], "removed": ["F2"]}
+
+
+@pytest.mark.parametrize("current", [
+    {**PREVIOUS, "bookMaker": [book(("A", 1.5), ("B", 2.5), status="SUSPENDED")]},
+    {**PREVIOUS, "bookMaker": [book(("B", 2.7), ("A", 1.4), ("D", 9.0))]},
+    {**PREVIOUS, "bookMaker": []},
+    {"fancy": PREVIOUS["fancy"][::-1]},
+    {**PREVIOUS, "fancy": [{**PREVIOUS["fancy"][0], "runsYes": None}]},
+])
+def test_applying_the_patch_rebuilds_the_snapshot(current):
+    rebuilt = apply_patch(PREVIOUS, diff_market_data(PREVIOUS, current))
+
+    def by_id(markets):
+        return {
+            category: {
+                market["marketId"]: {**market, "runners": sorted(market.get("runners", []), key=lambda r: r["selectionName"])}
+                for market in markets.get(category, [])
+            }
+            for category in ("bookMaker", "fancy")
+        }
+
+    assert by_id(rebuilt) == by_id(current)
@@ -0,0 +1,46 @@
+import asyncio
+import threading
+
+import pytest
+
+from src.utils.hashing import _HashPool
+
+pytestmark = pytest.mark.anyio
+
+
+@pytest.fixture
+def pool():
+    pool = _HashPool(1)
+    yield pool
+    pool.executor.shutdown(wait=True)
+
+
+async def test_completed_and_failed_calls_leave_the_queue(pool):
+    assert await pool.run(pow, 2, 3) == 8
+    with pytest.raises(ZeroDivisionError):
+        await pool.run(divmod, 1, 0)
+    stats = pool.stats()
+    assert (stats["queued"], stats["running"], stats["completed"]) == (0, 0, 2)
+
+
+async def test_rejected_submit_leaves_the_queue(pool):
+    pool.executor.shutdown()
+    with pytest.raises(RuntimeError):
+        await pool.run(pow, 2, 3)
+    assert pool.stats()["queued"] == 0
+
+
+async def test_call_cancelled_while_waiting_leaves_the_queue(pool):
+    release = threading.Event()
+    busy = asyncio.create_task(pool.run(release.wait))
+    waiting = asyncio.create_task(pool.run(pow, 2, 3))
+    await asyncio.sleep(0.05)
+    assert pool.stats()["queued"] == 1
+
+    waiting.cancel()
+    await asyncio.gather(waiting, return_exceptions=True)
+    assert pool.stats()["queued"] == 0
+    release.set()
+    await busy
+    stats = pool.stats()
+    assert (stats["queued"], stats["running"], stats["completed"]) == (0, 0, 1)
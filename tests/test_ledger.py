@@ -0,0 +1,120 @@
+import asyncio
+
+import pytest
+from fastapi import HTTPException
+from sqlalchemy import func
+from sqlmodel import select
+
+from src.database import new_session
+from src.models.bet import Bet
+from src.models.user import BalanceSnapshot, Transaction, TransactionType, User
+from src.schemas.bet import BetSlipItem
+from src.services import ledger as ledger_module
+from src.services.betting_engine import place_bets_logic
+from src.services.ledger import InsufficientFundsError, LedgerWriter, get_balance
+from src.services.market_index import index_events, index_markets
+
+pytestmark = pytest.mark.anyio
+
+EVENTS = [{"event_id": "E1", "event_name": "A v B", "openDate": "2030-01-01T10:00:00Z", "runners": []}]
+MARKETS = {"bookMaker": [{"marketId": "M1", "marketName": "Match Odds", "statusName": "OPEN", "runners": []}]}
+
+
+@pytest.fixture
+async def ledger(db):
+    writer = LedgerWriter()
+    writer.start()
+    yield writer
+    await writer.stop()
+
+
+@pytest.fixture
+async def indexed(redis_client):
+    await index_events(redis_client, EVENTS)
+    await index_markets(redis_client, "E1", MARKETS)
+    return redis_client
+
+
+def leg(stake):
+    return BetSlipItem(event_id="E1", market_id="M1", market_name="Match Odds", selection="A", odds=2, stake=stake)
+
+
+async def ledger_rows(model):
+    async with new_session() as session:
+        return list((await session.exec(select(model))).all())
+
+
+async def balance(username="test"):
+    async with new_session() as session:
+        return await get_balance(session, username)
+
+
+async def test_slip_debit_and_bets_commit_together(ledger, indexed):
+    async with new_session() as session:
+        bets = await place_bets_logic(session, indexed, ledger, "test", [leg(100), leg(50)])
+
+    assert all(bet.id is not None for bet in bets)
+    stakes = [row for row in await ledger_rows(Transaction) if row.type == TransactionType.BET_STAKE.value]
+    assert [(row.amount, row.reference) for row in stakes] == [(-150, bets[0].reference)]
+    assert await balance() == 9850
+
+
+async def test_rejected_slip_leaves_no_debit_and_no_bets(ledger, indexed):
+    async with new_session() as session:
+        with pytest.raises(HTTPException) as error:
+            await place_bets_logic(session, indexed, ledger, "test", [leg(6000), leg(5000)])
+    assert error.value.status_code == 400
+    assert await ledger_rows(Bet) == []
+    assert await balance() == 10000
+
+
+async def test_bets_that_cannot_be_stored_undo_their_debit_only(ledger):
+    good = Bet(username="test", market_id="M1", market_name="Match Odds", selection="A", stake=10, odds=2)
+    bad = Bet(username="test", market_id="M1", market_name=None, selection="A", stake=20, odds=2)
+
+    results = await asyncio.gather(
+        ledger.append("test", -10, TransactionType.BET_STAKE, "good", require_funds=True, rows=[good]),
+        ledger.append("test", -20, TransactionType.BET_STAKE, "bad", require_funds=True, rows=[bad]),
+        ledger.append("test", 5, TransactionType.DEPOSIT),
+        return_exceptions=True,
+    )
+
+    assert isinstance(results[1], Exception)
+    assert not isinstance(results[0], Exception) and not isinstance(results[2], Exception)
+    assert [bet.stake for bet in await ledger_rows(Bet)] == [10]
+    assert await balance() == 10000 - 10 + 5
+
+
+async def test_group_commit_never_overdraws(ledger):
+    results = await asyncio.gather(
+        *(ledger.append("test", -70, TransactionType.WITHDRAWAL, require_funds=True) for _ in range(150)),
+        return_exceptions=True,
+    )
+    accepted = [result for result in results if not isinstance(result, Exception)]
+    assert all(isinstance(result, InsufficientFundsError) for result in results if result not in accepted)
+    assert len(accepted) == 10000 // 70
+    assert await balance() == 10000 - 70 * len(accepted)
+    assert ledger.stats()["rejected"] == 150 - len(accepted)
+
+
+async def test_snapshots_fold_the_tail_once(ledger, monkeypatch):
+    monkeypatch.setattr(ledger_module, "LEDGER_SNAPSHOT_LAG", -1)
+    for amount in (100, -30, 5):
+        await ledger.append("test", amount, TransactionType.DEPOSIT)
+
+    # Overlapping runs, as during a leader change, must not fold entries twice
+    await asyncio.gather(ledger.snapshot_balances(), ledger.snapshot_balances())
+    await ledger.append("test", 1, TransactionType.DEPOSIT)
+    await ledger.snapshot_balances()
+
+    async with new_session() as session:
+        snapshot = await session.get(BalanceSnapshot, "test")
+        total = (await session.exec(select(func.sum(Transaction.amount)))).one()
+    assert snapshot.balance == total == 10076
+    assert await balance() == 10076
+
+
+async def test_balance_of_unknown_user_is_zero(db):
+    async with new_session() as session:
+        assert await get_balance(session, "nobody") == 0
+        assert await session.get(User, "test") is not None
@@ -0,0 +1,91 @@
+import pytest
+
+from src.main import app
+from tests.test_websocket import subscribe
+
+
+def poll(client):
+    client.portal.call(app.state.scheduler._poll_fetch_markets, "E1")
+
+
+def set_odds(upstream, odds):
+    upstream.markets["E1"]["bookMaker"][0]["runners"][0]["backOdds"] = odds
+
+
+@pytest.fixture
+def published(client, upstream):
+    """
+    E1 published as a snapshot (seq 1) and two patches, with the market loop
+    stopped so only the test polls. A subscriber stays connected throughout,
+    as the leader forgets an event nobody follows. Yields the sequence's epoch.
+    """
+    async def stop_polling():
+        app.state.scheduler.stop_polling()
+
+    client.portal.call(stop_polling)
+    poll(client)
+    with client.websocket_connect("/ws") as watcher:
+        snapshot = subscribe(watcher)
+        assert snapshot["seq"] == 1
+        for odds in (1.6, 1.7):
+            set_odds(upstream, odds)
+            poll(client)
+        yield snapshot["epoch"]
+
+
+def test_resume_replays_missed_patches(client, published):
+    with client.websocket_connect("/ws") as ws:
+        first = subscribe(ws, since=1, epoch=published)
+        second, status = ws.receive_json(), ws.receive_json()
+
+    assert [(first["type"], first["seq"]), (second["type"], second["seq"])] == [("patch", 2), ("patch", 3)]
+    assert first["epoch"] == second["epoch"] == published
+    runner = second["changes"]["bookMaker"]["changed"][0]["runners"]["changed"][0]
+    assert runner == {"selectionName": "A", "backOdds": 1.7}
+    assert status == {"type": "status", "event_id": "E1", "stale": False}
+    assert app.state.ws_manager.replays == 1
+
+
+def test_resume_at_the_latest_seq_only_gets_the_status(client, published):
+    with client.websocket_connect("/ws") as ws:
+        assert subscribe(ws, since=3, epoch=published)["type"] == "status"
+
+
+@pytest.mark.parametrize("resume", [
+    {"since": 1, "epoch": None},
+    {"since": 1, "epoch": "other"},
+    {"since": 4},
+    {"since": 0},
+    {"since": True},
+    {"since": "1"},
+])
+def test_resume_falls_back_to_a_snapshot(client, published, resume):
+    resume = {"epoch": published, **resume}
+    if resume["epoch"] is None:
+        del resume["epoch"]
+    with client.websocket_connect("/ws") as ws:
+        message = subscribe(ws, **resume)
+    assert (message["type"], message["seq"]) == ("snapshot", 3)
+    assert message["markets"]["bookMaker"][0]["runners"][0]["backOdds"] == 1.7
+
+
+def test_resume_past_the_kept_stream_gets_a_snapshot(client, sync_redis, published):
+    sync_redis.xtrim("stream:markets:E1", maxlen=1, approximate=False)
+    with client.websocket_connect("/ws") as ws:
+        assert subscribe(ws, since=1, epoch=published)["type"] == "snapshot"
+    # Only seq 3 is still kept, which is all a client at seq 2 missed
+    with client.websocket_connect("/ws") as ws:
+        assert subscribe(ws, since=2, epoch=published)["seq"] == 3
+
+
+def test_restarted_sequence_gets_a_new_epoch(client, sync_redis, upstream, published):
+    # The seq key expired, e.g. nobody followed E1 for a while, so the next publish is seq 1 again
+    sync_redis.delete("markets_seq:E1")
+    set_odds(upstream, 1.8)
+    poll(client)
+
+    epoch = sync_redis.get("markets_epoch:E1")
+    assert epoch != published
+    with client.websocket_connect("/ws") as ws:
+        message = subscribe(ws, since=1, epoch=published)
+    assert (message["type"], message["seq"], message["epoch"]) == ("snapshot", 1, epoch)
@@ -0,0 +1,112 @@
+import base64
+from datetime import datetime, timedelta
+
+import httpx
+import pytest
+
+from src.database import new_session
+from src.main import app
+from src.models.bet import Bet, Event, Market
+from src.utils.pagination import NEXT_CURSOR_HEADER, encode_cursor
+
+pytestmark = pytest.mark.anyio
+
+START = datetime(2030, 1, 1, 10, 0)
+
+
+@pytest.fixture
+async def http(db):
+    async with httpx.AsyncClient(transport=httpx.ASGITransport(app=app), base_url="http://test") as http:
+        yield http
+
+
+async def add(*rows):
+    async with new_session() as session:
+        session.add_all(rows)
+        await session.commit()
+
+
+async def add_bets(count, placed_at=START, market_id="M1"):
+    await add(*(
+        Bet(username="test", market_id=market_id, market_name="Match Odds", selection="A",
+            stake=1, odds=2, placed_at=placed_at)
+        for _ in range(count)
+    ))
+
+
+async def all_pages(http, url, limit):
+    pages, cursor = [], None
+    while True:
+        params = {"limit": limit} | ({"cursor": cursor} if cursor else {})
+        response = await http.get(url, params=params)
+        assert response.status_code == 200, response.text
+        pages.append(response.json())
+        cursor = response.headers.get(NEXT_CURSOR_HEADER)
+        if cursor is None:
+            return pages
+
+
+@pytest.fixture
+async def market(db):
+    await add(Event(event_id="E1", event_name="A v B", start_time=START))
+    await add(Market(event_id="E1", market_id="M1", market_name="Match Odds", status="OPEN"))
+
+
+async def test_rows_sharing_a_timestamp_are_paged_without_gaps_or_repeats(http, market):
+    await add_bets(7)
+    await add_bets(3, placed_at=START + timedelta(minutes=1))
+
+    pages = await all_pages(http, "/betting/bets/M1", limit=3)
+
+    assert [len(page) for page in pages] == [3, 3, 3, 1]
+    # Newest first, ties broken by id
+    assert [bet["id"] for page in pages for bet in page] == list(range(10, 0, -1))
+
+
+async def test_rows_added_between_pages_do_not_shift_the_next_page(http, market):
+    await add_bets(4)
+    first = await http.get("/betting/bets/M1", params={"limit": 2})
+    await add_bets(5, placed_at=START + timedelta(hours=1))
+
+    second = await http.get("/betting/bets/M1", params={"limit": 2, "cursor": first.headers[NEXT_CURSOR_HEADER]})
+    seen = [bet["id"] for bet in first.json() + second.json()]
+    assert seen == [4, 3, 2, 1]
+
+
+async def test_events_and_markets_are_paged(http, market):
+    await add(*(Event(event_id=f"E{i}", event_name="x", start_time=START) for i in range(2, 6)))
+    await add(*(Market(event_id="E1", market_id=f"M{i}", market_name="x", status="OPEN") for i in range(2, 6)))
+
+    events = [event["event_id"] for page in await all_pages(http, "/betting/events", 2) for event in page]
+    assert sorted(events) == ["E1", "E2", "E3", "E4", "E5"]
+    markets = [m["market_id"] for page in await all_pages(http, "/betting/markets/E1", 2) for m in page]
+    assert markets == ["M5", "M4", "M3", "M2", "M1"]
+
+
+def raw_cursor(text):
+    return base64.urlsafe_b64encode(text.encode()).decode()
+
+
+@pytest.mark.parametrize("cursor", [
+    "not a cursor!",
+    raw_cursor("not json"),
+    raw_cursor("5"),
+    raw_cursor('["2030-01-01T10:00:00"]'),
+    raw_cursor('["2030-01-01T10:00:00", 1, 2]'),
+    raw_cursor('["yesterday", 1]'),
+    raw_cursor('[1.5, 1]'),
+    raw_cursor('["2030-01-01T10:00:00", "one"]'),
+    raw_cursor('["2030-01-01T10:00:00", null]'),
+    raw_cursor('"ab"'),
+])
+async def test_malformed_cursor_is_rejected(http, market, cursor):
+    response = await http.get("/betting/bets/M1", params={"cursor": cursor})
+    assert response.status_code == 400
+    assert response.json()["detail"] == "Invalid cursor"
+
+
+async def test_cursor_round_trips_its_values(http, market):
+    await add_bets(3)
+    response = await http.get("/betting/bets/M1", params={"limit": 1, "cursor": encode_cursor(START, 3)})
+    assert [bet["id"] for bet in response.json()] == [2]
+    assert response.headers[NEXT_CURSOR_HEADER] == encode_cursor(START, 2)
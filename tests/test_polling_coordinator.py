@@ -0,0 +1,107 @@
+import asyncio
+
+import pytest
+
+from src.services.polling_coordinator import INTEREST_KEY, LEADER_KEY, WORKERS_KEY, PollingCoordinator
+from src.services.redis_client import RedisClient
+
+pytestmark = pytest.mark.anyio
+
+
+class Scheduler:
+    """
+    Records what the coordinator asks the polling scheduler to do.
+    """
+
+    def __init__(self):
+        self.polling = False
+        self.market_due: dict[str, float] = {}
+
+    def start_polling(self):
+        self.polling = True
+
+    def stop_polling(self):
+        self.polling = False
+        self.market_due.clear()
+
+    def add_market_job(self, event_id):
+        self.market_due[event_id] = 0
+
+    def remove_market_fetch_job(self, event_id):
+        self.market_due.pop(event_id, None)
+
+
+@pytest.fixture
+async def workers(redis_server):
+    clients = [RedisClient(), RedisClient()]
+    coordinators = [PollingCoordinator(client, Scheduler(), lease=1) for client in clients]
+    yield coordinators
+    for coordinator in coordinators:
+        await coordinator.stop()
+    for client in clients:
+        await client.close()
+
+
+async def test_one_leader_polls_the_summed_interest(workers, monkeypatch):
+    first, second = workers
+    for coordinator in workers:
+        await coordinator.start()
+    assert [first.is_leader, second.is_leader] == [True, False]
+    assert first.scheduler.polling and not second.scheduler.polling
+
+    def no_scan(*args, **kwargs):
+        raise AssertionError("interest must not be found by scanning the keyspace")
+
+    monkeypatch.setattr(first.redis, "scan_iter", no_scan)
+    await first.update_interest("E1", 2)
+    await second.update_interest("E1", 3)
+    await second.update_interest("E2", 1)
+    await first._sync_interest()
+
+    assert first.subscribers("E1") == 5
+    assert set(first.scheduler.market_due) == {"E1", "E2"}
+
+    await second.update_interest("E2", 0)
+    await first._sync_interest()
+    assert set(first.scheduler.market_due) == {"E1"}
+
+
+async def test_dead_worker_is_pruned_and_its_interest_dropped(workers):
+    first, second = workers
+    await first.start()
+    await first.update_interest("events", 1)
+    await second.update_interest("E9", 1)
+    await first._sync_interest()
+    assert "E9" in first.scheduler.market_due
+
+    # The dead worker's hash expires; its id is dropped from the set on the next sync
+    await second.redis.delete(INTEREST_KEY.format(second.worker_id))
+    await first._sync_interest()
+    assert "E9" not in first.scheduler.market_due
+    assert await first.redis.smembers(WORKERS_KEY) == {first.worker_id}
+
+
+async def test_leadership_fails_over_when_the_lease_lapses(workers):
+    first, second = workers
+    for coordinator in workers:
+        await coordinator.start()
+    assert first.is_leader
+
+    # The leader stalls without renewing, e.g. a long GC pause or a hung event loop
+    first.task.cancel()
+    await asyncio.sleep(1.5)
+    assert second.is_leader and second.scheduler.polling
+    assert await second.redis.get(LEADER_KEY) == second.worker_id
+
+    # Back from the stall, the old leader finds its lease taken and stops polling
+    await first._campaign()
+    assert not first.is_leader and not first.scheduler.polling
+
+
+async def test_stopping_leader_hands_over_at_once(workers):
+    first, second = workers
+    await first.start()
+    await first.stop()
+    assert await first.redis.get(LEADER_KEY) is None
+    await second.start()
+    assert second.is_leader
@@ -0,0 +1,77 @@
+import asyncio
+import copy
+import logging
+
+import pytest
+
+from src.main import app
+from src.services import scheduler as scheduler_module
+
+
+def test_timed_out_poll_flags_markets_stale(client, sync_redis, upstream, monkeypatch):
+    sch = app.state.scheduler
+    client.portal.call(sch._poll_fetch_markets, "E1")
+    assert sync_redis.get("stale:markets:E1") is None
+
+    async def hang(event_id):
+        await asyncio.sleep(10)
+
+    monkeypatch.setattr(upstream, "fetch_markets", hang)
+    monkeypatch.setattr(scheduler_module, "MARKET_POLL_TIMEOUT", 0.05)
+    client.portal.call(sch._poll_due_markets, "E1")
+
+    assert sync_redis.get("stale:markets:E1") == "1"
+    assert sch.market_stats()["timeouts"] == 1
+    # The last good snapshot is still served
+    assert sync_redis.get("markets:E1") is not None
+
+
+def test_poll_timeout_below_fetch_time_is_reported(client, monkeypatch, caplog):
+    monkeypatch.setattr(scheduler_module, "MARKET_POLL_TIMEOUT", 5)
+    with caplog.at_level(logging.ERROR):
+        app.state.scheduler._check_poll_timeout()
+    assert "MARKET_POLL_TIMEOUT" in caplog.text
+
+    caplog.clear()
+    monkeypatch.setattr(scheduler_module, "MARKET_POLL_TIMEOUT", 15)
+    app.state.scheduler._check_poll_timeout()
+    assert caplog.text == ""
+
+
+def test_slow_poll_does_not_hold_back_other_events(client, upstream, monkeypatch):
+    sch = app.state.scheduler
+    calls = []
+    monkeypatch.setattr(scheduler_module, "MARKET_POLL_TICK", 0.01)
+    monkeypatch.setattr(sch.policy, "interval", lambda *args: 0.02)
+
+    async def scenario():
+        sch.stop_polling()
+        release = asyncio.Event()
+
+        async def fetch(event_id):
+            calls.append(event_id)
+            if event_id == "SLOW":
+                await release.wait()
+            return copy.deepcopy(upstream.markets["E1"])
+
+        monkeypatch.setattr(upstream, "fetch_markets", fetch)
+        sch.add_market_job("SLOW")
+        sch.add_market_job("FAST")
+        loop_task = asyncio.create_task(sch._market_loop())
+        await asyncio.sleep(0.3)
+        # The hung poll is neither waited for nor started again while in flight
+        assert calls.count("SLOW") == 1
+        assert calls.count("FAST") >= 3
+        assert sch.market_stats()["in_flight"] == 1
+
+        release.set()
+        await asyncio.sleep(0.1)
+        assert calls.count("SLOW") >= 2
+
+        loop_task.cancel()
+        await asyncio.gather(loop_task, return_exceptions=True)
+        assert sch.market_polls == {}
+        for event_id in ("SLOW", "FAST"):
+            sch.remove_market_fetch_job(event_id)
+
+    client.portal.call(scenario)
@@ -0,0 +1,129 @@
+import asyncio
+
+import pytest
+
+from src.services.send_queue import SendQueue
+
+pytestmark = pytest.mark.anyio
+
+
+class Client:
+    """
+    A WebSocket whose sends block until the test lets them through.
+    """
+
+    def __init__(self):
+        self.sent = []
+        self.gate = asyncio.Semaphore(0)
+        self.slow = 0
+        self.resyncs = []
+
+    async def send(self, message):
+        await self.gate.acquire()
+        self.sent.append(message)
+        return True
+
+    async def resync(self, channel):
+        self.resyncs.append(channel)
+        return f"snapshot:{channel}"
+
+    def allow(self, sends: int):
+        for _ in range(sends):
+            self.gate.release()
+
+    def on_slow(self):
+        self.slow += 1
+
+    def queue(self, **kwargs):
+        return SendQueue(self.send, self.resync, self.on_slow, **kwargs)
+
+
+async def drain(queue):
+    for _ in range(100):
+        await asyncio.sleep(0)
+        if not queue.queue:
+            return
+
+
+async def test_full_queue_conflates_a_channel_into_one_snapshot():
+    client = Client()
+    queue = client.queue(maxsize=3)
+    queue.put("a1", "A")
+    queue.put("b1", "B")
+    queue.put("a2", "A")
+    queue.put("a3", "A")
+    # Covered by the pending snapshot, so dropped rather than queued behind it
+    queue.put("a4", "A")
+    queue.put("direct")
+
+    assert list(queue.queue) == [("B", "b1"), ("A", None), (None, "direct")]
+    assert queue.conflated == 4
+
+    client.allow(10)
+    await drain(queue)
+    assert client.sent == ["b1", "snapshot:A", "direct"]
+    assert client.resyncs == ["A"]
+    queue.close()
+
+
+async def test_updates_after_the_resync_is_read_queue_behind_it():
+    client = Client()
+    queue = client.queue(maxsize=10)
+    queue.put("a1", "A")
+    queue.request_resync("A")
+    assert list(queue.queue) == [("A", None)]
+
+    client.allow(10)
+    await drain(queue)
+    queue.put("a2", "A")
+    await drain(queue)
+    assert client.sent == ["snapshot:A", "a2"]
+    queue.close()
+
+
+async def test_client_over_the_limit_too_long_is_dropped():
+    client = Client()
+    queue = client.queue(maxsize=1, slow_timeout=0.05)
+    queue.put("a1", "A")
+    queue.put("b1", "B")
+    await asyncio.sleep(0.1)
+    queue.put("b2", "B")
+
+    assert client.slow == 1
+    assert queue.closed and not queue.queue
+    await asyncio.sleep(0)
+    assert queue.task.done()
+
+
+async def test_catching_up_below_the_limit_ends_the_slow_period():
+    client = Client()
+    queue = client.queue(maxsize=2, slow_timeout=0.05)
+    queue.put("a1", "A")
+    queue.put("b1", "B")
+    queue.put("c1", "C")
+    assert queue.behind_since is not None
+
+    # One send brings it back under the limit without emptying the queue
+    client.allow(1)
+    await asyncio.sleep(0.1)
+    assert len(queue.queue) == 1 and queue.behind_since is None
+
+    queue.put("c2", "C")
+    queue.put("d1", "D")
+    assert client.slow == 0 and not queue.closed
+    queue.close()
+
+
+async def test_failed_send_stops_the_writer():
+    async def send(message):
+        return False
+
+    async def resync(channel):
+        return None
+
+    queue = SendQueue(send, resync, lambda: None)
+    queue.put("a1", "A")
+    await asyncio.sleep(0)
+    assert queue.task.done() and queue.closed
+    queue.put("a2", "A")
+    assert not queue.queue
@@ -0,0 +1,162 @@
+import json
+
+import pytest
+from sqlalchemy.exc import IntegrityError, OperationalError
+from sqlmodel import select
+
+from src.database import new_session
+from src.models.bet import Bet
+from src.schemas.bet import BetSlipItem
+from src.services.betting_engine import settle_bets_logic
+from src.services.ledger import InsufficientFundsError, get_balance
+from src.services.market_index import index_events, index_markets
+from src.services.stake_reservation import DEAD_KEY, PENDING_KEY, PROCESSING_KEY, StakeReservation
+
+pytestmark = pytest.mark.anyio
+
+EVENTS = [{"event_id": "E1", "event_name": "A v B", "openDate": "2030-01-01T10:00:00Z", "runners": []}]
+MARKETS = {
+    "bookMaker": [{"marketId": "M1", "marketName": "Match Odds", "statusName": "OPEN",
+                   "runners": [{"selectionName": "A"}, {"selectionName": "B"}]}],
+    "fancy": [{"marketId": "F1", "marketName": "Runs", "statusName": "ACTIVE"}],
+}
+
+
+def leg(market_id="M1", selection="A", stake=10.0):
+    return BetSlipItem(event_id="E1", market_id=market_id, market_name="x", selection=selection, odds=2, stake=stake)
+
+
+@pytest.fixture
+async def reservation(db, redis_client):
+    await index_events(redis_client, EVENTS)
+    await index_markets(redis_client, "E1", MARKETS)
+    return StakeReservation(redis_client, max_attempts=3)
+
+
+async def reserve(reservation, *legs):
+    async with new_session() as session:
+        return await reservation.place_bets(session, "test", list(legs))
+
+
+async def take_all(reservation):
+    redis = reservation.redis
+    batch = []
+    while item := await redis.lmove(PENDING_KEY, PROCESSING_KEY, "RIGHT", "LEFT"):
+        batch.append(item)
+    return batch
+
+
+async def stored_bets():
+    async with new_session() as session:
+        return list((await session.exec(select(Bet))).all())
+
+
+async def test_reserve_debits_mirror_and_rejects_overdraft(reservation):
+    await reserve(reservation, leg(stake=9000))
+    assert float(await reservation.redis.get("balance:test")) == 1000
+    with pytest.raises(InsufficientFundsError):
+        await reserve(reservation, leg(stake=1001))
+    assert await reservation.redis.llen(PENDING_KEY) == 1
+
+
+async def test_persist_stores_bets_and_stake_once(reservation):
+    await reserve(reservation, leg("M1", stake=30), leg("F1", "Yes", stake=20))
+    batch = await take_all(reservation)
+    assert not await reservation._persist_batch(batch)
+    # A replay of the same slip, e.g. after a crash before release, is skipped
+    await reservation._persist_batch(batch)
+
+    assert len(await stored_bets()) == 2
+    async with new_session() as session:
+        assert await get_balance(session, "test") == 9950
+    assert await reservation.redis.llen(PROCESSING_KEY) == 0
+
+
+async def test_unknown_market_is_dead_lettered_without_blocking_the_batch(reservation):
+    await reserve(reservation, leg("M1", stake=10))
+    await reserve(reservation, leg("NOPE", stake=25))
+    await reserve(reservation, leg("F1", "Yes", stake=5))
+
+    assert not await reservation._persist_batch(await take_all(reservation))
+
+    assert sorted(bet.market_id for bet in await stored_bets()) == ["F1", "M1"]
+    dead = [json.loads(item) for item in await reservation.redis.lrange(DEAD_KEY, 0, -1)]
+    assert [entry["slip"]["bets"][0]["market_id"] for entry in dead] == ["NOPE"]
+    assert "unknown" in dead[0]["reason"]
+    # Only the stored stakes stay debited from the mirror
+    assert float(await reservation.redis.get("balance:test")) == 9985
+    assert await reservation.redis.llen(PROCESSING_KEY) == 0
+    assert reservation.stats()["dead_lettered"] == 1
+
+
+async def test_slip_pending_at_settlement_is_refunded_not_left_open(reservation):
+    await reserve(reservation, leg("M1", stake=10))
+    assert not await reservation._persist_batch(await take_all(reservation))
+    await reserve(reservation, leg("M1", stake=40))
+
+    async with new_session() as session:
+        await settle_bets_logic(session, "M1", "A", reservation)
+    await reservation._persist_batch(await take_all(reservation))
+
+    bets = await stored_bets()
+    assert [(bet.stake, bet.status) for bet in bets] == [(10, "WON")]
+    assert "settled" in json.loads(await reservation.redis.lindex(DEAD_KEY, 0))["reason"]
+    async with new_session() as session:
+        ledger_balance = await get_balance(session, "test")
+    assert ledger_balance == 10000 - 10 + 20
+    assert float(await reservation.redis.get("balance:test")) == ledger_balance
+
+
+async def test_failing_slip_is_retried_alone_then_dead_lettered(reservation, monkeypatch):
+    await reserve(reservation, leg("M1", stake=10))
+    bad = await reserve(reservation, leg("M1", stake=20))
+    persist = reservation._persist
+
+    async def flaky(batch):
+        if any(bad[0].reference in item for item in batch):
+            raise OperationalError("INSERT", {}, Exception("disk I/O error"))
+        return await persist(batch)
+
+    monkeypatch.setattr(reservation, "_persist", flaky)
+
+    # The good slip is stored on the first pass; the bad one is requeued until it runs out of attempts
+    assert await reservation._persist_batch(await take_all(reservation))
+    assert [bet.stake for bet in await stored_bets()] == [10]
+    assert await reservation.redis.llen(PENDING_KEY) == 1
+    assert await reservation._persist_batch(await take_all(reservation))
+    assert not await reservation._persist_batch(await take_all(reservation))
+
+    assert await reservation.redis.llen(PENDING_KEY) == 0
+    assert await reservation.redis.llen(DEAD_KEY) == 1
+    assert float(await reservation.redis.get("balance:test")) == 9990
+    assert reservation.attempts == {}
+
+
+async def test_integrity_error_is_dead_lettered_at_once(reservation, monkeypatch):
+    await reserve(reservation, leg("M1", stake=10))
+
+    async def violates(batch):
+        raise IntegrityError("INSERT", {}, Exception("FOREIGN KEY constraint failed"))
+
+    monkeypatch.setattr(reservation, "_persist", violates)
+    assert not await reservation._persist_batch(await take_all(reservation))
+    assert await reservation.redis.llen(DEAD_KEY) == 1
+    assert float(await reservation.redis.get("balance:test")) == 10000
+
+
+async def test_recover_requeues_in_flight_slips(reservation):
+    await reserve(reservation, leg("M1", stake=10))
+    await take_all(reservation)
+    await reservation.recover()
+    assert await reservation.redis.llen(PROCESSING_KEY) == 0
+    assert await reservation.redis.llen(PENDING_KEY) == 1
+
+
+async def test_reconcile_waits_for_queued_slips(reservation):
+    await reserve(reservation, leg("M1", stake=10))
+    await reservation.redis.set("balance:test", 1)
+    assert not await reservation.reconcile()
+
+    await reservation._persist_batch(await take_all(reservation))
+    assert await reservation.reconcile()
+    assert float(await reservation.redis.get("balance:test")) == 9990
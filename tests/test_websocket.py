@@ -0,0 +1,97 @@
+import time
+
+import msgpack
+import pytest
+
+from src.main import app
+from src.services.websocket_handler import WebSocketManager
+
+
+def subscribe(ws, **message):
+    ws.send_json({"type": "market", "event_id": "E1", **message})
+    return ws.receive_json()
+
+
+def wait_until(condition, timeout=2.0):
+    deadline = time.monotonic() + timeout
+    while not condition():
+        assert time.monotonic() < deadline, "condition not met in time"
+        time.sleep(0.02)
+
+
+def assert_released(manager, sync_redis):
+    wait_until(lambda: not manager.queues)
+    assert manager.connections == {}
+    assert manager.channel_subscribers == {}
+    assert manager.market_filters == {}
+    assert manager.ping_tasks == {}
+    assert sync_redis.hgetall(f"market_interest:{app.state.polling.worker_id}") == {}
+
+
+def test_snapshot_on_subscribe(client):
+    with client.websocket_connect("/ws") as ws:
+        message = subscribe(ws)
+    assert message["type"] == "snapshot"
+    assert [market["marketId"] for market in message["markets"]["bookMaker"]] == ["M1"]
+
+
+@pytest.mark.parametrize("selection", [
+    {"market_ids": [[1]]},
+    {"market_ids": [{"id": "M1"}]},
+    {"market_ids": "M1"},
+    {"categories": [["fancy"]]},
+    {"categories": ["nope"]},
+])
+def test_malformed_selection_is_rejected_and_socket_stays_usable(client, selection):
+    with client.websocket_connect("/ws") as ws:
+        assert subscribe(ws, **selection)["error"] == "Invalid market selection"
+        assert subscribe(ws)["type"] == "snapshot"
+
+
+@pytest.mark.parametrize("message", ["not json", "[1, 2]", '{"type": "market", "event_id": ["E1"]}'])
+def test_malformed_message_is_answered(client, message):
+    with client.websocket_connect("/ws") as ws:
+        ws.send_text(message)
+        assert ws.receive_json() == {"error": "Invalid message format"}
+
+
+def test_unexpected_error_releases_everything(client, sync_redis, monkeypatch):
+    manager = app.state.ws_manager
+    with client.websocket_connect("/ws") as ws:
+        subscribe(ws, market_ids=["M1"])
+        assert sync_redis.hgetall(f"market_interest:{app.state.polling.worker_id}") == {"E1": "1"}
+
+        async def broken(websocket):
+            raise RuntimeError("boom")
+
+        monkeypatch.setattr(manager, "subscribe_to_events", broken)
+        ws.send_json({"type": "events"})
+        assert_released(manager, sync_redis)
+
+
+def test_disconnect_releases_everything(client, sync_redis):
+    manager = app.state.ws_manager
+    with client.websocket_connect("/ws") as ws:
+        subscribe(ws, categories=["fancy"])
+    assert_released(manager, sync_redis)
+
+
+@pytest.mark.parametrize("format", [["msgpack"], {"name": "msgpack"}, 7])
+def test_malformed_format_is_rejected(client, format):
+    with client.websocket_connect("/ws") as ws:
+        message = subscribe(ws, format=format)
+        assert message["error"] == "Unsupported format"
+        assert subscribe(ws)["type"] == "snapshot"
+
+
+def test_msgpack_socket_gets_every_frame_as_msgpack(client, monkeypatch):
+    monkeypatch.setattr(WebSocketManager, "PING_INTERVAL", 0.05)
+    with client.websocket_connect("/ws") as ws:
+        ws.send_json({"type": "market", "event_id": "E1", "format": "msgpack"})
+        assert msgpack.unpackb(ws.receive_bytes())["type"] == "snapshot"
+        assert msgpack.unpackb(ws.receive_bytes()) == {"ping": "pong"}
+        ws.send_json({"type": "unsubscribe", "event_id": "E2"})
+        received = msgpack.unpackb(ws.receive_bytes())
+        while received == {"ping": "pong"}:
+            received = msgpack.unpackb(ws.receive_bytes())
+        assert received == {"error": "Not subscribed to these markets"}